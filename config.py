@@ -9,11 +9,12 @@ MOVIE_3_PATH = 'C://movies_et//norm_mov3.mp4'
 
 
 WIFI_SOURCE = 'hotspot_msi'
-WIFI_IP_DICT = {
-    'hotspot_msi': ("127.0.0.1", "192.168.137.100") # first is master, second is slave
+PUPIL_DEVICES = {
+    'hotspot_msi': [  # first is master (child, runs the procedure), the rest are slaves
+        {'name': 'master', 'ip': '127.0.0.1', 'port': 50020},
+        {'name': 'slave', 'ip': '192.168.137.100', 'port': 50020},
+    ]
 }
-MASTER_PORT = 50020
-SLAVE_PORT = 50020
 
 WIN_ID_MASTER = 1
 WIN_ID_MAIN = 0
@@ -29,4 +30,79 @@ PHOTODIODE_POS = (1, 0)
 
 DEFAULT_BCKGND = [0, 0, 0]
 FREE_CONV_DURATION = 180
-FREE_CONV_INTERVAL = 30
\ No newline at end of file
+FREE_CONV_INTERVAL = 30
+
+SYNC_FS = 200
+SYNC_WIN_LEN = 5.0
+SYNC_WIN_STEP = 0.5
+SYNC_MAX_LAG = 2.0
+SYNC_CHUNK_WINDOWS = 64
+SYNC_RECUR_BINS = 8
+
+VIDEO_SOURCE_DIR = 'C://movies_et//raw'
+VIDEO_OUTPUT_PREFIX = 'norm_'
+LOUDNORM_I = -16
+LOUDNORM_TP = -1.5
+LOUDNORM_LRA = 11
+ASSET_WORKERS = 4
+
+SUBJECT_REFRESH_RATE = 60
+TRANSCODED_DIR = 'C://movies_et//transcoded'
+TRANSCODE_GOP = 1.0
+
+ASSET_CACHE_PATH = 'data/asset_probe_cache.json'
+CALIB_ANI_DURATION_RANGE = (5, 180)
+MOVIE_DURATION_RANGE = (45, 90)
+LOUDNESS_TOLERANCE = 2.0
+
+CLOCK_PROBE_INTERVAL = 5.0
+CLOCK_SAMPLES_PER_PROBE = 8
+CLOCK_QUERY_TIMEOUT = 500
+CLOCK_DRIFT_THRESHOLD = 0.002
+
+TRACE_ENABLED = True
+TRACE_CAPACITY = 200000
+
+# 'psychopy' (visual.MovieStim) or 'shared_memory' (decoding in a worker process, m10_movie_player). The shared
+# memory stimulus builds on private visual.MovieStim internals - switch only after checking it on the lab's PsychoPy.
+MOVIE_BACKEND = 'psychopy'
+MOVIE_RING_SLOTS = 8
+
+RECORDING_CONFIRM_TIMEOUT = 5.0
+
+REPLAY_SCALE = 0.5
+REPLAY_CHUNK_SECONDS = 5.0
+REPLAY_BATCH_FRAMES = 32
+REPLAY_MIN_CONFIDENCE = 0.6
+
+RESOURCE_SAMPLE_INTERVAL = 1.0
+RESOURCE_RSS_BUDGET = 100  # MB left behind by a stage after cleanup
+RESOURCE_HANDLE_BUDGET = 10
+RESOURCE_TRACEMALLOC = False
+
+PARADIGM_PATH = 'paradigm.json'
+PARADIGM_PRELOAD_RESIDENT = 2  # clips created ahead of time and held at once
+PARADIGM_OPERATOR_ESTIMATE = 10.0  # expected duration of an operator prompt [s], for the duration estimate
+PARADIGM_CALIBRATION_ESTIMATE = 60.0
+
+EVENT_VELOCITY_THRESHOLD = 30.0  # deg/s, I-VT
+EVENT_DISPERSION_THRESHOLD = 1.5  # deg, horizontal + vertical range, I-DT
+EVENT_MIN_FIXATION = 0.06  # s
+EVENT_MIN_SACCADE = 0.01  # s
+EVENT_BLINK_CONFIDENCE = 0.5
+EVENT_BLINK_DURATION = (0.05, 0.5)  # s, longer low-confidence runs are signal loss
+EVENT_CHUNK_SECONDS = 60.0
+EVENT_CHUNK_OVERLAP = 1.0  # s, longer than EVENT_MIN_FIXATION and the longest blink
+
+PLDATA_BATCH_SIZE = 10000
+
+ANNOTATION_CONFIRM = True  # confirm annotations by their echo and retransmit lost ones
+ANNOTATION_DEADLINE = 2.0  # s
+ANNOTATION_RETRANSMIT_INTERVAL = 0.25  # s
+
+INPUT_POLL_INTERVAL = 0.005  # s
+
+HEATMAP_BINS = (64, 36)  # columns, rows of the cohort heatmap grid over the screen surface
+HEATMAP_FRAME_BIN = 1  # movie frames per heatmap time bin
+HEATMAP_SIGMA = 1.5  # grid cells, Gaussian smoothing of exported heatmaps
+HEATMAP_ALPHA = 0.6  # opacity of the hottest cells in heatmap videos
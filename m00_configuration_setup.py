@@ -2,7 +2,9 @@
 Contains functions used during configuration setup.
 """
 
-from config import WIN_SIZES
+import os
+
+from config import WIN_SIZES, TRANSCODED_DIR
 
 def create_session_name(expinfo:dict):
     """
@@ -34,4 +36,20 @@ def check_screens_id(screens:list):
         print(f"Screen {i}: {screen.width}x{screen.height}, x={screen.x}, y={screen.y}")
         if screen.width != WIN_SIZES[i][0] or screen.height != WIN_SIZES[i][1]:
             raise TypeError(
-                f"Screen {i} resolution mismatch. Expected {WIN_SIZES[i]}, got {(screen.width, screen.height)} instead.")
\ No newline at end of file
+                f"Screen {i} resolution mismatch. Expected {WIN_SIZES[i]}, got {(screen.width, screen.height)} instead.")
+
+def get_stimulus_path(path:str):
+    """
+    Returns the decoder-friendly version of a configured clip (see misc/video_transcoding.py) if it exists,
+    otherwise the configured path itself.
+
+    Args:
+        path (str): Clip path from config.py.
+
+    Returns:
+        (str): Path to be opened by visual.MovieStim.
+    """
+    transcoded_path = os.path.join(TRANSCODED_DIR, os.path.basename(path))
+    if os.path.isfile(transcoded_path):
+        return transcoded_path
+    return path
@@ -1,35 +1,28 @@
 """
 Setup for logging paths, screens, windows, PsychoPy handlers, Pupil Capture communication and presented stimuli.
+PsychoPy modules are imported inside the functions, so that they load only when needed (see m05_startup).
 """
 import os
-import zmq
 import time
-from numpy.random import randint
-from psychopy import  gui, visual, core, data, logging, monitors
+from random import randint
 
 import m03_pupilcapture_comms as comms
+import m07_tracing as trace
 
 from config import FREE_CONV_DURATION, FREE_CONV_INTERVAL, DEFAULT_BCKGND, PHOTODIODE_POS
-from config import WIN_ID_MAIN, WIN_ID_MASTER, WIN_SIZES
-from config import WIFI_IP_DICT, WIFI_SOURCE, MASTER_PORT, SLAVE_PORT
+from config import WIN_ID_MAIN, WIN_SIZES
+from config import PUPIL_DEVICES, WIFI_SOURCE
 
-def setup_path_log_psychopy():
+@trace.traced(cat='startup')
+def show_session_dialog():
     """
-    Setup paths and logs for ET procedure.
+    Shows the PsychoPy GUI dialog for session information.
 
     Returns:
-        - expInfo (dict): Dictionary of experiment information (name:value)
-        - thisExp (ExperimentHandler): PsychoPy handler.
-        - logFile (LogFile): PsychoPy logfile.
-        - filename (str) Absolute path for saving all data and logs.
+        expInfo (dict): Dictionary of experiment information (name:value)
     """
+    from psychopy import gui, core
 
-    # Path for saving logs
-    _thisDir = os.path.dirname(os.path.abspath(__file__))
-    os.chdir(_thisDir)
-
-    # Info about experimental session and what goes into GUI dialog
-    psychopyVersion = '2025.1.1'
     expName = 'et_syncc_in_procedure'
     expInfo = {
         'participant': f"{randint(0, 999999):06.0f}",
@@ -48,6 +41,31 @@ def setup_path_log_psychopy():
         dlg = gui.DlgFromDict(dictionary=expInfo, sortKeys=False, title=expName)
         if not dlg.OK:
             core.quit()  # user pressed cancel
+    return expInfo
+
+@trace.traced(cat='startup')
+def setup_path_log_psychopy(expInfo:dict):
+    """
+    Setup paths and logs for ET procedure.
+
+    Args:
+        expInfo (dict): Dictionary of experiment information, filled in show_session_dialog.
+
+    Returns:
+        - expInfo (dict): Dictionary of experiment information (name:value)
+        - thisExp (ExperimentHandler): PsychoPy handler.
+        - logFile (LogFile): PsychoPy logfile.
+        - filename (str) Absolute path for saving all data and logs.
+    """
+    from psychopy import data, logging
+
+    # Path for saving logs
+    _thisDir = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(_thisDir)
+
+    # Info about experimental session
+    psychopyVersion = '2025.1.1'
+    expName = 'et_syncc_in_procedure'
     expInfo['date'] = data.getDateStr()  # add a simple timestamp
     expInfo['expName'] = expName
     expInfo['psychopyVersion'] = psychopyVersion
@@ -67,20 +85,21 @@ def setup_path_log_psychopy():
 
     return expInfo, thisExp, logFile, filename
 
+@trace.traced(cat='startup')
 def setup_windows(background_clr:tuple|list = None):
     """
-    Creates PsychoPy-based windows used during procedure.
+    Creates PsychoPy-based window presented to the Subjects. The Researcher window runs in the operator console
+    process (m08_operator_console).
 
     Args:
         background_clr (tuple|list) : RGB backround color
 
     Returns:
         win_main (Window): PsychoPy window, presented to the Subjects.
-        win_master (Window): PsychoPy window, used by the Researcher.
         gigabyte_monitor (Monitor): PsychoPy Monitor - main, presented to the Subjects.
-        test_monitor (Monitor): PsychoPy Monitor - master PC monitor.
 
     """
+    from psychopy import visual, monitors
 
     all_monitors = monitors.getAllMonitors()
     print(f"Available monitors: {all_monitors}")
@@ -92,12 +111,6 @@ def setup_windows(background_clr:tuple|list = None):
     gigabyte_monitor.setDistance(65)
     gigabyte_monitor.saveMon()
 
-    test_monitor = monitors.Monitor('testMonitor')
-    test_monitor.setWidth(30.0)
-    test_monitor.setSizePix([640, 480])
-    test_monitor.setDistance(50)
-    test_monitor.saveMon()
-
     if background_clr is None:
         background_clr = [-1.0, -1.0, -1.0]
 
@@ -108,128 +121,85 @@ def setup_windows(background_clr:tuple|list = None):
         blendMode='avg', useFBO=True,
         units='norm', infoMsg='.')
     win_main.mouseVisible = True
-
-    win_master = visual.Window(
-        size=[640, 480], fullscr=False, screen=WIN_ID_MASTER,
-        winType='pyglet', allowStencil=False,
-        monitor=test_monitor, color=background_clr, colorSpace='rgb',
-        blendMode='avg', useFBO=True,
-        units='norm', infoMsg='.')
     print("Windows defined")
 
-    return win_main, win_master, gigabyte_monitor, test_monitor
+    return win_main, gigabyte_monitor
 
-def setup_pupil_comms():
+@trace.traced(cat='startup')
+def setup_iohub(win_main, expInfo:dict):
     """
-    Setup for Python <-> PupilCapture communications.
-    Sends appropriate settings to the PupilCapture instances.
-    Creates PUB, SUB and REQ sockets for bot slave and master Pupil instances.
-    Based on ZMQ library.
+    Launches the ioHub server and the keyboard used for the User interface - standard PsychoPy segment.
 
-    Returns:
-         context_master (zmq.Context): Context for Master PC.
-         req_master (zmq.Socket): REQ socket on Master context.
-         pub_master (zmq.Socket): PUB socket on Master context.
-         sub_master (zmq.Socket): SUB socket on Master context.
-         context_slave (zmq.Context): Context for Slave PC.
-         req_slave (zmq.Socket): REQ socket on Slave context.
-         pub_slave (zmq.Socket): SUB socket on Slave context.
-         sub_slave (zmq.Socket): PUB socket on Slave context.
+    Args:
+        win_main (Window): PsychoPy window, presented to the Subjects.
+        expInfo (dict): Dictionary of experiment information.
 
+    Returns:
+        ioServer (ioHubConnection): ioHub server connection.
+        defaultKeyboard (keyboard.Keyboard): Keyboard on ioHub backend.
+        ioSession (str): ioHub session ID.
     """
+    import psychopy.iohub as io
+    from psychopy.hardware import keyboard
 
-    addr_master, addr_slave = WIFI_IP_DICT[WIFI_SOURCE]
+    ioConfig = {}
+    ioConfig['Keyboard'] = dict(use_keymap='psychopy')
+    ioServer = io.launchHubServer(window=win_main, **ioConfig)
+    defaultKeyboard = keyboard.Keyboard(backend='iohub')
+    ioSession = '1'
+    if 'session' in expInfo:
+        ioSession = str(expInfo['session'])
 
-    # Master PC - ports and connections
-    port_master = str(MASTER_PORT)
-    comms.check_capture_exists(addr_master, port_master, 'Master')
+    return ioServer, defaultKeyboard, ioSession
 
-    context_master = zmq.Context()  # Context creation
-    context_master.setsockopt(zmq.LINGER, 0)
-
-    req_master = context_master.socket(zmq.REQ)  # Master req
-    req_master.connect("tcp://{}:{}".format(addr_master, port_master))
-
-    # pub: send info to other processes - we use it to send annotations to pupil capture
-    req_master.send_string("PUB_PORT")  # Master pub
-    pub_port_master = req_master.recv_string()
-    pub_master = zmq.Socket(context_master, zmq.PUB)
-    pub_master.connect("tcp://{}:{}".format(addr_master, pub_port_master))
-
-    # sub: listen to other processes - currently listens to the calibration parameters from pupil capture
-    req_master.send_string("SUB_PORT")  # Master sub
-    sub_port_master = req_master.recv_string()
-    sub_master = context_master.socket(zmq.SUB)
-    sub_master.connect("tcp://{}:{}".format(addr_master, sub_port_master))
-    sub_master.setsockopt_string(zmq.SUBSCRIBE, 'logging')
-    print("Master ports established")
-
-    # Slave PC - ports and connections
-    port_slave = str(SLAVE_PORT)
-    comms.check_capture_exists(addr_slave, port_slave, 'Slave')
-
-    context_slave = zmq.Context()  # Context creation
-
-    req_slave = context_slave.socket(zmq.REQ)  # Slave req
-    req_slave.connect("tcp://{}:{}".format(addr_slave, port_slave))
+@trace.traced(cat='pupil')
+def setup_pupil_comms():
+    """
+    Setup for Python <-> PupilCapture communications.
+    Sends appropriate settings to the PupilCapture instances.
+    Creates PUB, SUB and REQ sockets for every Pupil instance configured in PUPIL_DEVICES (first one is the master).
+    Based on ZMQ library.
 
-    req_slave.send_string("PUB_PORT")  # Slave pub
-    pub_port_slave = req_slave.recv_string()
-    pub_slave = zmq.Socket(context_slave, zmq.PUB)
-    pub_slave.connect("tcp://{}:{}".format(addr_slave, pub_port_slave))
+    Returns:
+         pupil (comms.DeviceRegistry): Connected Pupil Capture devices.
 
-    req_slave.send_string("SUB_PORT")  # Slave sub
-    sub_port_slave = req_slave.recv_string()
-    sub_slave = context_slave.socket(zmq.SUB)
-    sub_slave.connect("tcp://{}:{}".format(addr_slave, sub_port_slave))
-    sub_slave.setsockopt_string(zmq.SUBSCRIBE, 'logging')
-    print("Slave ports established")
+    """
+    pupil = comms.DeviceRegistry(PUPIL_DEVICES[WIFI_SOURCE])
+    pupil.connect()
 
     # Safety-check: Stop recording if there is one.
     rec_trigger = {'subject': 'recording.should_stop', "remote_notify": "all"}
-    comms.notify(req_master, rec_trigger)
-    comms.notify(req_slave, rec_trigger)
-
-    # Master PC - plugins: Annotation_Capture, Time_Sync, Log_History, Pupil_Groups
-    comms.notify(req_master,
-                 {"subject": "start_plugin", "name": "Annotation_Capture", "args": {}})
-    comms.notify(req_master,
-                 {"subject": "start_plugin", "name": "Time_Sync",
-                  "args": {'base_bias': 1.1, 'node_name': 'sync_master'}})
-    comms.notify(req_master,
-                 {"subject": "start_plugin", "name": "Log_History", "args": {}})
-    comms.notify(req_master,
-                 {"subject": "start_plugin", "name": "Pupil_Groups",
-                  "args": {'name': 'master_pupil', 'active_group': 'ET_exp'}})
-
-    # Slave PC - plugins: Annotation_Capture, Time_Sync, Log_History, Pupil_Groups
-    comms.notify(req_slave,
-                 {"subject": "start_plugin", "name": "Annotation_Capture", "args": {}})
-    comms.notify(req_slave,
-                 {"subject": "start_plugin", "name": "Time_Sync",
-                  "args": {'base_bias': 1.0, 'node_name': 'sync_slave'}})
-    comms.notify(req_slave,
-                 {"subject": "start_plugin", "name": "Log_History", "args": {}})
-    comms.notify(req_slave,
-                 {"subject": "start_plugin", "name": "Pupil_Groups",
-                  "args": {'name': 'slave_pupil', 'active_group': 'ET_exp'}})
+    pupil.notify_all(rec_trigger)
+
+    # All PCs - plugins: Annotation_Capture, Time_Sync, Log_History, Pupil_Groups
+    def start_plugins(device):
+        node_name = 'sync_master' if device.is_master else f'sync_{device.name}'
+        comms.notify(device.req,
+                     {"subject": "start_plugin", "name": "Annotation_Capture", "args": {}})
+        comms.notify(device.req,
+                     {"subject": "start_plugin", "name": "Time_Sync",
+                      "args": {'base_bias': 1.1 if device.is_master else 1.0, 'node_name': node_name}})
+        comms.notify(device.req,
+                     {"subject": "start_plugin", "name": "Log_History", "args": {}})
+        comms.notify(device.req,
+                     {"subject": "start_plugin", "name": "Pupil_Groups",
+                      "args": {'name': f'{device.name}_pupil', 'active_group': 'ET_exp'}})
+    pupil.fan_out(start_plugins)
 
     # Time synchronization and comms delay.
     t = time.time()
-    req_master.send_string("t")
-    req_master.recv_string()
+    pupil.master.command("t")
     python_to_pupil_delay = time.time() - t
     print("Round trip Python<->Pupil command delay:", python_to_pupil_delay)
 
-    req_master.send_string("T 0.0")
-    print(f'Master timesync: {req_master.recv_string()}')
-    req_slave.send_string("T 0.0")
-    print(f'Slave timesync: {req_slave.recv_string()}')
+    for device, reply in zip(pupil, pupil.command_all("T 0.0")):
+        print(f'{device.name} timesync: {reply}')
 
     print('Pupil Communication established.')
 
-    return context_master, req_master, pub_master, sub_master, context_slave, req_slave, pub_slave, sub_slave
+    return pupil
 
+@trace.traced()
 def setup_photodiode(win, photo_pos=PHOTODIODE_POS):
     """
     Setup for photodiode crude communications - blinking black-and-white box, registered by photodiode connected to EEG.
@@ -244,6 +214,7 @@ def setup_photodiode(win, photo_pos=PHOTODIODE_POS):
         photo_rect_off (visual.Rect): Offset photodiode rectangle - blackbox.
         cross (visual.ShapeStim): Fixation cross.
     """
+    from psychopy import visual
 
     # Photodiode rectangle init
     size = 0.1
@@ -2,12 +2,14 @@
 Contains full PsychoPy-like procedures.
 """
 
-from psychopy import core, visual, event, sound
+from psychopy import core, visual, sound
 from psychopy.constants import NOT_STARTED, STARTED, FINISHED
 import msgpack as serializer
 from zmq.asyncio import Socket
 
 import m03_pupilcapture_comms as comms
+import m07_tracing as trace
+import m11_resource_monitor as resources
 
 from config import FRAMETOLERANCE
 
@@ -27,11 +29,13 @@ def setup_routine_components(components:list):
         if hasattr(comp, 'status'):
             comp.status = NOT_STARTED
 
+@trace.traced(cat='routine')
+@resources.attributed
 def run_routine(
     win,
     routine_components,
     routine_timer,
-    defaultKeyboard,
+    input_service,
     msg="Running routine...",
     duration=None,
     escape_key="escape",
@@ -41,7 +45,7 @@ def run_routine(
       win                - (psychopy.visual.Window) window to draw on
       routine_components - (list) PsychoPy stimuli (TextStim, MovieStim, etc.)
       routine_timer      - (psychopy.core.Clock) clock controlling routine
-      defaultKeyboard    - (psychopy.hardware.keyboard.Keyboard) keyboard for quit key
+      input_service      - (InputService) operator key queue, drained once per frame for the quit key
       msg                - (str) debug message
       duration           - (float|None) routine duration (s), None = until all comps finish
       escape_key         - (str) key to abort routine
@@ -81,7 +85,7 @@ def run_routine(
                 comp.status = FINISHED
 
         # escape handling
-        if defaultKeyboard.getKeys(keyList=[escape_key]):
+        if input_service.drain((escape_key,), context=msg):
             for comp in routine_components:
                 if isinstance(comp, visual.MovieStim):
                     comp.stop()
@@ -94,7 +98,8 @@ def run_routine(
         )
 
         if continue_routine:
-            win.flip()
+            with trace.span('flip', 'frame'):
+                win.flip()
 
     # cleanup
     for comp in routine_components:
@@ -103,22 +108,19 @@ def run_routine(
         if isinstance(comp, visual.MovieStim):
             comp.stop()
 
-def interrupt(msg:str, win:visual.Window, keys:tuple=('x',)):
+def interrupt(msg:str, console, keys:tuple=('x',)):
     """
-    Prints msg (str) at win (psychopy.visual.Window) and waits for the User to press on of the keys (tuple)
+    Prints msg (str) at the operator console and waits for the User to press on of the keys (tuple)
     Args:
-        msg (str): Text message shown at Master PC PsychoPy window.
-        win (visual.Window): Window.
+        msg (str): Text message shown at Master PC operator console window.
+        console (OperatorConsole): Operator console.
         keys (tuple): User input keys.
     """
-    print(msg)
-    message = visual.TextStim(win, text=msg, color='white')
-    message.draw()
-    win.flip()
-    _ = event.waitKeys(keyList=keys)
-    win.flip()
+    return console.prompt(msg, keys)
 
-def run_calibration(req_port:Socket, sub_port:Socket, debug_mode:bool=False):
+@trace.traced(cat='pupil')
+@resources.attributed
+def run_calibration(req_port:Socket, sub_port:Socket, console, debug_mode:bool=False):
     """
     Runs calibration at specific PC, based on chosen req_port and sub_port (Context.socket).
     Evaluates whether the calibration quality is satisfactory and gives the User a choice to accept the quality
@@ -128,6 +130,7 @@ def run_calibration(req_port:Socket, sub_port:Socket, debug_mode:bool=False):
     Args:
         req_port (zmq.Socket): REQ socket for specific PC PupilCapture instance.
         sub_port (zmq.Socket): SUB socket for specific PC PupilCapture instance.
+        console (OperatorConsole): Operator console, used to accept or redo the calibration.
         debug_mode (bool): Debug mode - no calibration started at PupilCapture.
 
     Returns:
@@ -161,24 +164,23 @@ def run_calibration(req_port:Socket, sub_port:Socket, debug_mode:bool=False):
                 print('Calibration done')
                 calib_done = True
             else:
-                print('Accuracy parameters invalid:\nPress \"y\" to redo calbration, press \"n\" to continue')
-                while True:
-                    keys = event.getKeys()
-                    if 'y' in keys:
-                        ang_acc, ang_prec = 0, 0
-                        print('Redoing calibration')
-                        req_port.send_string("C")
-                        print(req_port.recv_string())
-                        break
-                    elif 'n' in keys:
-                        print('Finishing calibration with non-optimal accuracy')
-                        calib_done = True
-                        break
+                key = console.prompt('Accuracy parameters invalid:\nPress \"y\" to redo calbration, press \"n\" to continue',
+                                     keys=('y', 'n'))
+                if key == 'y':
+                    ang_acc, ang_prec = 0, 0
+                    print('Redoing calibration')
+                    req_port.send_string("C")
+                    print(req_port.recv_string())
+                else:
+                    print('Finishing calibration with non-optimal accuracy')
+                    calib_done = True
                 continue
     return ang_acc, ang_prec
 
-def run_stimulus_routine(win, mov_name, movie, photo_rect_on, photo_rect_off, routineTimer, thisExp, defaultKeyboard,
-                         movie_duration=None):
+@trace.traced(cat='routine')
+@resources.attributed
+def run_stimulus_routine(win, mov_name, movie, photo_rect_on, photo_rect_off, routineTimer, thisExp, input_service,
+                         movie_duration=None, frame_log=None):
     """
     Movie stimulus presentation routine.
     Using specific window 'win' (psychopy.visual.Window), creates routine segment with predefined stimuli:
@@ -192,8 +194,9 @@ def run_stimulus_routine(win, mov_name, movie, photo_rect_on, photo_rect_off, ro
         photo_rect_off (visual.Rect): Photodiode offset marker.
         routineTimer (psychopy.core.Clock): PsychoPy routine clock.
         thisExp (dict): PsychoPy log dictionary.
-        defaultKeyboard (psychopy.keyboard.Keyboard): Keyboard used for User interface.
+        input_service (InputService): Operator key queue, drained once per frame for the quit key.
         movie_duration (int|None): How long the routine will be run. If None, it will be played as long as the movie.
+        frame_log (m13_frame_log.FrameLog|None): Records the flip timestamp and shown movie frame of every flip.
     """
 
     continueRoutine = True
@@ -248,7 +251,7 @@ def run_stimulus_routine(win, mov_name, movie, photo_rect_on, photo_rect_off, ro
             toggle_cnt += 1
 
         # escape handling
-        if defaultKeyboard.getKeys(keyList=["escape"]):
+        if input_service.drain(("escape",), context=mov_name):
             core.quit()
 
         # breaking the routine
@@ -260,7 +263,10 @@ def run_stimulus_routine(win, mov_name, movie, photo_rect_on, photo_rect_off, ro
                 continueRoutine = True
                 break
         if continueRoutine:  # don't flip if this routine is over or we'll get a blank screen
-            win.flip()
+            with trace.span('flip', 'frame'):
+                t_flip = win.flip()
+            if frame_log is not None:
+                frame_log.record(t_flip, movie.frameIndex if movie.status == STARTED else -1)
 
     # END MOV ROUTINE
     print('{} finished'.format(mov_name))
@@ -272,56 +278,25 @@ def run_stimulus_routine(win, mov_name, movie, photo_rect_on, photo_rect_off, ro
     photo_rect_on.setAutoDraw(False)
     photo_rect_off.setAutoDraw(True)
 
-def _show_countdown(duration, win, timer, text_stim, text_content, key_list: tuple = ("escape",)):
-    """
-    Countdown handler used in free conversation routine.
-
-    Args:
-        duration (int):
-        win (Window):
-        timer (psychopy.core.Clock):
-        text_stim (visual.Text):
-        text_content (str):
-        key_list (tuple):
-
-    Returns:
-        None|str
-
-    """
-    timer.reset()
-    while timer.getTime() < duration:
-        remaining = int(duration - timer.getTime())
-        text_stim.text = f"{text_content}: {remaining} s"
-        text_stim.draw()
-        win.flip()
-
-        keys = event.getKeys(keyList=key_list)
-        if "escape" in keys:
-            core.quit()
-        elif "x" in keys:
-            return "x"
-    return None
-
-def run_free_convo_routine(win, win_master, photo_rect_on, photo_rect_off,
-                           req_master, pub_master, pub_slave,
+@trace.traced(cat='routine')
+@resources.attributed
+def run_free_convo_routine(win, console, photo_rect_on, photo_rect_off, pupil,
                            convo_countdown, convo_len, routineTimer):
     """
     Free conversation routine.
 
     Args:
         win (Window): Presentation window - win_main.
-        win_master (Window): Researcher window at Master Pc.
+        console (OperatorConsole): Researcher console at Master Pc.
         photo_rect_on (visual.Rect): Photodiode onset marker.
         photo_rect_off (visual.Rect): Photodiode offset marker.
-        req_master (zmq.Socket): REQ socket for Master PC PupilCapture instance.
-        pub_master (zmq.Socket): PUB socket for Master PC PupilCapture instance.
-        pub_slave (zmq.Socket): REQ socket for Slave PC PupilCapture instance.
+        pupil (comms.DeviceRegistry): Pupil Capture devices.
         convo_countdown (int): Countdown duration prior to conversation.
         convo_len (int): Conversation duration.
         routineTimer (psychopy.core.Clock): Local routine timer.
     """
     # marker - countdown starting
-    comms.send_annotation(pub_master, pub_slave, f"start_countdown_free", req_master)
+    comms.send_annotation(pupil, "start_countdown_free")
 
     # timer prep
     routineTimer.reset()
@@ -330,9 +305,7 @@ def run_free_convo_routine(win, win_master, photo_rect_on, photo_rect_off,
 
 
     # stage 0: countdown
-    countdown_text = visual.TextStim(win_master, text="", height=0.1, color='white', pos=(0, 0))
-    wait_timer = core.Clock()
-    response = _show_countdown(convo_countdown, win_master, wait_timer, countdown_text, "Countdown. Time left:")
+    response = console.countdown(convo_countdown, "Countdown. Time left:")
     if response == "x":
         return
 
@@ -370,14 +343,13 @@ def run_free_convo_routine(win, win_master, photo_rect_on, photo_rect_off,
     photo_rect_off.setAutoDraw(True)
 
     # marker - conversation start
-    comms.send_annotation(pub_master, pub_slave, "start_free_convo", req_master)
+    comms.send_annotation(pupil, "start_free_convo")
     # audio signal
     beep = sound.Sound("C", secs=1.0, stereo=True)
     beep.play()
 
     # stage 2: free conversation
-    wait_timer = core.Clock()
-    response = _show_countdown(convo_len, win_master, wait_timer, countdown_text, 'Free conversation. Time left:')
+    response = console.countdown(convo_len, 'Free conversation. Time left:')
     if response == "x":
         pass
 
@@ -385,7 +357,7 @@ def run_free_convo_routine(win, win_master, photo_rect_on, photo_rect_off,
     beep = sound.Sound("C", secs=1.0, stereo=True)
     beep.play()
     # marker - conversation finished
-    comms.send_annotation(pub_master, pub_slave, "stop_free_convo", req_master)
+    comms.send_annotation(pupil, "stop_free_convo")
 
     routineTimer.reset()
     toggle_cnt = 0
@@ -5,10 +5,22 @@ Handling PupilCapture instances communications.
 import zmq
 import msgpack as serializer
 import socket
+import json
+import queue
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from zmq.asyncio import Socket
 
+import numpy as np
 
+import m07_tracing as trace
+
+from config import RECORDING_CONFIRM_TIMEOUT, ANNOTATION_DEADLINE, ANNOTATION_RETRANSMIT_INTERVAL
+
+
+@trace.traced(cat='pupil')
 def notify(pupil_remote:Socket, notification:dict):
     """
     Prepares payload to sent using notification (dict) and sends it
@@ -28,18 +40,6 @@ def notify(pupil_remote:Socket, notification:dict):
     pupil_remote.send(payload)
     return pupil_remote.recv_string()
 
-def send_trigger(pub_socket:Socket, trigger:dict):
-    """
-    Sends a trigger (dict) via PUB socket (Context.socket())
-
-    Args:
-        pub_socket (Socket): Target socket.
-        trigger (dict): Trigger content.
-    """
-    payload = serializer.dumps(trigger, use_bin_type=True)
-    pub_socket.send_string(trigger["topic"], flags=zmq.SNDMORE)
-    pub_socket.send(payload)
-
 def check_capture_exists(ip_address:str, port:str, pc:str):
     """
     Check if Pupil Capture instance exists at specific PC with ip_address via port
@@ -56,24 +56,485 @@ def check_capture_exists(ip_address:str, port:str, pc:str):
             print(f"{pc}: Cannot find Pupil Capture")
             sys.exit()
 
-def send_annotation(pub_master:Socket, pub_slave:Socket, label:str, req_master:Socket):
+class PupilDevice:
+    """
+    Connection to a single Pupil Capture instance: REQ (Pupil Remote), PUB and SUB sockets on its own ZMQ context.
+    """
+    def __init__(self, name:str, ip:str, port:int, is_master:bool=False):
+        self.name = name
+        self.ip = ip
+        self.port = str(port)
+        self.is_master = is_master
+        self.context = None
+        self.req = None
+        self.pub = None
+        self.sub = None
+        self.pub_port = None
+        self.sub_port = None
+
+    @trace.traced('connect', cat='pupil')
+    def connect(self):
+        """
+        Checks that Pupil Capture runs on the device and creates REQ, PUB and SUB sockets.
+        """
+        check_capture_exists(self.ip, self.port, self.name)
+
+        self.context = zmq.Context()
+        self.context.setsockopt(zmq.LINGER, 0)
+
+        self.req = self.context.socket(zmq.REQ)
+        self.req.connect("tcp://{}:{}".format(self.ip, self.port))
+
+        # pub: send info to other processes - we use it to send annotations to pupil capture
+        self.req.send_string("PUB_PORT")
+        self.pub_port = self.req.recv_string()
+        self.pub = self.context.socket(zmq.PUB)
+        self.pub.connect("tcp://{}:{}".format(self.ip, self.pub_port))
+
+        # sub: listen to other processes - currently listens to the calibration parameters from pupil capture
+        self.req.send_string("SUB_PORT")
+        self.sub_port = self.req.recv_string()
+        self.sub = self.context.socket(zmq.SUB)
+        self.sub.connect("tcp://{}:{}".format(self.ip, self.sub_port))
+        self.sub.setsockopt_string(zmq.SUBSCRIBE, 'logging')
+        print(f"{self.name}: ports established")
+
+    @trace.traced('command', cat='pupil')
+    def command(self, cmd:str):
+        """
+        Sends a Pupil Remote command (e.g. 'r', 'T 0.0') and returns the reply.
+        """
+        self.req.send_string(cmd)
+        return self.req.recv_string()
+
+    def close(self):
+        for sock in (self.req, self.pub, self.sub):
+            if sock is not None:
+                sock.close()
+        if self.context is not None:
+            self.context.destroy()
+
+
+class DeviceRegistry:
+    """
+    All Pupil Capture instances of the session, created from config (PUPIL_DEVICES). The first device is the master.
+
+    Requests on REQ sockets (notifications, Pupil Remote commands) are dispatched to all devices at once from a
+    thread pool with one worker per device; every device's sockets are used by one thread at a time.
+    Annotations are serialized once and enqueued on all PUB sockets back to back, which takes microseconds per
+    device. The local spread of every fan-out is recorded: enqueue spread of annotations (first to last
+    send_multipart) and completion spread of requests (first to last reply). Both are measured on this PC only and
+    say nothing about the marker skew on the devices - see AnnotationDelivery and RecordingController for that.
+    """
+    def __init__(self, device_configs:list):
+        if not device_configs:
+            raise ValueError("At least one Pupil Capture device has to be configured.")
+        self.devices = [PupilDevice(cfg['name'], cfg['ip'], cfg['port'], is_master=(i == 0))
+                        for i, cfg in enumerate(device_configs)]
+        self._pool = ThreadPoolExecutor(max_workers=len(self.devices), thread_name_prefix='pupil')
+        self.dispatch_log = []  # (kind, label, n devices, local spread [s])
+        self.delivery = None  # AnnotationDelivery confirming annotations, None = fire and forget
+
+    @property
+    def master(self):
+        return self.devices[0]
+
+    @property
+    def slaves(self):
+        return self.devices[1:]
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def __len__(self):
+        return len(self.devices)
+
+    def fan_out(self, func, label:str=None):
+        """
+        Calls func(device) for all devices at once and waits for all of them.
+
+        Args:
+            func (callable): Function taking a PupilDevice.
+            label (str): Name recorded in the dispatch log, None = not recorded.
+
+        Returns:
+            (list): Results of func, in device order.
+        """
+        t0 = time.perf_counter()
+
+        def timed(device):
+            result = func(device)
+            return result, time.perf_counter() - t0
+
+        futures = [self._pool.submit(timed, device) for device in self.devices]
+        results, done_at = zip(*(future.result() for future in futures))
+        if label is not None:
+            self.dispatch_log.append(('request', label, len(self.devices), max(done_at) - min(done_at)))
+        return list(results)
+
+    def connect(self):
+        self.fan_out(PupilDevice.connect)
+
+    @trace.traced(cat='pupil')
+    def notify_all(self, notification:dict):
+        """
+        Sends a notification to all devices at once.
+
+        Returns:
+            (list): Replies of each device.
+        """
+        return self.fan_out(lambda device: notify(device.req, notification), label=notification['subject'])
+
+    @trace.traced(cat='pupil')
+    def command_all(self, cmd:str):
+        """
+        Sends a Pupil Remote command to all devices at once.
+
+        Returns:
+            (list): Replies of each device.
+        """
+        return self.fan_out(lambda device: device.command(cmd), label=cmd)
+
+    @trace.traced(cat='pupil')
+    def send_annotation(self, label:str):
+        """
+        Sends annotation to all devices, timestamped with the Master Pupil Capture clock.
+
+        Args:
+            label (str): Annotation label.
+        """
+        pupil_time = float(self.master.command('t'))
+        trigger = {
+            "topic": "annotation",
+            "label": label,
+            "timestamp": pupil_time,
+            "duration": 0.0,
+        }
+        topic = trigger["topic"].encode()
+        payload = serializer.dumps(trigger, use_bin_type=True)
+
+        sent_at = []
+        for device in self.devices:
+            device.pub.send_multipart((topic, payload))
+            sent_at.append(time.perf_counter())
+        self.dispatch_log.append(('annotation', label, len(self.devices), sent_at[-1] - sent_at[0]))
+        if self.delivery is not None:
+            self.delivery.track(trigger, dict(zip((device.name for device in self.devices), sent_at)))
+
+    def dispatch_report(self):
+        """
+        Prints mean and worst local spread (last device vs. first device) of annotation enqueues and request
+        replies.
+        """
+        print(f"Local dispatch spread across {len(self.devices)} devices:")
+        for kind, metric in (('annotation', 'enqueue spread'), ('request', 'completion spread')):
+            spreads = [spread for k, _, _, spread in self.dispatch_log if k == kind]
+            if spreads:
+                print(f"  {kind}s ({metric}): n={len(spreads)}, mean={1000 * sum(spreads) / len(spreads):.3f} ms, "
+                      f"max={1000 * max(spreads):.3f} ms")
+
+    def close(self):
+        self._pool.shutdown()
+        for device in self.devices:
+            device.close()
+
+class RecordingController:
+    """
+    Starts and stops recording on all devices together and measures how far apart the recordings actually began
+    and ended, in master Pupil time.
+
+    Notifications are serialized before dispatch (pre-armed) and the device threads are released together by a
+    barrier, so no device waits for another one's round trip. Every device is then confirmed through its own
+    'recording.started' / 'recording.stopped' notification, received on SUB sockets of the controller.
+    Start times come from 'start_time_synced' of the notification, stop times from the notification arrival,
+    mapped to the device clock. Device clocks are related to the master clock by a 't' query right before
+    each dispatch.
+
+    Args:
+        pupil (DeviceRegistry): Connected Pupil Capture devices.
+        timeout (float): Time to wait for the confirmation of all devices [s].
+    """
+    def __init__(self, pupil:DeviceRegistry, timeout:float=RECORDING_CONFIRM_TIMEOUT):
+        self.pupil = pupil
+        self.timeout = timeout
+        self.log = []  # one entry per start / stop, see _confirm
+        self._subs = {}
+        for device in pupil:
+            sub = device.context.socket(zmq.SUB)
+            sub.connect("tcp://{}:{}".format(device.ip, device.sub_port))
+            sub.setsockopt_string(zmq.SUBSCRIBE, 'notify.recording.')
+            self._subs[device.name] = sub
+
+    def _read_clock(self, device:PupilDevice):
+        """
+        Returns:
+            (tuple): Local time.perf_counter() at the middle of a 't' round trip and the device Pupil time.
+        """
+        t_send = time.perf_counter()
+        pupil_time = float(device.command('t'))
+        return (t_send + time.perf_counter()) / 2, pupil_time
+
+    def _drain(self):
+        for sub in self._subs.values():
+            while sub.poll(0):
+                sub.recv_multipart()
+
+    def _dispatch(self, notification:dict):
+        """
+        Sends the pre-serialized notification to all devices at once.
+
+        Returns:
+            (list): Local send time of every device.
+        """
+        topic = "notify." + notification["subject"]
+        payload = serializer.dumps(notification, use_bin_type=True)
+        barrier = threading.Barrier(len(self.pupil))
+
+        def send(device):
+            barrier.wait()
+            t_send = time.perf_counter()
+            device.req.send_string(topic, flags=zmq.SNDMORE)
+            device.req.send(payload)
+            device.req.recv_string()
+            return t_send
+
+        return self.pupil.fan_out(send, label=notification['subject'])
+
+    def _await(self, subject:str):
+        """
+        Waits for 'subject' notifications of all devices.
+
+        Returns:
+            (dict): Device name -> (local arrival time, notification).
+        """
+        poller = zmq.Poller()
+        for sub in self._subs.values():
+            poller.register(sub, zmq.POLLIN)
+        names = {sub: name for name, sub in self._subs.items()}
+        received = {}
+        deadline = time.perf_counter() + self.timeout
+        while len(received) < len(self._subs) and time.perf_counter() < deadline:
+            for sub, _ in poller.poll(timeout=max(1, int(1000 * (deadline - time.perf_counter())))):
+                topic, payload = sub.recv_multipart()[:2]
+                if topic.decode() == "notify." + subject and names[sub] not in received:
+                    received[names[sub]] = (time.perf_counter(), serializer.loads(payload, raw=False))
+        return received
+
+    def _confirm(self, block:str, action:str, notification:dict, subject:str):
+        """
+        Dispatches notification, waits for the confirmation of every device and logs the skew.
+        """
+        self._drain()
+        clocks = dict(zip((device.name for device in self.pupil), self.pupil.fan_out(self._read_clock)))
+        sent_at = self._dispatch(notification)
+        confirmed = self._await(subject)
+
+        master_local, master_time = clocks[self.pupil.master.name]
+        times = {}
+        for device in self.pupil:
+            if device.name not in confirmed:
+                print(f"WARNING: {device.name} did not confirm {subject} within {self.timeout} s")
+                continue
+            local, pupil_time = clocks[device.name]
+            offset = (pupil_time - (local - master_local)) - master_time  # device - master clock
+            arrival, msg = confirmed[device.name]
+            device_time = msg.get('start_time_synced', pupil_time + arrival - local)
+            times[device.name] = device_time - offset
+
+        entry = {
+            'block': block,
+            'action': action,
+            'times': times,
+            'confirmed': len(times) == len(self.pupil),
+            'skew': max(times.values()) - min(times.values()) if times else None,
+            'dispatch_skew': max(sent_at) - min(sent_at),
+        }
+        self.log.append(entry)
+        skew = f"{1000 * entry['skew']:.3f} ms" if entry['skew'] is not None else "n/a"
+        print(f"Recording {action} ({block}): {len(times)}/{len(self.pupil)} devices confirmed, "
+              f"skew {skew}, dispatch skew {1000 * entry['dispatch_skew']:.3f} ms")
+        return entry
+
+    @trace.traced('recording_start', cat='pupil')
+    def start(self, session_name:str, block:str):
+        """
+        Starts recording on all devices.
+
+        Args:
+            session_name (str): Pupil Capture session name.
+            block (str): Block label used in the log, e.g. 'movies'.
+
+        Returns:
+            (dict): Log entry - block, action, confirmed start time of each device (master Pupil time),
+                whether all devices confirmed, start skew and dispatch skew [s].
+        """
+        return self._confirm(block, 'start', {'subject': 'recording.should_start', 'session_name': session_name},
+                             'recording.started')
+
+    @trace.traced('recording_stop', cat='pupil')
+    def stop(self, block:str):
+        """
+        Stops recording on all devices.
+
+        Returns:
+            (dict): Log entry, as in start.
+        """
+        return self._confirm(block, 'stop', {'subject': 'recording.should_stop'}, 'recording.stopped')
+
+    def close(self):
+        for sub in self._subs.values():
+            sub.close()
+
+class AnnotationDelivery:
+    """
+    Confirms that every annotation reached every Pupil Capture instance, and retransmits the ones that did not.
+
+    Pupil Capture republishes whatever arrives on its PUB port to its SUB port subscribers - the recorder among
+    them - so an annotation is confirmed by its echo on a SUB socket of this class, matched by label and timestamp.
+    Annotations not echoed within retransmit_after are sent again on PUB sockets of this class, with the same
+    label and timestamp and a 'retransmission' count, until the deadline (duplicates in a recording can be dropped
+    by label and timestamp). Matching and retransmission run in a daemon thread, so send_annotation never waits.
+
+    Latency is the round trip from the (last) send to the echo; the one-way latency is taken as half of it, as the
+    device does not report when the annotation arrived.
+
+    Args:
+        pupil (DeviceRegistry): Connected Pupil Capture devices.
+        deadline (float): Time after the first send after which an annotation is reported lost [s].
+        retransmit_after (float): Time without echo after which an annotation is sent again [s].
+    """
+    def __init__(self, pupil:DeviceRegistry, deadline:float=ANNOTATION_DEADLINE,
+                 retransmit_after:float=ANNOTATION_RETRANSMIT_INTERVAL):
+        self.pupil = pupil
+        self.deadline = deadline
+        self.retransmit_after = retransmit_after
+        self.log = []  # (label, timestamp, device, delivered, round trip, retransmissions)
+        self._queue = queue.Queue()
+        self._subs, self._pubs = {}, {}
+        for device in pupil:
+            sub = device.context.socket(zmq.SUB)
+            sub.connect("tcp://{}:{}".format(device.ip, device.sub_port))
+            sub.setsockopt_string(zmq.SUBSCRIBE, 'annotation')
+            self._subs[device.name] = sub
+            pub = device.context.socket(zmq.PUB)
+            pub.connect("tcp://{}:{}".format(device.ip, device.pub_port))
+            self._pubs[device.name] = pub
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='annotation_delivery', daemon=True)
+        self._thread.start()
+
+    def track(self, trigger:dict, sent_at:dict):
+        """
+        Registers a sent annotation.
+
+        Args:
+            trigger (dict): Annotation as sent.
+            sent_at (dict): Device name -> local time.perf_counter() of the send.
+        """
+        self._queue.put((trigger, sent_at))
+
+    def _run(self):
+        poller = zmq.Poller()
+        for sub in self._subs.values():
+            poller.register(sub, zmq.POLLIN)
+        names = {sub: name for name, sub in self._subs.items()}
+        pending = {}  # (label, timestamp) -> [trigger, deadline, {device: [last send, retransmissions]}]
+        early = {}  # (label, timestamp, device) -> arrival of echoes received before their track() was read
+
+        while not (self._stop.is_set() and not pending and self._queue.empty()):
+            while not self._queue.empty():
+                trigger, sent_at = self._queue.get()
+                key = (trigger['label'], trigger['timestamp'])
+                pending[key] = [trigger, min(sent_at.values()) + self.deadline,
+                                {name: [t, 0] for name, t in sent_at.items()}]
+                for name, t_sent in sent_at.items():
+                    if key + (name,) in early:
+                        del pending[key][2][name]
+                        self.log.append((key[0], key[1], name, True, early.pop(key + (name,)) - t_sent, 0))
+
+            for sub, _ in poller.poll(timeout=10):
+                topic, payload = sub.recv_multipart()[:2]
+                t_recv = time.perf_counter()
+                msg = serializer.loads(payload, raw=False)
+                key, name = (msg.get('label'), msg.get('timestamp')), names[sub]
+                if key in pending and name in pending[key][2]:
+                    t_sent, n = pending[key][2].pop(name)
+                    self.log.append((key[0], key[1], name, True, t_recv - t_sent, n))
+                elif 'retransmission' not in msg:
+                    early[key + (name,)] = t_recv
+
+            now = time.perf_counter()
+            early = {key: t for key, t in early.items() if now - t < self.deadline}  # other senders' annotations
+            for key, (trigger, deadline, devices) in list(pending.items()):
+                for name, state in list(devices.items()):
+                    if now > deadline:
+                        del devices[name]
+                        self.log.append((key[0], key[1], name, False, None, state[1]))
+                        print(f"WARNING: annotation {key[0]} not confirmed by {name} within {self.deadline} s")
+                    elif now - state[0] > self.retransmit_after:
+                        state[1] += 1
+                        retransmission = dict(trigger, retransmission=state[1])
+                        self._pubs[name].send_multipart((b"annotation",
+                                                         serializer.dumps(retransmission, use_bin_type=True)))
+                        state[0] = time.perf_counter()
+                if not devices:
+                    del pending[key]
+
+    def report(self):
+        """
+        Returns:
+            (dict): Per device - annotations sent, delivered, delivered after retransmission and lost, and one-way
+                latency [s] (half round trip) - mean, 95th percentile and maximum; 'lost' lists lost labels.
+        """
+        summary = {}
+        for device in self.pupil:
+            entries = [entry for entry in self.log if entry[2] == device.name]
+            latency = np.array([entry[4] / 2 for entry in entries if entry[3]])
+            summary[device.name] = {
+                'sent': len(entries),
+                'delivered': int(sum(entry[3] for entry in entries)),
+                'retransmitted': int(sum(entry[3] and entry[5] > 0 for entry in entries)),
+                'lost': [entry[0] for entry in entries if not entry[3]],
+                'latency_mean': float(latency.mean()) if len(latency) else None,
+                'latency_p95': float(np.percentile(latency, 95)) if len(latency) else None,
+                'latency_max': float(latency.max()) if len(latency) else None,
+            }
+        return summary
+
+    def close(self, report_path:str=None):
+        """
+        Waits for the annotations in flight (at most the deadline), stops the thread and reports the delivery.
+
+        Args:
+            report_path (str): JSON report file with the summary and every annotation, None = not written.
+
+        Returns:
+            (dict): Delivery summary, see report.
+        """
+        self._stop.set()
+        self._thread.join(timeout=self.deadline + 1)
+        for sock in list(self._subs.values()) + list(self._pubs.values()):
+            sock.close()
+        summary = self.report()
+        for name, entry in summary.items():
+            latency = f"{1000 * entry['latency_mean']:.2f} ms mean, {1000 * entry['latency_max']:.2f} ms max" \
+                if entry['latency_mean'] is not None else "n/a"
+            print(f"Annotations {name}: {entry['delivered']}/{entry['sent']} delivered "
+                  f"({entry['retransmitted']} retransmitted, {len(entry['lost'])} lost), one-way latency {latency}")
+        if report_path is not None:
+            keys = ('label', 'timestamp', 'device', 'delivered', 'round_trip', 'retransmissions')
+            with open(report_path, 'w') as f:
+                json.dump({'summary': summary, 'annotations': [dict(zip(keys, entry)) for entry in self.log]},
+                          f, indent=2)
+        return summary
+
+def send_annotation(pupil:DeviceRegistry, label:str):
     """
-    Send annotation (string) to both slave and master pc via PUB sockets (Context.socket),
+    Send annotation (string) to all Pupil Capture instances via PUB sockets,
     including also Master Pupil Capture time based on Master clock.
 
     Args:
-        pub_master (Socket): PUB socket for Master PC PupilCapture instance.
-        pub_slave (Socket): PUB socket for Slave PC PupilCapture instance.
+        pupil (DeviceRegistry): Pupil Capture devices.
         label (str): Trigger label.
-        req_master (Socket): REQ socket for Master PC PupilCapture instance.
     """
-    req_master.send_string('t')
-    pupil_time = req_master.recv()
-    trigger = {
-        "topic": "annotation",
-        "label": label,
-        "timestamp": float(pupil_time),
-        "duration": 0.0,
-    }
-    send_trigger(pub_master, trigger)
-    send_trigger(pub_slave, trigger)
+    pupil.send_annotation(label)
@@ -0,0 +1,157 @@
+"""
+Probing and validation of configured stimulus clips, with a probe cache shared between launches.
+"""
+import json
+import os
+import subprocess
+import time
+
+from misc.video_handling import measure_loudness, load_manifest, write_json_atomic
+
+import m00_configuration_setup as config_setup
+
+from config import CALIB_ANI_1_PATH, CALIB_ANI_2_PATH, CALIB_ANI_3_PATH, MOVIE_1_PATH, MOVIE_2_PATH, MOVIE_3_PATH
+from config import ASSET_CACHE_PATH, CALIB_ANI_DURATION_RANGE, MOVIE_DURATION_RANGE
+from config import LOUDNORM_I, LOUDNESS_TOLERANCE
+
+CALIB_ANI_PATHS = [CALIB_ANI_1_PATH, CALIB_ANI_2_PATH, CALIB_ANI_3_PATH]
+MOVIE_PATHS = [MOVIE_1_PATH, MOVIE_2_PATH, MOVIE_3_PATH]
+
+_cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ASSET_CACHE_PATH)
+_cache = None
+
+
+def probe_media(path:str):
+    """
+    Reads stream parameters of a media file with ffprobe.
+
+    Args:
+        path (str): Media file.
+
+    Returns:
+        (dict): width, height, fps, codec, duration [s] and has_audio.
+    """
+    proc = subprocess.run(["ffprobe", "-v", "error", "-print_format", "json",
+                           "-show_entries", "stream=codec_type,codec_name,width,height,avg_frame_rate:format=duration",
+                           path],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip() or f"ffprobe exited with code {proc.returncode}")
+    info = json.loads(proc.stdout)
+    video = [s for s in info['streams'] if s.get('codec_type') == 'video']
+    if not video:
+        raise RuntimeError("no video stream")
+    num, den = video[0]['avg_frame_rate'].split('/')
+    return {
+        'width': int(video[0]['width']),
+        'height': int(video[0]['height']),
+        'fps': float(num) / float(den) if float(den) else 0.0,
+        'codec': video[0]['codec_name'],
+        'duration': float(info['format']['duration']),
+        'has_audio': any(s.get('codec_type') == 'audio' for s in info['streams']),
+    }
+
+def _load_cache():
+    global _cache
+    if _cache is None:
+        _cache = load_manifest(_cache_path)
+    return _cache
+
+def probe_asset(path:str, refresh:bool=False):
+    """
+    Probes a clip (stream parameters and integrated loudness), using the cached result if the file's size and
+    modification time did not change.
+
+    Args:
+        path (str): Clip path.
+        refresh (bool): Ignore the cached result.
+
+    Returns:
+        (dict): Probe result. 'error' is set instead of the stream parameters if the clip cannot be probed.
+    """
+    cache = _load_cache()
+    path = os.path.abspath(path)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {'path': path, 'error': 'file not found'}
+
+    entry = cache.get(path)
+    if not refresh and entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry
+
+    entry = {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    try:
+        entry.update(probe_media(path))
+        entry['loudness'] = measure_loudness(path)['input_i'] if entry['has_audio'] else None
+    except (OSError, RuntimeError, KeyError, ValueError) as e:
+        entry['error'] = str(e)
+    cache[path] = entry
+    os.makedirs(os.path.dirname(_cache_path), exist_ok=True)
+    write_json_atomic(_cache_path, cache)
+    return entry
+
+def get_duration(path:str):
+    """
+    Duration [s] of a configured clip, read from the probe cache instead of an opened decoder.
+
+    Args:
+        path (str): Clip path from config.py.
+
+    Returns:
+        (float): Clip duration [s].
+    """
+    entry = probe_asset(config_setup.get_stimulus_path(path))
+    if 'error' in entry:
+        raise RuntimeError(f"Cannot probe {path}: {entry['error']}")
+    return entry['duration']
+
+def _check(entry:dict, duration_range:tuple, needs_audio:bool):
+    """
+    Lists problems found in one probe result.
+    """
+    if 'error' in entry:
+        return [entry['error']]
+    problems = []
+    if not duration_range[0] <= entry['duration'] <= duration_range[1]:
+        problems.append(f"duration {entry['duration']:.1f} s outside {duration_range}")
+    if entry['fps'] <= 0:
+        problems.append("invalid frame rate")
+    if entry['width'] <= 0 or entry['height'] <= 0:
+        problems.append("invalid resolution")
+    if needs_audio and not entry['has_audio']:
+        problems.append("no audio stream")
+    if entry['loudness'] is not None and abs(entry['loudness'] - LOUDNORM_I) > LOUDNESS_TOLERANCE:
+        problems.append(f"loudness {entry['loudness']:.1f} LUFS, expected {LOUDNORM_I} LUFS "
+                        f"(run misc/video_handling.py)")
+    return problems
+
+def validate_assets(refresh:bool=False):
+    """
+    Probes every configured calibration animation and movie and stops the procedure before anything else starts
+    if one of them is missing, corrupt, of unexpected length or not loudness-normalized.
+
+    Args:
+        refresh (bool): Ignore the probe cache.
+
+    Returns:
+        (dict): Probe results keyed by configured path.
+    """
+    t = time.perf_counter()
+    results, problems = {}, []
+    for paths, duration_range, needs_audio in ((CALIB_ANI_PATHS, CALIB_ANI_DURATION_RANGE, False),
+                                               (MOVIE_PATHS, MOVIE_DURATION_RANGE, True)):
+        for path in paths:
+            entry = probe_asset(config_setup.get_stimulus_path(path), refresh=refresh)
+            results[path] = entry
+            problems += [f"{path}: {problem}" for problem in _check(entry, duration_range, needs_audio)]
+
+    for entry in results.values():
+        if 'error' not in entry:
+            audio = f"{entry['loudness']:.1f} LUFS" if entry['loudness'] is not None else 'none'
+            print(f"{os.path.basename(entry['path'])}: {entry['duration']:.1f} s, {entry['fps']:.2f} fps, "
+                  f"{entry['width']}x{entry['height']}, {entry['codec']}, audio: {audio}")
+    print(f"Assets validated in {time.perf_counter() - t:.3f} s")
+    if problems:
+        raise ValueError("Stimulus validation failed:\n" + "\n".join(problems))
+    return results
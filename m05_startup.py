@@ -0,0 +1,151 @@
+"""
+Procedure startup: the session dialog first, then the independent setup steps run concurrently.
+Every step is timed, and a startup timeline is printed once the procedure is ready for the first User prompt.
+
+Dependencies:
+    screen check, asset probing, background imports -> start at launch (asset probing and GL-free imports in threads)
+    session dialog + asset probing -> paradigm compilation -> logs, windows (a bad paradigm fails here)
+    session dialog -> logs
+    session dialog -> Pupil comms handshake (thread)
+    session dialog -> operator console (separate process)
+    session dialog -> windows -> ioHub -> input service (operator keys of the console)
+The subject window (GL context), ioHub and every import of pyglet stay on the main thread.
+"""
+import ast
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import m00_configuration_setup as config_setup
+import m01_procedure_setup as procedure_setup
+import m04_asset_validation as assets
+import m07_tracing as trace
+import m08_operator_console as operator_console
+import m12_paradigm as paradigm
+import m14_input_service as inputs
+
+
+class StartupTimeline:
+    """
+    Collects start and end of startup phases, relative to the procedure launch.
+    """
+    def __init__(self, t_launch:float=None):
+        self.t_launch = time.perf_counter() if t_launch is None else t_launch
+        self.phases = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name:str):
+        """
+        Times the enclosed block as phase 'name'.
+        """
+        start = time.perf_counter()
+        try:
+            with trace.span(name, 'startup'):
+                yield
+        finally:
+            self._add(name, start, time.perf_counter())
+
+    def timed(self, name:str, func, *args, **kwargs):
+        """
+        Runs func(*args, **kwargs) as phase 'name' - used to time tasks submitted to the thread pool.
+        """
+        with self.phase(name):
+            return func(*args, **kwargs)
+
+    def _add(self, name:str, start:float, end:float):
+        with self._lock:
+            self.phases.append((name, start - self.t_launch, end - self.t_launch, threading.current_thread().name))
+
+    def report(self, width:int=40):
+        """
+        Prints the phases ordered by their start, with a bar chart of their span.
+
+        Returns:
+            (float): Time from launch to the end of the last phase [s].
+        """
+        total = max((end for _, _, end, _ in self.phases), default=0.0)
+        scale = width / total if total else 0
+        print("Startup timeline [s]:")
+        for name, start, end, thread in sorted(self.phases, key=lambda p: p[1]):
+            bar = ' ' * int(start * scale) + '#' * max(int((end - start) * scale), 1)
+            print(f"  {name:<26}{start:>7.2f}{end:>7.2f}{end - start:>7.2f}  {thread:<12}|{bar:<{width}}|")
+        print(f"Launch to first prompt: {total:.2f} s")
+        return total
+
+def _prefetch_imports():
+    """
+    Imports heavy PsychoPy modules free of GL while the User fills in the session dialog. psychopy.visual, the
+    keyboard and ioHub pull in pyglet.window, which creates its shadow GL window and context on the importing
+    thread - they are imported on the main thread by setup_windows and setup_iohub.
+    """
+    import psychopy.data
+
+def bootstrap(timeline:StartupTimeline):
+    """
+    Runs the startup sequence.
+
+    Args:
+        timeline (StartupTimeline): Timeline started at launch.
+
+    Returns:
+        (dict): Session objects - expInfo, thisExp, logFile, filename, ses_pupil_file, bckgnd_clr, win_main,
+            gigabyte_mon, console (OperatorConsole), ioServer, defaultKeyboard, ioSession,
+            input_service (InputService), pupil (comms.DeviceRegistry), asset_info and plan (compiled paradigm).
+    """
+    import pyglet
+
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix='startup') as pool:
+        imports_task = pool.submit(timeline.timed, 'imports (background)', _prefetch_imports)
+        assets_task = pool.submit(timeline.timed, 'asset probing', assets.validate_assets)
+
+        # Check whether screen IDs are assigned correctly.
+        with timeline.phase('screen check'):
+            config_setup.check_screens_id(pyglet.canvas.get_display().get_screens())
+
+        with timeline.phase('session dialog'):
+            expInfo = procedure_setup.show_session_dialog()
+
+        # Pupil comms do not depend on PsychoPy, the handshake runs while the paradigm is compiled and windows are
+        # created.
+        pupil_task = pool.submit(timeline.timed, 'pupil comms', procedure_setup.setup_pupil_comms)
+
+        # The operator console opens its window in its own process meanwhile.
+        bckgnd_clr = ast.literal_eval(expInfo['window background color'])  # Convert it to a list of RGB
+        console = operator_console.OperatorConsole(bckgnd_clr)
+        console.start()
+
+        # Paradigm compiled and validated before the logs, windows and ioHub - only this needs the asset probe.
+        with timeline.phase('paradigm'):
+            asset_info = assets_task.result()  # re-raises validation errors
+            plan = paradigm.compile_paradigm(paradigm.load_paradigm(), expInfo, asset_info)
+
+        with timeline.phase('logs'):
+            expInfo, thisExp, logFile, filename = procedure_setup.setup_path_log_psychopy(expInfo)
+            ses_pupil_file = config_setup.create_session_name(expInfo)
+
+        with timeline.phase('windows'):
+            win_main, gigabyte_mon = procedure_setup.setup_windows(background_clr=bckgnd_clr)
+
+        with timeline.phase('iohub'):
+            ioServer, defaultKeyboard, ioSession = procedure_setup.setup_iohub(win_main, expInfo)
+            # Operator keys are read system-wide from ioHub - the console window loses the focus to win_main.
+            input_service = inputs.InputService(ioServer)
+            input_service.start()
+            console.input = input_service
+
+        with timeline.phase('waiting for tasks'):
+            imports_task.result()
+            pupil = pupil_task.result()
+            console.wait_ready()
+
+    timeline.report()
+    return {
+        'expInfo': expInfo, 'thisExp': thisExp, 'logFile': logFile, 'filename': filename,
+        'ses_pupil_file': ses_pupil_file, 'bckgnd_clr': bckgnd_clr,
+        'win_main': win_main, 'gigabyte_mon': gigabyte_mon, 'console': console,
+        'ioServer': ioServer, 'defaultKeyboard': defaultKeyboard, 'ioSession': ioSession,
+        'input_service': input_service,
+        'pupil': pupil, 'asset_info': asset_info, 'plan': plan,
+    }
@@ -0,0 +1,167 @@
+"""
+Background monitoring of the master-slave Pupil clock offset during the session.
+
+Every CLOCK_PROBE_INTERVAL seconds each device is asked for its Pupil time CLOCK_SAMPLES_PER_PROBE times. As in NTP,
+only the query with the shortest round trip is kept, and the device clock is assumed to be read at the midpoint of
+the round trip. The difference of those estimates gives the slave - master offset. Offsets are written to a CSV
+timeline (usable for offline correction of slave timestamps, see correct_timestamps) and summarized at the end.
+"""
+import csv
+import threading
+import time
+
+import numpy as np
+import zmq
+
+from config import CLOCK_PROBE_INTERVAL, CLOCK_SAMPLES_PER_PROBE, CLOCK_QUERY_TIMEOUT, CLOCK_DRIFT_THRESHOLD
+
+
+class ClockMonitor:
+    """
+    Samples Pupil clocks of all devices in a daemon thread, on REQ sockets of its own.
+
+    Args:
+        pupil (comms.DeviceRegistry): Connected Pupil Capture devices.
+        csv_path (str): Offset timeline file.
+        interval (float): Time between probes [s].
+        n_samples (int): Queries per device and probe.
+        threshold (float): Largest accepted offset change over the session [s].
+    """
+    def __init__(self, pupil, csv_path:str, interval:float=CLOCK_PROBE_INTERVAL,
+                 n_samples:int=CLOCK_SAMPLES_PER_PROBE, threshold:float=CLOCK_DRIFT_THRESHOLD):
+        self.pupil = pupil
+        self.csv_path = csv_path
+        self.interval = interval
+        self.n_samples = n_samples
+        self.threshold = threshold
+        self.records = []  # (master time, device, offset, uncertainty)
+        self._sockets = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='clock_monitor', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        print(f"Clock monitor started, probing every {self.interval} s")
+
+    def _socket(self, device):
+        sock = self._sockets.get(device.name)
+        if sock is None:
+            sock = device.context.socket(zmq.REQ)
+            sock.setsockopt(zmq.RCVTIMEO, CLOCK_QUERY_TIMEOUT)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.connect("tcp://{}:{}".format(device.ip, device.port))
+            self._sockets[device.name] = sock
+        return sock
+
+    def _probe(self, device):
+        """
+        Best of n_samples clock readings of one device.
+
+        Returns:
+            (tuple|None): (local midpoint time, device Pupil time, round trip) of the fastest query,
+                None if the device did not answer.
+        """
+        best = None
+        for _ in range(self.n_samples):
+            sock = self._socket(device)
+            t_send = time.perf_counter()
+            sock.send_string('t')
+            try:
+                pupil_time = float(sock.recv_string())
+            except zmq.Again:
+                # REQ socket cannot send again without a reply - replace it
+                sock.close()
+                del self._sockets[device.name]
+                continue
+            t_recv = time.perf_counter()
+            if best is None or t_recv - t_send < best[2]:
+                best = ((t_send + t_recv) / 2, pupil_time, t_recv - t_send)
+        return best
+
+    def probe_once(self):
+        """
+        Probes all devices and records slave - master offsets.
+        """
+        readings = {device.name: self._probe(device) for device in self.pupil}
+        master = readings[self.pupil.master.name]
+        if master is None:
+            return
+        for device in self.pupil.slaves:
+            reading = readings[device.name]
+            if reading is None:
+                continue
+            # device clocks extrapolated to one local instant (the master reading)
+            offset = (reading[1] - (reading[0] - master[0])) - master[1]
+            uncertainty = (reading[2] + master[2]) / 2
+            self.records.append((master[1], device.name, offset, uncertainty))
+
+    def _run(self):
+        with open(self.csv_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['master_time', 'device', 'offset', 'uncertainty'])
+            while not self._stop.is_set():
+                n = len(self.records)
+                self.probe_once()
+                writer.writerows(self.records[n:])
+                f.flush()
+                self._stop.wait(self.interval)
+        for sock in self._sockets.values():
+            sock.close()
+
+    def stop(self):
+        """
+        Stops the sampler and summarizes offsets of each slave.
+
+        Returns:
+            (dict): Per device - number of probes, mean offset [s], drift [s/s] (slope of offset over master time)
+                and offset change over the session [s]; 'flagged' is True if the change exceeds the threshold.
+        """
+        self._stop.set()
+        self._thread.join()
+        summary = {}
+        for device in self.pupil.slaves:
+            rows = np.array([(t, o) for t, name, o, _ in self.records if name == device.name])
+            if len(rows) < 2:
+                continue
+            drift = np.polyfit(rows[:, 0], rows[:, 1], 1)[0]
+            change = abs(drift * (rows[-1, 0] - rows[0, 0]))
+            summary[device.name] = {
+                'probes': len(rows),
+                'mean_offset': float(rows[:, 1].mean()),
+                'drift': float(drift),
+                'change': float(change),
+                'flagged': bool(change > self.threshold),
+            }
+            print(f"Clock {device.name} - master: offset {1000 * rows[:, 1].mean():.3f} ms, "
+                  f"drift {1e6 * drift:.2f} ppm, change {1000 * change:.3f} ms over {len(rows)} probes")
+            if change > self.threshold:
+                print(f"WARNING: {device.name} clock drifted by {1000 * change:.3f} ms "
+                      f"(threshold {1000 * self.threshold:.1f} ms) - correct slave timestamps offline")
+        return summary
+
+def load_timeline(csv_path:str, device:str):
+    """
+    Reads the offset timeline of one slave device.
+
+    Returns:
+        master_time (np.ndarray): Master Pupil time of each probe.
+        offset (np.ndarray): Slave - master offset [s].
+    """
+    with open(csv_path, newline='') as f:
+        rows = [(float(r['master_time']), float(r['offset'])) for r in csv.DictReader(f) if r['device'] == device]
+    rows = np.array(rows).reshape(-1, 2)
+    return rows[:, 0], rows[:, 1]
+
+def correct_timestamps(t_slave:np.ndarray, master_time:np.ndarray, offset:np.ndarray):
+    """
+    Maps slave Pupil timestamps onto the master clock, interpolating the measured offset timeline.
+
+    Args:
+        t_slave (np.ndarray): Slave timestamps.
+        master_time (np.ndarray): Probe times (master clock), from load_timeline.
+        offset (np.ndarray): Slave - master offsets, from load_timeline.
+
+    Returns:
+        (np.ndarray): Timestamps on the master clock.
+    """
+    return t_slave - np.interp(t_slave, master_time + offset, offset)
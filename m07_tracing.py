@@ -0,0 +1,171 @@
+"""
+Session-wide tracing: spans and instant events stored in preallocated arrays, exported as Chrome trace JSON
+(open in chrome://tracing or ui.perfetto.dev).
+
+Tracing is off until enable() is called. When off, span() returns a shared no-op context manager and traced
+functions cost one global lookup, so the instrumentation stays in the code for production sessions.
+"""
+import atexit
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+import numpy as np
+
+from config import TRACE_CAPACITY
+
+_enabled = False
+_NULL_SPAN = nullcontext()
+_PHASE_SPAN, _PHASE_INSTANT = 0, 1
+
+_index = itertools.count()
+_start = np.zeros(0, dtype=np.int64)
+_duration = np.zeros(0, dtype=np.int64)
+_name_id = np.zeros(0, dtype=np.int32)
+_thread_id = np.zeros(0, dtype=np.int64)
+_phase = np.zeros(0, dtype=np.int8)
+_names = {}  # (name, category) -> id
+_names_lock = threading.Lock()
+_thread_names = {}
+_t0 = 0
+
+
+def enable(capacity:int=TRACE_CAPACITY):
+    """
+    Allocates the event buffer and starts recording. Events beyond capacity are dropped.
+
+    Args:
+        capacity (int): Maximal number of recorded events.
+    """
+    global _enabled, _index, _start, _duration, _name_id, _thread_id, _phase, _t0
+    _index = itertools.count()
+    _start = np.zeros(capacity, dtype=np.int64)
+    _duration = np.zeros(capacity, dtype=np.int64)
+    _name_id = np.zeros(capacity, dtype=np.int32)
+    _thread_id = np.zeros(capacity, dtype=np.int64)
+    _phase = np.zeros(capacity, dtype=np.int8)
+    _names.clear()
+    _thread_names.clear()
+    _t0 = time.perf_counter_ns()
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def _record(name:str, cat:str, start:int, duration:int, phase:int):
+    i = next(_index)  # atomic under the GIL, so threads never share a slot
+    if i >= len(_start):
+        return
+    key = (name, cat)
+    name_id = _names.get(key)
+    if name_id is None:
+        with _names_lock:
+            name_id = _names.setdefault(key, len(_names))
+    tid = threading.get_ident()
+    if tid not in _thread_names:
+        _thread_names[tid] = threading.current_thread().name
+    _start[i] = start - _t0
+    _duration[i] = duration
+    _name_id[i] = name_id
+    _thread_id[i] = tid
+    _phase[i] = phase
+
+
+class _Span:
+    __slots__ = ('name', 'cat', 'start')
+
+    def __init__(self, name:str, cat:str):
+        self.name = name
+        self.cat = cat
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        _record(self.name, self.cat, self.start, time.perf_counter_ns() - self.start, _PHASE_SPAN)
+        return False
+
+
+def span(name:str, cat:str='procedure'):
+    """
+    Context manager recording the enclosed block as a span.
+
+    Args:
+        name (str): Span name.
+        cat (str): Category, e.g. 'procedure', 'routine', 'frame', 'pupil', 'startup'.
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, cat)
+
+def instant(name:str, cat:str='procedure'):
+    """
+    Records an instant event, e.g. an operator key press.
+    """
+    if _enabled:
+        _record(name, cat, time.perf_counter_ns(), 0, _PHASE_INSTANT)
+
+def traced(name:str=None, cat:str='procedure'):
+    """
+    Decorator recording every call of the function as a span.
+
+    Args:
+        name (str): Span name, by default the function name.
+        cat (str): Category.
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Span(span_name, cat):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def export(path:str):
+    """
+    Writes recorded events as Chrome trace / Perfetto JSON.
+
+    Args:
+        path (str): Output file.
+
+    Returns:
+        (int): Number of exported events.
+    """
+    n = min(next(_index), len(_start))
+    names = {i: key for key, i in _names.items()}
+    tids = {tid: i for i, tid in enumerate(_thread_names)}
+    pid = os.getpid()
+
+    events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tids[tid], 'args': {'name': thread_name}}
+              for tid, thread_name in _thread_names.items()]
+    for start, duration, name_id, tid, phase in zip(_start[:n].tolist(), _duration[:n].tolist(),
+                                                    _name_id[:n].tolist(), _thread_id[:n].tolist(),
+                                                    _phase[:n].tolist()):
+        name, cat = names[name_id]
+        event = {'name': name, 'cat': cat, 'pid': pid, 'tid': tids[tid], 'ts': start / 1000}
+        if phase == _PHASE_SPAN:
+            event.update(ph='X', dur=duration / 1000)
+        else:
+            event.update(ph='i', s='t')
+        events.append(event)
+
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    print(f"Trace: {n} events exported to {path}")
+    return n
+
+def export_at_exit(path:str):
+    """
+    Exports the trace when the interpreter exits, including core.quit() on escape.
+    """
+    atexit.register(lambda: _enabled and export(path))
@@ -0,0 +1,198 @@
+"""
+Operator console: the Researcher window (prompts, countdowns, keyboard) runs in a separate process with its own
+GL context, so the stimulus process only ever flips win_main.
+
+The stimulus process starts the console as a subprocess ('python m08_operator_console.py <port> <background>')
+and talks to it over a ZMQ PAIR socket on localhost with msgpack-encoded requests. Every request gets exactly one
+reply, sent right away - the console never blocks the stimulus process. The console only displays: operator keys
+are read system-wide by the InputService (m14_input_service, ioHub) of the stimulus process, since the console
+window loses the OS focus to the fullscreen subject window and would not see them.
+"""
+import ast
+import atexit
+import os
+import subprocess
+import sys
+import time
+
+import msgpack as serializer
+import zmq
+
+import m07_tracing as trace
+
+from config import WIN_ID_MASTER
+
+
+class OperatorConsole:
+    """
+    Stimulus-process side of the operator console.
+
+    Args:
+        background_clr (tuple|list): RGB background color of the console window.
+    """
+    def __init__(self, background_clr:tuple|list=None):
+        self.background_clr = [-1.0, -1.0, -1.0] if background_clr is None else list(background_clr)
+        self.context = zmq.Context()
+        self.context.setsockopt(zmq.LINGER, 0)
+        self.socket = self.context.socket(zmq.PAIR)
+        self.port = self.socket.bind_to_random_port("tcp://127.0.0.1")
+        self.process = None
+        self.input = None  # InputService answering prompts and countdowns, attached once ioHub is running
+        self.key_log = []  # (key, ioHub time, prompt)
+
+    def start(self):
+        """
+        Launches the console process. Returns immediately; see wait_ready.
+        """
+        script = os.path.abspath(__file__)
+        self.process = subprocess.Popen([sys.executable, script, str(self.port), str(self.background_clr)],
+                                        cwd=os.path.dirname(script))
+        atexit.register(self._terminate)
+
+    def _terminate(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+
+    @trace.traced(cat='startup')
+    def wait_ready(self):
+        """
+        Blocks until the console window is open.
+        """
+        reply = self._recv()
+        if reply['type'] != 'ready':
+            raise RuntimeError(f"Unexpected message from operator console: {reply}")
+        print("Operator console ready")
+
+    def _recv(self):
+        while not self.socket.poll(500):
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Operator console exited with code {self.process.returncode}")
+        return serializer.loads(self.socket.recv(), raw=False)
+
+    def _request(self, request:dict):
+        self.socket.send(serializer.dumps(request, use_bin_type=True))
+        return self._recv()
+
+    def _input(self):
+        if self.input is None:
+            raise RuntimeError("Operator console has no InputService attached - operator keys cannot be read")
+        return self.input
+
+    def _handle_key(self, key:str, t:float, text:str):
+        self.key_log.append((key, t, text))
+        if key == 'escape':
+            from psychopy import core
+            core.quit()
+
+    @trace.traced(cat='operator')
+    def prompt(self, msg:str, keys:tuple=('x',)):
+        """
+        Shows msg in the console window and waits for one of keys.
+
+        Returns:
+            (str): Pressed key.
+        """
+        inputs = self._input()
+        print(msg)
+        self._request({'type': 'message', 'text': msg})
+        key, t = inputs.wait(keys, context=msg)
+        self._request({'type': 'message', 'text': ''})
+        self._handle_key(key, t, msg)
+        return key
+
+    @trace.traced(cat='operator')
+    def countdown(self, duration:float, text:str, keys:tuple=('escape', 'x')):
+        """
+        Runs a countdown in the console window. The console replies at once and animates the countdown on its own;
+        the keys are waited for here, from the input service. 'escape' quits the procedure.
+
+        Returns:
+            (None|str): Key which ended the countdown early, None if it ran out.
+        """
+        inputs = self._input()
+        self._request({'type': 'countdown', 'duration': duration, 'text': text})
+        found = inputs.wait(keys, timeout=duration, context=text)
+        if found is None:
+            return None
+        self._request({'type': 'message', 'text': ''})  # ends the countdown display
+        self._handle_key(*found, text)
+        return found[0]
+
+    def message(self, msg:str):
+        """
+        Shows msg in the console window without waiting for the User.
+        """
+        print(msg)
+        self._request({'type': 'message', 'text': msg})
+
+    def close(self):
+        if self.process is not None and self.process.poll() is None:
+            self._request({'type': 'close'})
+            self.process.wait(timeout=5)
+        self.socket.close()
+        self.context.destroy()
+
+
+def _run_console(port:int, background_clr:list):
+    """
+    Console process: Researcher window on the master screen, serving requests of the stimulus process.
+    """
+    from psychopy import visual, monitors
+
+    test_monitor = monitors.Monitor('testMonitor')
+    test_monitor.setWidth(30.0)
+    test_monitor.setSizePix([640, 480])
+    test_monitor.setDistance(50)
+
+    win = visual.Window(
+        size=[640, 480], fullscr=False, screen=WIN_ID_MASTER,
+        winType='pyglet', allowStencil=False,
+        monitor=test_monitor, color=background_clr, colorSpace='rgb',
+        blendMode='avg', useFBO=True,
+        units='norm', infoMsg='.')
+    text_stim = visual.TextStim(win, text='', color='white')
+    countdown_stim = visual.TextStim(win, text='', height=0.1, color='white', pos=(0, 0))
+
+    context = zmq.Context()
+    socket = context.socket(zmq.PAIR)
+    socket.connect(f"tcp://127.0.0.1:{port}")
+
+    def reply(msg:dict):
+        socket.send(serializer.dumps(msg, use_bin_type=True))
+
+    reply({'type': 'ready'})
+    while True:
+        if not socket.poll(50):
+            text_stim.draw()  # the shown text stays up until a message replaces it ('' clears it)
+            win.flip()  # keeps the window responsive while idle
+            continue
+        request = serializer.loads(socket.recv(), raw=False)
+
+        if request['type'] == 'countdown':
+            # the stimulus process waits for the keys and ends the countdown early with its next request
+            reply({'type': 'countdown'})
+            t_end = time.perf_counter() + request['duration']
+            while time.perf_counter() < t_end and not socket.poll(0):
+                countdown_stim.text = f"{request['text']}: {int(t_end - time.perf_counter())} s"
+                countdown_stim.draw()
+                win.flip()
+            text_stim.draw()
+            win.flip()
+
+        elif request['type'] == 'message':
+            text_stim.text = request['text']
+            text_stim.draw()
+            win.flip()
+            reply({'type': 'message'})
+
+        elif request['type'] == 'close':
+            reply({'type': 'closed'})
+            break
+
+    win.close()
+    socket.close()
+    context.term()
+
+
+if __name__ == '__main__':
+    _run_console(int(sys.argv[1]), ast.literal_eval(sys.argv[2]))
@@ -0,0 +1,155 @@
+"""
+Shared-memory ring of decoded movie frames, filled by a worker process (see m10_movie_player).
+
+Ring layout (one SharedMemory block):
+    header      int64[4]            consumed (next frame the worker may not overwrite), frame count at EOF
+                                    (-1 while decoding), stop flag, unused
+    slot_frame  int64[n_slots]      frame index held by each slot, -1 if empty
+    slot_ready  float64[n_slots]    time.perf_counter() at which the slot was filled
+    frames      uint8[n_slots, h, w, 3]
+
+Frame n is written to slot n % n_slots once frame n - n_slots has been consumed. The worker is started as a
+subprocess ('python m09_frame_ring.py ...'), like the operator console, and pipes raw RGB frames from ffmpeg
+straight into the ring.
+"""
+import atexit
+import os
+import subprocess
+import sys
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from config import MOVIE_RING_SLOTS
+
+_HEADER = 4
+_CONSUMED, _EOF, _STOP = 0, 1, 2
+
+
+def _ring_layout(n_slots:int, width:int, height:int):
+    """
+    Byte offsets of the ring parts.
+
+    Returns:
+        (tuple): slot_frame offset, slot_ready offset, frames offset, total size.
+    """
+    slot_frame = 8 * _HEADER
+    slot_ready = slot_frame + 8 * n_slots
+    frames = -(-(slot_ready + 8 * n_slots) // 64) * 64
+    return slot_frame, slot_ready, frames, frames + n_slots * width * height * 3
+
+def _ring_views(buf, n_slots:int, width:int, height:int):
+    """
+    Numpy views of the ring parts, shared by both processes (no copies).
+    """
+    slot_frame, slot_ready, frames, _ = _ring_layout(n_slots, width, height)
+    return (np.ndarray((_HEADER,), np.int64, buf, 0),
+            np.ndarray((n_slots,), np.int64, buf, slot_frame),
+            np.ndarray((n_slots,), np.float64, buf, slot_ready),
+            np.ndarray((n_slots, height, width, 3), np.uint8, buf, frames))
+
+
+class FrameRing:
+    """
+    Render-process side of the decoder: owns the shared-memory ring and the worker process.
+
+    Args:
+        path (str): Movie file.
+        width (int): Frame width [px].
+        height (int): Frame height [px].
+        n_slots (int): Number of frame buffers in the ring.
+    """
+    def __init__(self, path:str, width:int, height:int, n_slots:int=MOVIE_RING_SLOTS):
+        self.n_slots = n_slots
+        self.shm = shared_memory.SharedMemory(create=True, size=_ring_layout(n_slots, width, height)[3])
+        self.header, self.slot_frame, self.slot_ready, self.frames = _ring_views(self.shm.buf, n_slots, width, height)
+        self.header[:] = 0
+        self.header[_EOF] = -1
+        self.slot_frame[:] = -1
+
+        script = os.path.abspath(__file__)
+        self.process = subprocess.Popen([sys.executable, script, self.shm.name, path,
+                                         str(width), str(height), str(n_slots)],
+                                        cwd=os.path.dirname(script))
+        atexit.register(self.close)
+
+    def get(self, frame:int):
+        """
+        Returns:
+            (tuple|None): (frame view in the ring, perf_counter time it was decoded), None if not decoded yet.
+        """
+        slot = frame % self.n_slots
+        if self.slot_frame[slot] != frame:
+            return None
+        return self.frames[slot], self.slot_ready[slot]
+
+    def release(self, frame:int):
+        """
+        Lets the worker overwrite every frame before 'frame'.
+        """
+        self.header[_CONSUMED] = max(self.header[_CONSUMED], frame)
+
+    @property
+    def n_frames(self):
+        """
+        Number of frames of the movie, -1 until the worker reached the end of the stream.
+        """
+        return int(self.header[_EOF])
+
+    def close(self):
+        if self.shm is None:
+            return
+        self.header[_STOP] = 1
+        try:
+            self.process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        del self.header, self.slot_frame, self.slot_ready, self.frames  # views must go before the buffer
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+
+def _run_decoder(shm_name:str, path:str, width:int, height:int, n_slots:int):
+    """
+    Worker process: decodes the movie with ffmpeg and fills the ring, never overwriting an unconsumed frame.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    if os.name == 'posix':  # the render process owns (and unlinks) the block
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    header, slot_frame, slot_ready, frames = _ring_views(shm.buf, n_slots, width, height)
+
+    ffmpeg = subprocess.Popen(["ffmpeg", "-v", "error", "-i", path, "-an", "-f", "rawvideo", "-pix_fmt", "rgb24",
+                               "-s", f"{width}x{height}", "-"],
+                              stdout=subprocess.PIPE, bufsize=0)
+    n, view = 0, None
+    while not header[_STOP]:
+        if n - header[_CONSUMED] >= n_slots:
+            time.sleep(0.001)  # ring full
+            continue
+        view = memoryview(frames[n % n_slots]).cast('B')
+        filled = 0
+        while filled < len(view):
+            read = ffmpeg.stdout.readinto(view[filled:])
+            if not read:
+                break
+            filled += read
+        if filled < len(view):
+            header[_EOF] = n
+            break
+        slot_ready[n % n_slots] = time.perf_counter()
+        slot_frame[n % n_slots] = n  # published last, after the pixels
+        n += 1
+
+    ffmpeg.kill()
+    ffmpeg.wait()
+    while not header[_STOP]:  # keep the last frames readable until the player closes
+        time.sleep(0.01)
+    del header, slot_frame, slot_ready, frames, view
+    shm.close()
+
+
+if __name__ == '__main__':
+    _run_decoder(sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]))
@@ -0,0 +1,271 @@
+"""
+Movie stimulus backed by the shared-memory frame ring of m09_frame_ring: decoding runs in a worker process and
+the render loop only uploads the frame due at the next flip.
+
+SharedMemoryMovieStim overrides private parts of visual.MovieStim (texture buffers, playback state), whose names
+change between PsychoPy releases; it is opt-in (MOVIE_BACKEND = 'shared_memory') until checked on the lab's version.
+
+Drop/repeat policy: at every flip the newest decoded frame not later than the due frame is uploaded. Older decoded
+frames are dropped, and if none is decoded yet the previous frame stays on screen (counted as repeated).
+"""
+import ctypes
+import os
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+from psychopy import core, sound, visual
+from psychopy.constants import NOT_STARTED, PLAYING, PAUSED, STOPPED, FINISHED
+import pyglet.gl as GL
+
+import m04_asset_validation as assets
+import m07_tracing as trace
+from m09_frame_ring import FrameRing
+
+from config import MOVIE_BACKEND, MOVIE_RING_SLOTS
+
+
+def _extract_audio(path:str):
+    """
+    Extracts the audio track to a WAV file in the temp directory, reused while the movie file does not change.
+
+    Returns:
+        (str): WAV file.
+    """
+    stat = os.stat(path)
+    wav_path = os.path.join(tempfile.gettempdir(),
+                            f"{os.path.splitext(os.path.basename(path))[0]}_{stat.st_size}_{stat.st_mtime_ns}.wav")
+    if not os.path.isfile(wav_path):
+        subprocess.run(["ffmpeg", "-v", "error", "-y", "-i", path, "-vn", "-acodec", "pcm_s16le", "-ar", "48000",
+                        wav_path], check=True)
+    return wav_path
+
+
+class SharedMemoryMovieStim(visual.MovieStim):
+    """
+    visual.MovieStim decoded in a worker process into a shared-memory frame ring. Same constructor, autoDraw,
+    play(), pause() and stop() as visual.MovieStim; audio is extracted once and played with sound.Sound from the
+    first flip.
+
+    Args:
+        win (visual.Window): Window to draw on.
+        filename (str): Movie file.
+        n_slots (int): Frame buffers in the shared-memory ring.
+    """
+    def __init__(self, win, filename:str, n_slots:int=MOVIE_RING_SLOTS, **kwargs):
+        self._n_slots = n_slots
+        self._info = None
+        self._audio = None
+        super().__init__(win, filename, **kwargs)
+
+    def loadMovie(self, filename:str):
+        self._setFileName(filename)
+        self._info = assets.probe_asset(self._filename)
+        if 'error' in self._info:
+            raise RuntimeError(f"Cannot probe {self._filename}: {self._info['error']}")
+        self._player = FrameRing(self._filename, self._info['width'], self._info['height'], self._n_slots)
+        if self._info['has_audio'] and not self._noAudio:
+            self._audio = sound.Sound(_extract_audio(self._filename), volume=self._volume)
+
+        self._freeTextureBuffers()
+        self._setupTextureBuffers()
+        self.size = self._requestedSize
+
+        self._playbackStatus = NOT_STARTED
+        self._pts = 0.0
+        self._movieTime = 0.0
+        self._t_play = None
+        self._frame_shown = -1
+        self._dropped = 0
+        self._repeated = 0
+        self._lead = []  # decode lead time [s] of every uploaded frame
+        self._isLoaded = True
+
+    @property
+    def duration(self):
+        return self._info['duration'] if self._info else -1.0
+
+    @property
+    def frameRate(self):
+        return self._info['fps']
+
+    def getFPS(self):
+        return self._info['fps'] if self._info else 1.0
+
+    @property
+    def frameSize(self):
+        return (self._info['width'], self._info['height']) if self._info else (0, 0)
+
+    @property
+    def frameIndex(self):
+        return self._frame_shown
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self._volume = value
+        if getattr(self, '_audio', None) is not None:
+            self._audio.setVolume(value)
+
+    def play(self, log=True):
+        if self._playbackStatus == PLAYING or not self._hasPlayer:
+            return
+        # movie time 0 (or the paused movie time on resume) is the next flip; the audio starts on that flip too
+        self._t_play = self.win.getFutureFlipTime(clock=None) - self._movieTime
+        if self._audio is not None:
+            self.win.callOnFlip(self._audio.play)
+        self._playbackStatus = PLAYING
+
+    def pause(self, log=True):
+        """
+        Freezes movie time and the audio; the shown frame stays on screen. The worker fills the ring and then waits,
+        as no slot is released. play() resumes from the paused movie time.
+        """
+        if self._playbackStatus != PLAYING:
+            return
+        if self._audio is not None:
+            self._audio.pause()
+        self._playbackStatus = PAUSED
+
+    def updateVideoFrame(self):
+        """
+        Picks the frame due at the next flip according to the drop/repeat policy.
+
+        Returns:
+            (bool): True if a new frame has to be uploaded.
+        """
+        if self._playbackStatus != PLAYING:
+            return False  # paused, finished or not started - the shown frame stays on screen
+        t_flip = self.win.getFutureFlipTime(clock=None)
+        self._movieTime = min(t_flip - self._t_play, self.duration)
+        due = int(self._movieTime * self.frameRate + 1e-6)
+        n_frames = self._player.n_frames
+        if n_frames >= 0:
+            if due >= n_frames:
+                self._playbackStatus = FINISHED
+            due = min(due, n_frames - 1)
+        if due <= self._frame_shown:
+            return False  # frame still on screen (refresh rate above movie frame rate)
+
+        for frame in range(due, self._frame_shown, -1):
+            decoded = self._player.get(frame)
+            if decoded is not None:
+                break
+        else:
+            self._repeated += 1
+            trace.instant('movie_repeat', 'movie')
+            return False
+        if frame < due:
+            trace.instant('movie_late', 'movie')
+        self._dropped += frame - self._frame_shown - 1
+        self._recentFrame, t_ready = decoded
+        # lead: how long before its flip the frame was ready
+        self._lead.append(time.perf_counter() + (t_flip - core.getTime()) - t_ready)
+        self._frame_shown = frame
+        self._pts = frame / self.frameRate
+        return True
+
+    def _setupTextureBuffers(self):
+        width, height = self.frameSize
+        GL.glGenBuffers(1, ctypes.byref(self._pixbuffId))
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, self._pixbuffId)
+        GL.glBufferData(GL.GL_PIXEL_UNPACK_BUFFER, width * height * 3, None, GL.GL_STREAM_DRAW)
+        GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+
+        GL.glEnable(GL.GL_TEXTURE_2D)
+        GL.glGenTextures(1, ctypes.byref(self._textureId))
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self._textureId)
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGB8, width, height, 0, GL.GL_RGB, GL.GL_UNSIGNED_BYTE, None)
+        tex_filter = GL.GL_LINEAR if self.interpolate else GL.GL_NEAREST
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, tex_filter)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, tex_filter)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+        GL.glDisable(GL.GL_TEXTURE_2D)
+        GL.glFlush()
+        self._texFilterNeedsUpdate = False
+
+    def _pixelTransfer(self):
+        """
+        Copies the picked frame from the ring to the GPU, then hands its slot back to the worker.
+        """
+        width, height = self.frameSize
+        with trace.span('frame_upload', 'movie'):
+            GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, self._pixbuffId)
+            GL.glBufferData(GL.GL_PIXEL_UNPACK_BUFFER, width * height * 3, None, GL.GL_STREAM_DRAW)
+            buffer_ptr = GL.glMapBuffer(GL.GL_PIXEL_UNPACK_BUFFER, GL.GL_WRITE_ONLY)
+            ctypes.memmove(buffer_ptr, self._recentFrame.ctypes.data, width * height * 3)
+            GL.glUnmapBuffer(GL.GL_PIXEL_UNPACK_BUFFER)
+            self._player.release(self._frame_shown + 1)
+
+            GL.glEnable(GL.GL_TEXTURE_2D)
+            GL.glActiveTexture(GL.GL_TEXTURE0)
+            GL.glBindTexture(GL.GL_TEXTURE_2D, self._textureId)
+            GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, 0, 0, width, height, GL.GL_RGB, GL.GL_UNSIGNED_BYTE, 0)
+            GL.glBindBuffer(GL.GL_PIXEL_UNPACK_BUFFER, 0)
+            GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+            GL.glDisable(GL.GL_TEXTURE_2D)
+        self._recentFrame = None  # the slot may be overwritten from now on
+
+    def playback_stats(self):
+        """
+        Returns:
+            (dict): Shown, dropped and repeated (late) frames, and decode lead time [s] of uploaded frames -
+                mean, minimum and 5th percentile.
+        """
+        lead = np.array(self._lead) if self._lead else np.zeros(1)
+        return {
+            'shown': len(self._lead),
+            'dropped': self._dropped,
+            'repeated': self._repeated,
+            'lead_mean': float(lead.mean()),
+            'lead_min': float(lead.min()),
+            'lead_p5': float(np.percentile(lead, 5)),
+        }
+
+    def stop(self, log=True):
+        """
+        Stops playback, releases the worker and the ring and prints playback statistics.
+        """
+        if not self._hasPlayer:
+            return
+        if self._audio is not None:
+            self._audio.stop()
+        stats = self.playback_stats()
+        print(f"{os.path.basename(self._filename)}: {stats['shown']} frames shown, {stats['dropped']} dropped, "
+              f"{stats['repeated']} repeated; decode lead mean {1000 * stats['lead_mean']:.1f} ms, "
+              f"min {1000 * stats['lead_min']:.1f} ms")
+        self._player.close()
+        self._player = None
+        self._isLoaded = False
+        self._playbackStatus = STOPPED
+
+    def unload(self, log=True):
+        if self._hasPlayer:
+            self._player.close()
+            self._player = None
+        self._freeTextureBuffers()
+        self._isLoaded = False
+
+
+def create_movie(win, filename:str, **kwargs):
+    """
+    Creates the movie stimulus of the configured backend (MOVIE_BACKEND): 'shared_memory' for
+    SharedMemoryMovieStim, 'psychopy' for visual.MovieStim.
+
+    Args:
+        win (visual.Window): Window to draw on.
+        filename (str): Movie file.
+        **kwargs: Further visual.MovieStim arguments, e.g. size.
+
+    Returns:
+        (visual.MovieStim): Movie stimulus.
+    """
+    if MOVIE_BACKEND == 'shared_memory':
+        return SharedMemoryMovieStim(win, filename, **kwargs)
+    return visual.MovieStim(win, filename, **kwargs)
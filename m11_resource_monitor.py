@@ -0,0 +1,240 @@
+"""
+Background sampling of process resources (RSS, Python heap, threads, open file and socket handles), attributed to
+procedure stages and routines.
+
+Stages are marked from main.py with mark_stage(); routines are attributed through the @attributed decorator.
+Open files and sockets are expensive to list (psutil open_files / net_connections, on Windows especially), so they
+are sampled at stage and routine boundaries and by the sampler thread only while no routine is running - never
+during playback, where the listing could itself cause the frame hiccups the monitor attributes.
+When a stage ends - i.e. when the next one is marked, after the previous stage cleaned up its windows and movies -
+garbage is collected and the resources left behind are compared with the stage start. Stages leaving more than
+RESOURCE_RSS_BUDGET / RESOURCE_HANDLE_BUDGET behind are flagged, with the top allocators of the stage when
+tracemalloc is on (RESOURCE_TRACEMALLOC).
+"""
+import csv
+import functools
+import gc
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import psutil
+
+from config import RESOURCE_SAMPLE_INTERVAL, RESOURCE_RSS_BUDGET, RESOURCE_HANDLE_BUDGET, RESOURCE_TRACEMALLOC
+
+_active = None  # running ResourceMonitor, used by @attributed
+_MB = 1024 * 1024
+
+
+def attributed(func):
+    """
+    Decorator attributing resource samples taken during the call to the routine (function name).
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _active is None:
+            return func(*args, **kwargs)
+        monitor = _active
+        with monitor._routine_lock:  # waits for a handle listing of the sampler thread to finish
+            monitor.record(handles=True)
+            previous, monitor.routine = monitor.routine, func.__name__
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with monitor._routine_lock:
+                monitor.routine = previous
+                monitor.record(handles=True)
+    return wrapper
+
+
+class ResourceMonitor:
+    """
+    Samples resources of the procedure process in a daemon thread and keeps per-stage accounting.
+
+    Args:
+        csv_path (str): Sample timeline file.
+        interval (float): Time between samples [s].
+        rss_budget (float): Largest accepted RSS growth of a stage after cleanup [MB].
+        handle_budget (int): Largest accepted growth of open files + sockets of a stage after cleanup.
+        heap_tracing (bool): Trace Python allocations with tracemalloc (adds allocation overhead).
+    """
+    def __init__(self, csv_path:str, interval:float=RESOURCE_SAMPLE_INTERVAL, rss_budget:float=RESOURCE_RSS_BUDGET,
+                 handle_budget:int=RESOURCE_HANDLE_BUDGET, heap_tracing:bool=RESOURCE_TRACEMALLOC):
+        self.csv_path = csv_path
+        self.interval = interval
+        self.rss_budget = rss_budget
+        self.handle_budget = handle_budget
+        self.heap_tracing = heap_tracing
+        self.stage = 'setup'
+        self.routine = None
+        # (time, stage, routine, rss, heap, threads, files, sockets) - files and sockets None if not listed
+        self.records = []
+        self.stages = []
+        self._stage_start = None
+        self._stage_snapshot = None
+        self._lock = threading.Lock()
+        self._routine_lock = threading.RLock()  # routine entry/exit vs. handle listing of the sampler thread
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='resource_monitor', daemon=True)
+
+    def sample(self, handles:bool=True):
+        """
+        Args:
+            handles (bool): List open files and sockets (expensive).
+
+        Returns:
+            (dict): rss [MB], heap [MB] (None without tracemalloc), threads, open files and sockets (None if not
+                listed).
+        """
+        process = psutil.Process()  # one per call - oneshot caches are not shared between threads
+        with process.oneshot():
+            rss = process.memory_info().rss / _MB
+            threads = process.num_threads()
+            files = len(process.open_files()) if handles else None
+            sockets = len(process.net_connections(kind='all')) if handles else None
+        heap = tracemalloc.get_traced_memory()[0] / _MB if tracemalloc.is_tracing() else None
+        return {'rss': rss, 'heap': heap, 'threads': threads, 'files': files, 'sockets': sockets}
+
+    def start(self):
+        global _active
+        if self.heap_tracing:
+            tracemalloc.start()
+        _active = self
+        self._begin_stage(self.stage)
+        self._thread.start()
+        print(f"Resource monitor started, sampling every {self.interval} s")
+
+    def record(self, handles:bool=True):
+        """
+        Takes a sample attributed to the running stage and routine; written to the CSV by the sampler thread.
+        """
+        s = self.sample(handles)
+        with self._lock:
+            self.records.append((time.perf_counter(), self.stage, self.routine, s['rss'], s['heap'], s['threads'],
+                                 s['files'], s['sockets']))
+
+    def _run(self):
+        written = 0
+        with open(self.csv_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['time', 'stage', 'routine', 'rss_mb', 'heap_mb', 'threads', 'files', 'sockets'])
+            while not self._stop.is_set():
+                # handles listed only with no routine running; a routine starting meanwhile waits for the listing
+                with self._routine_lock:
+                    idle = self.routine is None
+                    if idle:
+                        self.record(handles=True)
+                if not idle:
+                    self.record(handles=False)
+                with self._lock:
+                    new, written = self.records[written:], len(self.records)
+                writer.writerows(new)
+                f.flush()
+                self._stop.wait(self.interval)
+            with self._lock:
+                writer.writerows(self.records[written:])  # boundary samples taken since the last write
+
+    def _begin_stage(self, name:str):
+        self.stage = name
+        self._stage_start = (time.perf_counter(), self.sample())
+        self._stage_snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+
+    def _end_stage(self):
+        """
+        Collects garbage and compares the resources with the stage start.
+
+        Returns:
+            (dict): Stage accounting.
+        """
+        gc.collect()
+        t_start, start = self._stage_start
+        end = self.sample()
+        with self._lock:
+            peak = max((r[3] for r in self.records if r[0] >= t_start and r[1] == self.stage), default=end['rss'])
+        left = {key: end[key] - start[key] for key in ('rss', 'threads', 'files', 'sockets')}
+        entry = {
+            'stage': self.stage,
+            'duration': time.perf_counter() - t_start,
+            'rss_start': start['rss'], 'rss_end': end['rss'], 'rss_peak': max(peak, end['rss']),
+            'left': left,
+            'flagged': left['rss'] > self.rss_budget or left['files'] + left['sockets'] > self.handle_budget,
+            'top_allocators': [],
+        }
+        if self._stage_snapshot is not None:
+            stats = tracemalloc.take_snapshot().compare_to(self._stage_snapshot, 'lineno')
+            entry['top_allocators'] = [(str(stat.traceback), stat.size_diff / _MB)
+                                       for stat in stats if stat.size_diff > 0][:10]
+
+        print(f"Stage {self.stage}: RSS {start['rss']:.0f} -> {end['rss']:.0f} MB (peak {entry['rss_peak']:.0f} MB), "
+              f"left behind {left['rss']:+.1f} MB, {left['threads']:+d} threads, {left['files']:+d} files, "
+              f"{left['sockets']:+d} sockets")
+        if entry['flagged']:
+            print(f"WARNING: stage {self.stage} exceeded its budget ({self.rss_budget} MB, "
+                  f"{self.handle_budget} handles) after cleanup")
+            for where, size in entry['top_allocators']:
+                print(f"  {size:+.2f} MB  {where}")
+        self.stages.append(entry)
+        return entry
+
+    def mark_stage(self, name:str):
+        """
+        Ends the running stage (see _end_stage) and attributes further samples to stage 'name'.
+        """
+        self._end_stage()
+        self._begin_stage(name)
+
+    def heap_top(self, n:int=10):
+        """
+        Top Python allocators right now (on demand, requires tracemalloc).
+
+        Returns:
+            (list): (source line, allocated MB) pairs.
+        """
+        if not tracemalloc.is_tracing():
+            return []
+        stats = tracemalloc.take_snapshot().statistics('lineno')[:n]
+        return [(str(stat.traceback), stat.size / _MB) for stat in stats]
+
+    def routine_peaks(self):
+        """
+        Returns:
+            (dict): Peak RSS [MB] and sample count of every routine.
+        """
+        peaks = {}
+        with self._lock:
+            for _, _, routine, rss, *_ in self.records:
+                if routine is not None:
+                    peak, n = peaks.get(routine, (0.0, 0))
+                    peaks[routine] = (max(peak, rss), n + 1)
+        return {routine: {'rss_peak': peak, 'samples': n} for routine, (peak, n) in peaks.items()}
+
+    def stop(self, report_path:str=None):
+        """
+        Ends the last stage, stops the sampler and writes the resource report.
+
+        Args:
+            report_path (str): JSON report file, None = not written.
+
+        Returns:
+            (dict): Report - per-stage accounting, routine peaks and flagged stages.
+        """
+        global _active
+        self._end_stage()
+        self._stop.set()
+        self._thread.join()
+        _active = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+        report = {
+            'stages': self.stages,
+            'routines': self.routine_peaks(),
+            'flagged': [entry['stage'] for entry in self.stages if entry['flagged']],
+        }
+        if report_path is not None:
+            with open(report_path, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"Resource report written to {os.path.basename(report_path)}")
+        return report
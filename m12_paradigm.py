@@ -0,0 +1,404 @@
+"""
+Paradigm compiler and runner.
+
+The session structure is defined in PARADIGM_PATH (paradigm.json): stages made of steps. Before anything is shown,
+compile_paradigm() resolves config names, randomizes the movie order, expands per-device steps and checks the
+paradigm (known step types, assets probed, a window open for every drawing step, photodiode set up before marked
+stimuli, recordings started and stopped in pairs, unique photodiode codes). The result is an execution plan with
+the expected duration, the assets of each stage, a preload schedule and the annotation/photodiode code table.
+run_plan() then executes the plan step by step.
+
+Preloading: a clip is created after the window it is drawn on was opened, and at most PARADIGM_PRELOAD_RESIDENT
+clips are resident at once; each clip is released right after its step. Preloads run between steps, so their cost
+is hidden behind operator prompts and fixation crosses instead of delaying the stimulus onset.
+
+Usage (offline check of the paradigm and its assets):
+    python m12_paradigm.py [--start-stage 2] [--debug]
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+import config
+import m00_configuration_setup as config_setup
+import m04_asset_validation as assets
+import m07_tracing as trace
+
+from config import PARADIGM_PATH, PARADIGM_PRELOAD_RESIDENT, PARADIGM_OPERATOR_ESTIMATE, PARADIGM_CALIBRATION_ESTIMATE
+from config import WIFI_SOURCE, PUPIL_DEVICES, WIN_ID_MAIN, WIN_SIZES, DEBUG_TIME, PHOTODIODE_POS
+from config import MOVIE_BACKEND, MOVIE_RING_SLOTS, SUBJECT_REFRESH_RATE
+
+ASSET_STEPS = ('animation', 'movie')
+WINDOW_STEPS = ('animation', 'photodiode', 'movie', 'fixation', 'free_convo')
+MARKED_STEPS = ('movie', 'free_convo')  # need the photodiode markers
+MOVIE_PHOTO_TOGGLE_TIME = 0.5  # m02_psychopy_routines.run_stimulus_routine
+CONVO_PHOTO_TOGGLES = 4  # m02_psychopy_routines.run_free_convo_routine, before and after the conversation
+CONVO_PHOTO_TOGGLE_TIME = 1.0
+
+
+def load_paradigm(path:str=PARADIGM_PATH):
+    """
+    Reads the paradigm definition.
+
+    Args:
+        path (str): Paradigm file, relative to the repository root.
+
+    Returns:
+        (dict): Paradigm definition.
+    """
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    with open(path) as f:
+        return json.load(f)
+
+def _config_value(name, problems:list, where:str):
+    """
+    Resolves a config.py name (numbers are passed through).
+    """
+    if not isinstance(name, str):
+        return name
+    if not hasattr(config, name):
+        problems.append(f"{where}: unknown config name {name}")
+        return None
+    return getattr(config, name)
+
+def _clip_duration(path:str, asset_info:dict, debug_mode:bool, problems:list, where:str):
+    """
+    Duration [s] of a clip and the memory [MB] it holds while resident.
+    """
+    entry = asset_info.get(path) or assets.probe_asset(config_setup.get_stimulus_path(path))
+    if 'error' in entry:
+        problems.append(f"{where}: {path}: {entry['error']}")
+        return 0.0, 0.0
+    frame = entry['width'] * entry['height'] * 3
+    n_frames = MOVIE_RING_SLOTS + 1 if MOVIE_BACKEND == 'shared_memory' else 2  # buffers + texture
+    return (DEBUG_TIME if debug_mode else entry['duration']), n_frames * frame / 2 ** 20
+
+def compile_paradigm(paradigm:dict, expInfo:dict, asset_info:dict=None, rng=np.random):
+    """
+    Compiles the paradigm into an execution plan and validates it.
+
+    Args:
+        paradigm (dict): Paradigm definition, see load_paradigm.
+        expInfo (dict): Session information from the dialog - start stage, debug mode and free conversation timing.
+        asset_info (dict): Probe results keyed by configured path (from validate_assets), probed if missing.
+        rng: Random generator used for randomized movie orders (np.random by default, as before).
+
+    Returns:
+        (dict): Plan - steps, mov_order, stage_assets, preload schedule, code table, expected duration [s]
+            of timed steps, number and estimated duration of operator-dependent steps and peak clip memory [MB].
+    """
+    asset_info = asset_info or {}
+    start_stage = int(expInfo['start at stage'][0])
+    debug_mode = expInfo['debug mode'] == 'True'
+    devices = PUPIL_DEVICES[WIFI_SOURCE]
+    problems, steps, mov_order = [], [], []
+
+    for stage in paradigm['stages']:
+        if stage['number'] < start_stage:
+            continue
+        for n, spec in enumerate(stage['steps']):
+            where = f"stage {stage['number']} ({stage['name']}) step {n + 1} ({spec.get('type')})"
+            base = {'stage': stage['name'], 'stage_number': stage['number'], 'type': spec.get('type'),
+                    'duration': 0.0, 'where': where}
+            kind = spec.get('type')
+
+            if kind == 'interrupt':
+                steps.append({**base, 'text': spec['text'], 'duration': None})
+            elif kind == 'window':
+                steps.append({**base, 'duration': float(spec.get('wait', 0))})
+            elif kind == 'animation':
+                path = _config_value(spec['asset'], problems, where)
+                duration, memory = _clip_duration(path, asset_info, debug_mode, problems, where) if path else (0, 0)
+                steps.append({**base, 'asset': path, 'annotation': spec['annotation'], 'duration': duration,
+                              'memory': memory, 'close_window': spec.get('close_window', False)})
+            elif kind == 'calibration':
+                targets = devices[1:] if spec['devices'] == 'slaves' else devices[:1]
+                for device in targets:
+                    steps.append({**base, 'device': device['name'], 'text': spec['text'].format(device=device['name']),
+                                  'duration': None})
+            elif kind in ('recording_start', 'recording_stop'):
+                steps.append({**base, 'block': spec['block']})
+            elif kind == 'photodiode':
+                steps.append({**base, 'show_cross': spec.get('show_cross', False)})
+            elif kind == 'movie_block':
+                names = list(spec['movies'])
+                order = [str(name) for name in rng.permutation(names)] if spec.get('order') == 'random' else names
+                mov_order += order
+                fixation = _config_value(spec.get('fixation', 0), problems, where)
+                for name in order:
+                    path = _config_value(spec['movies'][name], problems, where)
+                    duration, memory = _clip_duration(path, asset_info, debug_mode, problems, where) if path else (0, 0)
+                    movie_id = int(name[-1])
+                    steps.append({**base, 'type': 'movie', 'name': name, 'asset': path, 'duration': duration,
+                                  'memory': memory, 'photo_toggles': 2 * movie_id + 1})
+                    steps.append({**base, 'type': 'fixation', 'duration': float(fixation or 0)})
+            elif kind == 'free_convo':
+                countdown = int(expInfo['free conversation countdown'])
+                length = int(expInfo['free conversation length'])
+                steps.append({**base, 'name': spec['name'], 'countdown': countdown, 'length': length,
+                              'duration': countdown + length + 2 * CONVO_PHOTO_TOGGLES * CONVO_PHOTO_TOGGLE_TIME,
+                              'photo_toggles': CONVO_PHOTO_TOGGLES})
+            else:
+                problems.append(f"{where}: unknown step type")
+
+    # Window, photodiode and recording state along the plan
+    window, window_opened_at, n_windows, photodiode, recording = 0, 0, 0, False, None
+    for i, step in enumerate(steps):
+        if step['type'] == 'window':
+            n_windows += 1
+            window, window_opened_at, photodiode = n_windows, i + 1, False  # markers belong to the old window
+        elif step['type'] in WINDOW_STEPS and window is None:
+            problems.append(f"{step['where']}: no window is open")
+        step['window'] = window
+        if step['type'] == 'photodiode':
+            photodiode = True
+        elif step['type'] in MARKED_STEPS and not photodiode:
+            problems.append(f"{step['where']}: photodiode markers are not set up")
+        if step['type'] == 'recording_start':
+            if recording is not None:
+                problems.append(f"{step['where']}: recording {recording} is still running")
+            recording = step['block']
+        elif step['type'] == 'recording_stop':
+            if recording != step['block']:
+                problems.append(f"{step['where']}: recording {step['block']} was not started")
+            recording = None
+        step['window_opened_at'] = window_opened_at
+        if step['type'] == 'animation' and step['close_window']:
+            window = None
+    if recording is not None:
+        problems.append(f"recording {recording} is never stopped")
+
+    codes = [(step['stage'], step['name'], step['photo_toggles']) for step in steps if step['type'] == 'movie']
+    toggles = [t for _, _, t in codes]
+    if len(set(toggles)) != len(toggles):
+        problems.append(f"photodiode codes of movies are not unique: {codes}")
+    if problems:
+        raise ValueError("Paradigm compilation failed:\n" + "\n".join(problems))
+
+    preload, peak_memory = _schedule_preload(steps)
+    timed = [step['duration'] for step in steps if step['duration'] is not None]
+    operator = [step for step in steps if step['duration'] is None]
+    stage_assets = {}
+    for step in steps:
+        if step['type'] in ASSET_STEPS:
+            stage_assets.setdefault(step['stage'], []).append(step['asset'])
+    return {
+        'steps': steps,
+        'mov_order': mov_order,
+        'stage_assets': stage_assets,
+        'preload': preload,
+        'peak_memory': peak_memory,
+        'codes': _code_table(steps),
+        'duration': sum(timed),
+        'operator_steps': len(operator),
+        'operator_estimate': sum(PARADIGM_CALIBRATION_ESTIMATE if step['type'] == 'calibration'
+                                 else PARADIGM_OPERATOR_ESTIMATE for step in operator),
+    }
+
+def _schedule_preload(steps:list, resident:int=PARADIGM_PRELOAD_RESIDENT):
+    """
+    Earliest preload point of every clip: after its window was opened and after the clip 'resident' places
+    before it was released.
+
+    Returns:
+        preload (dict): Step index -> indices of clip steps to create before running it.
+        peak_memory (float): Largest memory of simultaneously resident clips [MB].
+    """
+    clip_steps = [i for i, step in enumerate(steps) if step['type'] in ASSET_STEPS]
+    preload, loaded_at = {}, {}
+    for n, i in enumerate(clip_steps):
+        at = steps[i]['window_opened_at']
+        if n >= resident:
+            at = max(at, clip_steps[n - resident] + 1)
+        loaded_at[i] = at
+        preload.setdefault(at, []).append(i)
+    peak_memory = max((sum(steps[j]['memory'] for j in clip_steps if loaded_at[j] <= i <= j)
+                       for i in range(len(steps))), default=0.0)
+    return preload, peak_memory
+
+def _code_table(steps:list):
+    """
+    Annotation labels and photodiode codes sent by every marked step.
+
+    Returns:
+        (list): (stage, annotations, photodiode toggles, toggle period [s]) per step.
+    """
+    table = []
+    for step in steps:
+        if step['type'] == 'animation':
+            table.append((step['stage'], [f"start_{step['annotation']}", f"stop_{step['annotation']}"], 0, None))
+        elif step['type'] == 'movie':
+            table.append((step['stage'], [f"start_{step['name']}", f"stop_{step['name']}"],
+                          step['photo_toggles'], MOVIE_PHOTO_TOGGLE_TIME))
+        elif step['type'] == 'free_convo':
+            table.append((step['stage'], ['start_countdown_free', 'start_free_convo', 'stop_free_convo'],
+                          step['photo_toggles'], CONVO_PHOTO_TOGGLE_TIME))
+    return table
+
+def _describe(step:dict):
+    for key in ('text', 'annotation', 'name', 'device', 'block'):
+        if key in step:
+            return str(step[key])
+    return ''
+
+def print_plan(plan:dict):
+    """
+    Prints the execution plan, preload schedule, code table and expected duration.
+    """
+    print("Execution plan:")
+    for i, step in enumerate(plan['steps']):
+        duration = f"{step['duration']:.1f}" if step['duration'] is not None else 'user'
+        loads = ' '.join(f"+{os.path.basename(plan['steps'][j]['asset'])}" for j in plan['preload'].get(i, []))
+        print(f"  {i:>3} {step['stage']:<12}{step['type']:<16}{duration:>7}  {_describe(step)[:48]:<50}{loads}")
+    print("Annotation / photodiode codes:")
+    for stage, labels, toggles, period in plan['codes']:
+        code = f"{toggles} toggles every {period} s" if toggles else "no photodiode code"
+        print(f"  {stage:<12}{', '.join(labels):<60}{code}")
+    print(f"Expected duration: {plan['duration'] / 60:.1f} min timed + {plan['operator_steps']} operator steps "
+          f"(~{plan['operator_estimate'] / 60:.1f} min); peak clip memory {plan['peak_memory']:.0f} MB")
+
+
+def _create_clip(step:dict, ctx:dict):
+    import m10_movie_player as player
+    with trace.span('MovieStim', 'movie'):
+        clip = player.create_movie(ctx['win_main'], config_setup.get_stimulus_path(step['asset']),
+                                   size=WIN_SIZES[WIN_ID_MAIN])
+    print(f"{os.path.basename(step['asset'])} initialized...")
+    return clip
+
+def _open_window(step:dict, ctx:dict):
+    from psychopy import visual, core
+    with trace.span('window', 'window'):
+        ctx['win_main'] = visual.Window(
+            size=WIN_SIZES[WIN_ID_MAIN], fullscr=True, screen=WIN_ID_MAIN,
+            winType='pyglet', allowStencil=False,
+            monitor=ctx['gigabyte_mon'], color=ctx['bckgnd_clr'], colorSpace='rgb',
+            blendMode='avg', useFBO=True,
+            units='height', infoMsg='.')
+        ctx['win_main'].flip()
+        if step['duration']:
+            core.wait(step['duration'])
+    print('New window created...')
+
+def _run_animation(step:dict, ctx:dict, clip):
+    import m02_psychopy_routines as routines
+    import m03_pupilcapture_comms as comms
+    routines.setup_routine_components([clip])  # Setup psychopy routine for calibration instruction
+    comms.send_annotation(ctx['pupil'], f"start_{step['annotation']}")
+    routines.run_routine(ctx['win_main'], [clip], ctx['routineTimer'], ctx['input_service'],
+                         msg=f"Running {step['annotation']}...", duration=step['duration'])
+    comms.send_annotation(ctx['pupil'], f"stop_{step['annotation']}")
+    if step['close_window']:
+        ctx['win_main'].close()  # Clean-up the Subject's window
+
+def _run_calibration(step:dict, ctx:dict):
+    import m02_psychopy_routines as routines
+    routines.interrupt(step['text'], ctx['console'])
+    if not ctx['debug_mode']:
+        device = next(device for device in ctx['pupil'] if device.name == step['device'])
+        ctx['expInfo'][f"calibration_{device.name}"] = routines.run_calibration(device.req, device.sub,
+                                                                               ctx['console'])
+
+def _setup_photodiode(step:dict, ctx:dict):
+    import m01_procedure_setup as procedure_setup
+    ctx['photo_rect_on'], ctx['photo_rect_off'], ctx['cross'] = procedure_setup.setup_photodiode(
+        ctx['win_main'], photo_pos=PHOTODIODE_POS)
+    if step['show_cross']:
+        ctx['cross'].draw()  # Draw focus cross before the first movie
+        ctx['win_main'].flip()
+
+def _run_movie(step:dict, ctx:dict, clip):
+    from psychopy import logging
+    import m02_psychopy_routines as routines
+    import m03_pupilcapture_comms as comms
+    import m13_frame_log as frame_log
+    routines.setup_routine_components([clip])
+    flips = frame_log.FrameLog(int(2 * SUBJECT_REFRESH_RATE * (step['duration'] + 1)), clip.frameRate,
+                               logging.defaultClock.getTime)  # win.flip() timestamps use the logging clock
+    flips.anchor(ctx['pupil'].master)
+    comms.send_annotation(ctx['pupil'], label=f"start_{step['name']}")
+    routines.run_stimulus_routine(ctx['win_main'], step['name'], clip, ctx['photo_rect_on'], ctx['photo_rect_off'],
+                                  ctx['routineTimer'], ctx['thisExp'], ctx['input_service'],
+                                  movie_duration=step['duration'], frame_log=flips)
+    flips.anchor(ctx['pupil'].master)
+    flips.save(f"{ctx['filename']}_{step['name']}_frames.npz")
+    if hasattr(clip, 'playback_stats'):
+        ctx['expInfo'][f"{step['name']}_playback"] = clip.playback_stats()  # dropped/repeated frames, decode lead
+    comms.send_annotation(ctx['pupil'], label=f"stop_{step['name']}")
+
+def _run_fixation(step:dict, ctx:dict):
+    import m02_psychopy_routines as routines
+    routines.setup_routine_components([ctx['cross']])
+    routines.run_routine(ctx['win_main'], [ctx['cross']], ctx['routineTimer'], ctx['input_service'],
+                         duration=step['duration'])
+
+def _run_free_convo(step:dict, ctx:dict):
+    import m02_psychopy_routines as routines
+    routines.run_free_convo_routine(ctx['win_main'], ctx['console'], ctx['photo_rect_on'], ctx['photo_rect_off'],
+                                    ctx['pupil'], step['countdown'], step['length'], ctx['routineTimer'])
+
+def run_plan(plan:dict, ctx:dict):
+    """
+    Executes the plan.
+
+    Args:
+        plan (dict): Compiled plan.
+        ctx (dict): Session objects - expInfo, thisExp, win_main, gigabyte_mon, bckgnd_clr, console, pupil,
+            recorder, resource_monitor, input_service, routineTimer, filename, ses_pupil_file and debug_mode.
+            Updated in place (win_main, photodiode markers, fixation cross).
+
+    Returns:
+        (dict): ctx.
+    """
+    import m02_psychopy_routines as routines
+    clips, stage = {}, None
+    for i, step in enumerate(plan['steps']):
+        if step['stage'] != stage:
+            stage = step['stage']
+            trace.instant(f"stage_{step['stage_number']}_{stage}")
+            ctx['resource_monitor'].mark_stage(stage)
+        for j in plan['preload'].get(i, []):
+            clips[j] = _create_clip(plan['steps'][j], ctx)
+
+        kind = step['type']
+        if kind == 'interrupt':
+            routines.interrupt(step['text'], ctx['console'])
+        elif kind == 'window':
+            _open_window(step, ctx)
+        elif kind == 'animation':
+            _run_animation(step, ctx, clips.pop(i))
+        elif kind == 'calibration':
+            _run_calibration(step, ctx)
+        elif kind == 'recording_start':
+            ctx['recorder'].start(ctx['ses_pupil_file'], step['block'])
+        elif kind == 'recording_stop':
+            ctx['recorder'].stop(step['block'])
+        elif kind == 'photodiode':
+            _setup_photodiode(step, ctx)
+        elif kind == 'movie':
+            _run_movie(step, ctx, clips.pop(i))
+        elif kind == 'fixation':
+            _run_fixation(step, ctx)
+        elif kind == 'free_convo':
+            _run_free_convo(step, ctx)
+    return ctx
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compiles the paradigm and prints the execution plan.")
+    parser.add_argument('--start-stage', type=int, default=2, choices=(2, 3, 4))
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+
+    expInfo = {'start at stage': str(args.start_stage), 'debug mode': str(args.debug),
+               'free conversation countdown': str(config.FREE_CONV_INTERVAL),
+               'free conversation length': str(config.FREE_CONV_DURATION)}
+    try:
+        print_plan(compile_paradigm(load_paradigm(), expInfo))
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
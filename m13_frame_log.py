@@ -0,0 +1,127 @@
+"""
+Per-flip movie frame log: which decoded movie frame was on screen from which flip on.
+
+run_stimulus_routine records the flip timestamp and the movie frame index of every flip in a preallocated array.
+Around the routine the master Pupil clock is read against the flip clock (anchors, best of CLOCK_SAMPLES_PER_PROBE
+round trips as in m06_clock_monitor), so flips can be mapped onto Pupil time offline. Each clip gets a binary
+sidecar '<session>_<movie>_frames.npz'; FrameLookup answers "which frame was visible at Pupil time t" for whole
+gaze arrays at once (binary search, O(log n) per sample).
+"""
+import numpy as np
+
+from config import CLOCK_SAMPLES_PER_PROBE
+
+FLIP_DTYPE = np.dtype([('flip', 'f8'), ('frame', 'i4')])
+
+
+class FrameLog:
+    """
+    Flip log of one movie routine.
+
+    Args:
+        capacity (int): Preallocated number of flips, grown if exceeded.
+        fps (float): Movie frame rate, used to derive frame presentation timestamps.
+        clock: Function returning the time of the clock used by win.flip() timestamps
+            (psychopy.logging.defaultClock.getTime).
+    """
+    def __init__(self, capacity:int, fps:float, clock):
+        self.flips = np.empty(capacity, dtype=FLIP_DTYPE)
+        self.n = 0
+        self.fps = fps
+        self.clock = clock
+        self.anchors = []  # (flip clock time, master Pupil time, round trip)
+
+    def record(self, t_flip:float, frame:int):
+        """
+        Records a flip; frame is the movie frame index on screen after it (-1 before the first frame).
+        """
+        if self.n == len(self.flips):
+            self.flips = np.resize(self.flips, 2 * len(self.flips))
+        self.flips[self.n] = (t_flip, frame)
+        self.n += 1
+
+    def anchor(self, device, n_samples:int=CLOCK_SAMPLES_PER_PROBE):
+        """
+        Reads the Pupil clock of device against the flip clock; the fastest round trip is kept and the Pupil clock
+        is assumed to be read at its midpoint.
+
+        Args:
+            device (comms.PupilDevice): Device whose clock the flips are mapped onto (the master).
+        """
+        best = None
+        for _ in range(n_samples):
+            t_send = self.clock()
+            pupil_time = float(device.command('t'))
+            t_recv = self.clock()
+            if best is None or t_recv - t_send < best[2]:
+                best = ((t_send + t_recv) / 2, pupil_time, t_recv - t_send)
+        self.anchors.append(best)
+
+    def save(self, path:str):
+        """
+        Writes the sidecar: flip times, frame indices, frame rate and clock anchors.
+        """
+        flips = self.flips[:self.n]
+        np.savez(path, flip=flips['flip'], frame=flips['frame'], fps=self.fps,
+                 anchors=np.array(self.anchors, dtype=float).reshape(-1, 3))
+
+
+def flips_to_pupil_time(t_flip:np.ndarray, anchors:np.ndarray):
+    """
+    Maps flip clock times onto Pupil time - linear fit through the anchors (offset and drift), offset only
+    with a single anchor.
+
+    Args:
+        t_flip (np.ndarray): Flip clock times.
+        anchors (np.ndarray): (flip clock time, Pupil time, round trip) rows.
+
+    Returns:
+        (np.ndarray): Pupil times.
+    """
+    if len(anchors) == 0:
+        raise ValueError("No clock anchors - flips cannot be mapped onto Pupil time")
+    if len(anchors) == 1:
+        return t_flip + (anchors[0, 1] - anchors[0, 0])
+    slope, intercept = np.polyfit(anchors[:, 0], anchors[:, 1], 1)
+    return slope * t_flip + intercept
+
+
+class FrameLookup:
+    """
+    Movie frame visible at given Pupil times, from a frame log sidecar.
+
+    A frame is visible from the flip it was first shown at until the next flip with a different frame. After the
+    last flip the screen is assumed unchanged for one more median flip interval.
+
+    Args:
+        path (str): Sidecar written by FrameLog.save.
+    """
+    def __init__(self, path:str):
+        with np.load(path) as data:
+            frame, t_flip, self.fps, anchors = data['frame'], data['flip'], float(data['fps']), data['anchors']
+        t_pupil = flips_to_pupil_time(t_flip, anchors)
+        # keep flips at which the visible frame changed
+        changed = np.ones(len(frame), dtype=bool)
+        changed[1:] = frame[1:] != frame[:-1]
+        self.onsets = t_pupil[changed]
+        self.frames = frame[changed]
+        interval = np.median(np.diff(t_pupil)) if len(t_pupil) > 1 else 0.0
+        self.end = t_pupil[-1] + interval if len(t_pupil) else -np.inf
+
+    def frame_at(self, t:np.ndarray):
+        """
+        Args:
+            t (np.ndarray): Pupil timestamps (any shape).
+
+        Returns:
+            frame (np.ndarray): Visible movie frame index, -1 outside of the movie.
+            pts (np.ndarray): Presentation timestamp of that frame in the movie [s], NaN outside of the movie.
+        """
+        t = np.asarray(t, dtype=float)
+        if len(self.onsets) == 0:
+            return np.full(t.shape, -1), np.full(t.shape, np.nan)
+        i = np.searchsorted(self.onsets, t, side='right') - 1
+        inside = (i >= 0) & (t < self.end)
+        frame = np.where(inside, self.frames[np.clip(i, 0, None)], -1)
+        pts = np.where(frame >= 0, frame / self.fps, np.nan)
+        return frame, pts
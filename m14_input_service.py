@@ -0,0 +1,117 @@
+"""
+Operator keyboard input on a thread of its own.
+
+The service thread reads key presses from ioHub (hardware timestamps, ioHub/PsychoPy clock) and appends them to a
+deque; deque append/popleft are atomic, so routines drain it without a lock and without a keyboard round trip to
+the ioHub process in every frame. ioHub sees the keyboard system-wide, so keys pressed while the operator console
+window has the focus arrive here too - prompts and countdowns of the console are answered from this queue.
+
+Every key consumed by a routine or prompt is an operator action, kept with its timestamp in 'actions' for the
+session log.
+"""
+import collections
+import threading
+import time
+
+import m07_tracing as trace
+
+from config import INPUT_POLL_INTERVAL
+
+
+class InputService:
+    """
+    Key presses of the ioHub keyboard, timestamped and queued by a daemon thread.
+
+    Args:
+        ioServer (ioHubConnection): ioHub server connection.
+        poll_interval (float): Time between ioHub reads of the service thread [s].
+    """
+    def __init__(self, ioServer, poll_interval:float=INPUT_POLL_INTERVAL):
+        self.keyboard = ioServer.getDevice('keyboard')
+        self.poll_interval = poll_interval
+        self.actions = []  # (key, ioHub time, context) of consumed keys
+        self._events = collections.deque()  # (key, ioHub time)
+        self._arrived = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='input_service', daemon=True)
+
+    def start(self):
+        self.keyboard.getPresses()  # keys pressed before the start are not operator actions
+        self._thread.start()
+        print(f"Input service started, reading ioHub every {1000 * self.poll_interval:.0f} ms")
+
+    def _run(self):
+        while not self._stop.is_set():
+            presses = self.keyboard.getPresses()
+            if presses:
+                self._events.extend((press.key, press.time) for press in presses)
+                self._arrived.set()
+            self._stop.wait(self.poll_interval)
+
+    def _consume(self, keys, context:str):
+        """
+        Pops the queued events; returns the first one in keys (None if there is none) and drops the rest.
+        """
+        found = None
+        while self._events:
+            key, t = self._events.popleft()
+            if found is None and key in keys:
+                found = (key, t)
+        if found is not None:
+            self.actions.append((found[0], found[1], context))
+            trace.instant(f"key_{found[0]}", 'operator')
+        return found
+
+    def drain(self, keys, context:str=None):
+        """
+        Non-blocking check for keys, e.g. once per frame.
+
+        Args:
+            keys (tuple|list): Keys of interest; other queued keys are discarded.
+            context (str): Description logged with the action.
+
+        Returns:
+            (tuple|None): (key, ioHub time) of the first key of interest, None if none was pressed.
+        """
+        if not self._events:
+            return None
+        return self._consume(keys, context)
+
+    def clear(self):
+        self._events.clear()
+        self._arrived.clear()
+
+    def wait(self, keys, timeout:float=None, context:str=None):
+        """
+        Waits for one of keys; keys pressed before the call are ignored.
+
+        Args:
+            keys (tuple|list): Accepted keys.
+            timeout (float): Longest wait [s], None = no limit.
+            context (str): Description logged with the action.
+
+        Returns:
+            (tuple|None): (key, ioHub time), None on timeout.
+        """
+        self.clear()
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.perf_counter()
+            if remaining is not None and remaining <= 0:
+                return None
+            if self._arrived.wait(remaining):
+                self._arrived.clear()
+                found = self._consume(keys, context)
+                if found is not None:
+                    return found
+
+    def stop(self):
+        """
+        Stops the service thread.
+
+        Returns:
+            (list): Operator actions - (key, ioHub time, context).
+        """
+        self._stop.set()
+        self._thread.join()
+        return self.actions
@@ -0,0 +1,345 @@
+"""
+Fixation, saccade and blink detection for the child (master) and caregiver (slave) recordings, per movie and
+free conversation block.
+
+Gaze direction is taken from gaze_point_3d of Pupil Player exports (gaze_positions.csv) as azimuth/elevation
+angles in the scene camera, so thresholds are in degrees and do not depend on a screen surface - the conversation
+blocks have none. Samples are classified with a velocity threshold (I-VT) or a dispersion threshold (I-DT);
+blinks are runs of low confidence, which override both.
+
+All steps work on whole arrays. Long recordings are classified in chunks of EVENT_CHUNK_SECONDS, each extended by
+EVENT_CHUNK_OVERLAP on both sides; only the labels of the chunk core are kept, so events crossing a chunk border
+are classified with full context (the overlap has to exceed the longest minimum-duration rule). Events are then
+extracted from the stitched labels of the whole block.
+
+Usage:
+    python misc/events.py detect --child <child export dir> --parent <parent export dir> --output events.csv
+        [--method ivt|idt] [--clock data/<session>_clock.csv]
+    python misc/events.py benchmark
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import WIFI_SOURCE, PUPIL_DEVICES
+from config import EVENT_VELOCITY_THRESHOLD, EVENT_DISPERSION_THRESHOLD, EVENT_MIN_FIXATION, EVENT_MIN_SACCADE
+from config import EVENT_BLINK_CONFIDENCE, EVENT_BLINK_DURATION, EVENT_CHUNK_SECONDS, EVENT_CHUNK_OVERLAP
+from misc.replay import load_annotations
+from m06_clock_monitor import load_timeline, correct_timestamps
+
+UNCLASSIFIED, FIXATION, SACCADE, BLINK = 0, 1, 2, 3
+EVENT_NAMES = {FIXATION: 'fixation', SACCADE: 'saccade', BLINK: 'blink'}
+EVENT_FIELDS = ['participant', 'block', 'event', 'start', 'stop', 'duration', 'azimuth', 'elevation', 'amplitude',
+                'peak_velocity']
+
+
+def load_gaze_angles(export_dir:str):
+    """
+    Reads gaze_positions.csv of a Pupil Player export as gaze angles.
+
+    Returns:
+        t (np.ndarray): Gaze timestamps (Pupil time), sorted.
+        azimuth (np.ndarray): Horizontal gaze angle [deg], NaN if missing.
+        elevation (np.ndarray): Vertical gaze angle [deg], up positive, NaN if missing.
+        confidence (np.ndarray): Gaze confidence.
+    """
+    def value(text:str):
+        return float(text) if text else np.nan
+
+    with open(os.path.join(export_dir, 'gaze_positions.csv'), newline='') as f:
+        rows = [(float(r['gaze_timestamp']), value(r['gaze_point_3d_x']), value(r['gaze_point_3d_y']),
+                 value(r['gaze_point_3d_z']), float(r['confidence'])) for r in csv.DictReader(f)]
+    t, x, y, z, confidence = (np.array(c) for c in zip(*rows))
+    order = np.argsort(t)
+    azimuth = np.degrees(np.arctan2(x, z))
+    elevation = np.degrees(np.arctan2(-y, z))  # camera y axis points down
+    return t[order], azimuth[order], elevation[order], confidence[order]
+
+def block_bounds(annotations:list):
+    """
+    Movie and free conversation blocks delimited by the master annotations.
+
+    Args:
+        annotations (list): (timestamp, label) pairs, see misc.replay.load_annotations.
+
+    Returns:
+        (dict): Block name ('m1', ..., 'free_convo_first', 'free_convo_second') -> (start, stop) in Pupil time.
+    """
+    starts, bounds = {}, {}
+    convo_names = iter(['first', 'second'])
+    for t, label in annotations:
+        if label.startswith('start_') and label != 'start_countdown_free':
+            starts[label[len('start_'):]] = t
+        elif label.startswith('stop_') and label[len('stop_'):] in starts:
+            name = label[len('stop_'):]
+            block = f"{name}_{next(convo_names)}" if name == 'free_convo' else name
+            bounds[block] = (starts.pop(name), t)
+    return {block: bound for block, bound in bounds.items() if not block.startswith('calib_anim')}
+
+def _runs(mask:np.ndarray):
+    """
+    Start (inclusive) and stop (exclusive) indices of the True runs of mask.
+    """
+    edges = np.diff(mask.astype(np.int8), prepend=0, append=0)
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+def _runs_to_mask(n:int, starts:np.ndarray, stops:np.ndarray):
+    """
+    Union of the [start, stop) index ranges as a boolean mask of length n (ranges may overlap).
+    """
+    delta = np.zeros(n + 1, dtype=np.int32)
+    np.add.at(delta, starts, 1)
+    np.add.at(delta, stops, -1)
+    return np.cumsum(delta[:n]) > 0
+
+def _keep_runs(mask:np.ndarray, t:np.ndarray, min_duration:float=0.0, max_duration:float=np.inf):
+    """
+    Keeps the True runs of mask lasting between min_duration and max_duration [s].
+    """
+    starts, stops = _runs(mask)
+    duration = t[stops - 1] - t[starts]
+    keep = (duration >= min_duration) & (duration <= max_duration)
+    return _runs_to_mask(len(mask), starts[keep], stops[keep])
+
+def _segment_reduce(ufunc, values:np.ndarray, starts:np.ndarray, stops:np.ndarray):
+    """
+    ufunc reduction (np.add, np.maximum) of values over every [start, stop) range.
+    """
+    values = np.append(values, 0)  # stops may point past the last sample
+    return ufunc.reduceat(values, np.column_stack([starts, stops]).ravel())[::2]
+
+def angular_speed(t:np.ndarray, azimuth:np.ndarray, elevation:np.ndarray):
+    """
+    Returns:
+        (np.ndarray): Gaze speed [deg/s], NaN next to missing samples.
+    """
+    return np.hypot(np.gradient(azimuth, t), np.gradient(elevation, t))
+
+def detect_blinks(t:np.ndarray, confidence:np.ndarray, threshold:float=EVENT_BLINK_CONFIDENCE,
+                  duration:tuple=EVENT_BLINK_DURATION):
+    """
+    Blinks: runs of confidence below threshold lasting within the duration range [s]. Longer runs are signal loss.
+
+    Returns:
+        (np.ndarray): Boolean blink mask.
+    """
+    return _keep_runs(confidence < threshold, t, *duration)
+
+def classify_ivt(t:np.ndarray, azimuth:np.ndarray, elevation:np.ndarray, threshold:float=EVENT_VELOCITY_THRESHOLD,
+                 min_fixation:float=EVENT_MIN_FIXATION, min_saccade:float=EVENT_MIN_SACCADE):
+    """
+    Velocity-threshold classification: runs faster than threshold [deg/s] lasting at least min_saccade [s] are
+    saccades (shorter ones are noise spikes), slower runs lasting at least min_fixation [s] are fixations.
+
+    Returns:
+        (np.ndarray): int8 sample labels.
+    """
+    speed = angular_speed(t, azimuth, elevation)
+    labels = np.zeros(len(t), dtype=np.int8)
+    labels[_keep_runs(speed > threshold, t, min_saccade)] = SACCADE
+    labels[_keep_runs(speed <= threshold, t, min_fixation)] = FIXATION
+    return labels
+
+def classify_idt(t:np.ndarray, azimuth:np.ndarray, elevation:np.ndarray,
+                 dispersion:float=EVENT_DISPERSION_THRESHOLD, min_fixation:float=EVENT_MIN_FIXATION):
+    """
+    Dispersion-threshold classification: every window of min_fixation [s] whose dispersion (horizontal + vertical
+    range [deg]) is below the threshold marks its samples as fixation; valid samples outside fixations are saccades.
+    The growing window of the sequential I-DT is replaced by the union of all qualifying windows.
+
+    Returns:
+        (np.ndarray): int8 sample labels.
+    """
+    labels = np.zeros(len(t), dtype=np.int8)
+    valid = ~(np.isnan(azimuth) | np.isnan(elevation))
+    n = max(int(round(min_fixation / np.median(np.diff(t)))) + 1, 2) if len(t) > 1 else 2
+    if len(t) < n:
+        return labels
+    az = sliding_window_view(np.where(valid, azimuth, 0.0), n)
+    el = sliding_window_view(np.where(valid, elevation, 0.0), n)
+    spread = np.ptp(az, axis=1) + np.ptp(el, axis=1)
+    complete = sliding_window_view(valid, n).all(axis=1)
+    span = t[n - 1:] - t[:len(t) - n + 1]  # windows across recording gaps are not fixations
+    starts = np.flatnonzero((spread <= dispersion) & complete & (span <= 2 * min_fixation))
+    labels[valid] = SACCADE
+    labels[_runs_to_mask(len(t), starts, starts + n)] = FIXATION
+    return labels
+
+CLASSIFIERS = {'ivt': classify_ivt, 'idt': classify_idt}
+
+def classify(t:np.ndarray, azimuth:np.ndarray, elevation:np.ndarray, confidence:np.ndarray, method:str='ivt'):
+    """
+    Sample labels of one stretch of gaze - I-VT or I-DT, blinks on top.
+    """
+    if len(t) < 2:
+        return np.zeros(len(t), dtype=np.int8)
+    labels = CLASSIFIERS[method](t, azimuth, elevation)
+    labels[detect_blinks(t, confidence)] = BLINK
+    return labels
+
+def classify_chunked(t:np.ndarray, azimuth:np.ndarray, elevation:np.ndarray, confidence:np.ndarray,
+                     method:str='ivt', chunk_seconds:float=EVENT_CHUNK_SECONDS, overlap:float=EVENT_CHUNK_OVERLAP):
+    """
+    classify() over overlapping chunks; every chunk contributes the labels of its core only.
+
+    Returns:
+        (np.ndarray): int8 sample labels.
+    """
+    labels = np.empty(len(t), dtype=np.int8)
+    if len(t) == 0:
+        return labels
+    core = np.searchsorted(t, np.arange(t[0], t[-1] + chunk_seconds, chunk_seconds))
+    core[-1] = len(t)
+    lo = np.searchsorted(t, t[0] + np.arange(len(core) - 1) * chunk_seconds - overlap)
+    hi = np.searchsorted(t, t[0] + np.arange(1, len(core)) * chunk_seconds + overlap)
+    for a, b, c, d in zip(core[:-1], core[1:], lo, hi):
+        if a == b:
+            continue
+        chunk = classify(t[c:d], azimuth[c:d], elevation[c:d], confidence[c:d], method)
+        labels[a:b] = chunk[a - c:b - c]
+    return labels
+
+def extract_events(t:np.ndarray, labels:np.ndarray, azimuth:np.ndarray, elevation:np.ndarray):
+    """
+    Events from sample labels.
+
+    Returns:
+        (dict): Event name -> dict of arrays: start, stop, duration [s], mean azimuth/elevation [deg],
+            amplitude [deg] (first to last sample) and peak velocity [deg/s].
+    """
+    speed = np.nan_to_num(angular_speed(t, azimuth, elevation))
+    events = {}
+    for code, name in EVENT_NAMES.items():
+        starts, stops = _runs(labels == code)
+        if len(starts) == 0:
+            events[name] = {key: np.empty(0) for key in EVENT_FIELDS[3:]}
+            continue
+        n = stops - starts
+        with np.errstate(invalid='ignore'):
+            events[name] = {
+                'start': t[starts],
+                'stop': t[stops - 1],
+                'duration': t[stops - 1] - t[starts],
+                'azimuth': _segment_reduce(np.add, azimuth, starts, stops) / n,
+                'elevation': _segment_reduce(np.add, elevation, starts, stops) / n,
+                'amplitude': np.hypot(azimuth[stops - 1] - azimuth[starts], elevation[stops - 1] - elevation[starts]),
+                'peak_velocity': _segment_reduce(np.maximum, speed, starts, stops),
+            }
+    return events
+
+def detect_block(gaze:tuple, t_start:float, t_stop:float, method:str='ivt'):
+    """
+    Events of one participant within one block.
+
+    Args:
+        gaze (tuple): Output of load_gaze_angles.
+        t_start (float): Block start in Pupil time.
+        t_stop (float): Block stop in Pupil time.
+        method (str): 'ivt' or 'idt'.
+
+    Returns:
+        (dict): See extract_events.
+    """
+    i0, i1 = np.searchsorted(gaze[0], [t_start, t_stop])
+    t, azimuth, elevation, confidence = (column[i0:i1] for column in gaze)
+    labels = classify_chunked(t, azimuth, elevation, confidence, method)
+    return extract_events(t, labels, azimuth, elevation)
+
+def detect_session(child_dir:str, parent_dir:str, clock_path:str=None, method:str='ivt'):
+    """
+    Events of both participants in every movie and free conversation block.
+
+    Args:
+        child_dir (str): Pupil Player export directory of the child (master) recording.
+        parent_dir (str): Pupil Player export directory of the caregiver (slave) recording.
+        clock_path (str): Session clock timeline (data/<session>_clock.csv), None = slave clock not corrected.
+        method (str): 'ivt' or 'idt'.
+
+    Returns:
+        (dict): Participant -> block -> events (see extract_events).
+    """
+    blocks = block_bounds(load_annotations(os.path.join(child_dir, 'annotations.csv')))
+    gaze = {'child': load_gaze_angles(child_dir), 'parent': load_gaze_angles(parent_dir)}
+    if clock_path is not None:
+        slave_name = PUPIL_DEVICES[WIFI_SOURCE][1]['name']
+        gaze['parent'] = (correct_timestamps(gaze['parent'][0], *load_timeline(clock_path, slave_name)),) \
+            + gaze['parent'][1:]
+    return {participant: {block: detect_block(g, *bounds, method=method) for block, bounds in blocks.items()}
+            for participant, g in gaze.items()}
+
+def write_events(results:dict, output_path:str):
+    """
+    Writes the events of detect_session as one CSV row per event.
+    """
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(EVENT_FIELDS)
+        for participant, blocks in results.items():
+            for block, events in blocks.items():
+                for name, columns in events.items():
+                    for row in zip(*(columns[key] for key in EVENT_FIELDS[3:])):
+                        writer.writerow([participant, block, name] + [f"{value:.6f}" for value in row])
+
+def synthetic_gaze(duration:float, fs:float=200.0, seed:int=0):
+    """
+    Synthetic gaze: fixations with jitter, saccades between them, blinks and tracking loss.
+
+    Returns:
+        (tuple): Same layout as load_gaze_angles.
+    """
+    rng = np.random.default_rng(seed)
+    n = int(duration * fs)
+    t = np.arange(n) / fs + rng.normal(0, 0.0005, n)
+    t.sort()
+    n_fix = int(duration / 0.3) + 1
+    targets = rng.uniform(-20, 20, (n_fix + 1, 2))
+    phase = np.arange(n) / fs / 0.3  # a fixation every 300 ms, the last 30 ms of it a saccade to the next one
+    k = phase.astype(int)
+    progress = np.clip((phase - k - 0.9) / 0.1, 0, 1)[:, None]
+    position = targets[k] + progress * (targets[k + 1] - targets[k]) + rng.normal(0, 0.05, (n, 2))
+    confidence = rng.uniform(0.8, 1.0, n)
+    for start in rng.integers(0, n - 100, int(duration / 4)):  # a blink every ~4 s
+        confidence[start:start + rng.integers(20, 60)] = 0.1
+    position[confidence < 0.3] = np.nan
+    return t, position[:, 0], position[:, 1], confidence
+
+def run_benchmark(duration:float=25 * 60, fs:float=200.0):
+    """
+    Times event detection of a full dyad session (both devices) with both methods.
+    """
+    gaze = [synthetic_gaze(duration, fs, seed) for seed in (0, 1)]
+    for method in CLASSIFIERS:
+        t0 = time.perf_counter()
+        counts = {name: 0 for name in EVENT_NAMES.values()}
+        for g in gaze:
+            events = detect_block(g, g[0][0], g[0][-1] + 1, method=method)
+            for name in counts:
+                counts[name] += len(events[name]['start'])
+        elapsed = time.perf_counter() - t0
+        print(f"{method}: {elapsed:.3f} s for 2 x {duration / 60:.0f} min at {fs:.0f} Hz "
+              f"({2 * len(gaze[0][0]) / elapsed / 1e6:.1f} M samples/s) - "
+              + ", ".join(f"{count} {name}s" for name, count in counts.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fixation, saccade and blink detection for both participants.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    detect_parser = subparsers.add_parser('detect')
+    detect_parser.add_argument('--child', required=True, help="Pupil Player export directory of the child recording")
+    detect_parser.add_argument('--parent', required=True, help="Pupil Player export directory of the caregiver recording")
+    detect_parser.add_argument('--output', required=True)
+    detect_parser.add_argument('--method', choices=sorted(CLASSIFIERS), default='ivt')
+    detect_parser.add_argument('--clock', default=None, help="session clock timeline (data/<session>_clock.csv)")
+    subparsers.add_parser('benchmark')
+    args = parser.parse_args()
+
+    if args.command == 'detect':
+        write_events(detect_session(args.child, args.parent, clock_path=args.clock, method=args.method), args.output)
+    else:
+        run_benchmark()
@@ -0,0 +1,368 @@
+"""
+Cohort gaze heatmaps of the movie clips, frame by frame, for children and caregivers.
+
+Every session contributes the surface-mapped gaze of both participants (Pupil Player exports, as in misc/replay.py)
+during each movie block. Gaze samples are mapped onto movie frames - with the per-flip frame log of the session
+(m13_frame_log) when it is given, from the 'start_<movie>' annotation and the clip frame rate otherwise - and
+counted in a downsampled grid of HEATMAP_BINS cells and HEATMAP_FRAME_BIN frames.
+
+The cohort is a store directory of generations: 'gen-<n>/' holds the count arrays ('<movie>_<participant>.npy')
+and manifest.json listing the sessions they include, and the 'current' file names the valid generation. Updating
+the store only processes new sessions: they are split among worker processes, each summing its sessions into one
+partial result, and the partial results are added to the current counts in a new generation. Counts and session
+list are committed together by replacing 'current', so an interrupted update leaves the previous generation in
+place and never counts a session twice.
+Smoothed, normalized heatmaps are exported from the counts as arrays or as a video over the clip.
+
+Usage:
+    python misc/heatmaps.py update --store data/heatmaps --sessions sessions.csv [--workers N] [--surface screen]
+    python misc/heatmaps.py export --store data/heatmaps m1 child|parent|both (--video out.mp4 | --array out.npy)
+
+sessions.csv columns: session, child, parent (Pupil Player export directories), clock (data/<session>_clock.csv)
+and frames (data/<session> prefix of the frame logs); clock and frames may be empty.
+"""
+import argparse
+import csv
+import json
+import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import WIFI_SOURCE, PUPIL_DEVICES, ASSET_WORKERS
+from config import HEATMAP_BINS, HEATMAP_FRAME_BIN, HEATMAP_SIGMA, HEATMAP_ALPHA, REPLAY_MIN_CONFIDENCE
+from misc.replay import MOVIE_PATHS, load_annotations, load_surface_gaze
+from m00_configuration_setup import get_stimulus_path
+from m04_asset_validation import probe_media
+from m06_clock_monitor import load_timeline, correct_timestamps
+from m13_frame_log import FrameLookup
+
+PARTICIPANTS = ('child', 'parent')
+MANIFEST_NAME = 'manifest.json'
+CURRENT_NAME = 'current'
+
+
+def read_sessions(path:str):
+    """
+    Reads the session list.
+
+    Returns:
+        (list): One dict per session - session, child, parent, clock and frames (None if empty).
+    """
+    with open(path, newline='') as f:
+        return [{key: (row.get(key) or None) for key in ('session', 'child', 'parent', 'clock', 'frames')}
+                for row in csv.DictReader(f)]
+
+def _grid_shape(movie_info:dict, bins:tuple, frame_bin:int):
+    return (-(-movie_info['n_frames'] // frame_bin), bins[1], bins[0])
+
+def gaze_frame_indices(t:np.ndarray, t_start:float, movie_info:dict, frames_path:str=None):
+    """
+    Frame of the cohort grid shown at each gaze timestamp, -1 outside of the clip.
+
+    With a frame log, the presentation timestamp of the frame on screen is taken from it - frame rate and length of
+    the clip actually played, which may differ from the file probed for the grid (e.g. a transcoded copy) - and
+    converted to a grid frame.
+
+    Args:
+        t (np.ndarray): Gaze timestamps (master Pupil time).
+        t_start (float): 'start_<movie>' annotation time.
+        movie_info (dict): n_frames and fps of the cohort grid.
+        frames_path (str): Frame log sidecar of the clip, None = frames derived from t_start and the frame rate.
+    """
+    if frames_path is not None and os.path.isfile(frames_path):
+        pts = FrameLookup(frames_path).frame_at(t)[1]
+        frame = np.floor(np.nan_to_num(pts, nan=-1.0) * movie_info['fps'] + 1e-6).astype(np.int64)
+    else:
+        frame = np.floor((t - t_start) * movie_info['fps']).astype(np.int64)
+    return np.where((frame >= 0) & (frame < movie_info['n_frames']), frame, -1)
+
+def accumulate(counts:np.ndarray, frame:np.ndarray, x:np.ndarray, y:np.ndarray, confidence:np.ndarray,
+               frame_bin:int, min_confidence:float=REPLAY_MIN_CONFIDENCE):
+    """
+    Adds gaze samples to a (time bins, rows, columns) count array in place.
+
+    Args:
+        frame (np.ndarray): Movie frame of each sample (-1 = outside of the clip, frames beyond the grid are
+            ignored too).
+        x (np.ndarray): Horizontal surface position, 0-1 from the left (NaN off the surface).
+        y (np.ndarray): Vertical surface position, 0-1 from the bottom.
+        confidence (np.ndarray): Gaze confidence.
+    """
+    n_t, ny, nx = counts.shape
+    with np.errstate(invalid='ignore'):
+        valid = ((frame >= 0) & (frame < n_t * frame_bin) & (confidence >= min_confidence)
+                 & (x >= 0) & (x < 1) & (y > 0) & (y <= 1))
+    column = (x[valid] * nx).astype(np.int64)
+    row = ((1 - y[valid]) * ny).astype(np.int64)  # row 0 at the top of the screen
+    flat = (frame[valid] // frame_bin) * (ny * nx) + row * nx + column
+    counts += np.bincount(flat, minlength=counts.size).reshape(counts.shape).astype(counts.dtype)
+
+def session_contribution(session:dict, movie_info:dict, bins:tuple, frame_bin:int, surface:str):
+    """
+    Count arrays of one session.
+
+    Returns:
+        (dict): (movie, participant) -> count array, only for movies found in the session annotations.
+    """
+    annotations = load_annotations(os.path.join(session['child'], 'annotations.csv'))
+    gaze_file = os.path.join('surfaces', f'gaze_positions_on_surface_{surface}.csv')
+    gaze = {'child': load_surface_gaze(os.path.join(session['child'], gaze_file)),
+            'parent': load_surface_gaze(os.path.join(session['parent'], gaze_file))}
+    if session['clock'] is not None:
+        slave_name = PUPIL_DEVICES[WIFI_SOURCE][1]['name']
+        gaze['parent'] = (correct_timestamps(gaze['parent'][0], *load_timeline(session['clock'], slave_name)),) \
+            + gaze['parent'][1:]
+
+    result = {}
+    for movie, info in movie_info.items():
+        starts = [t for t, label in annotations if label == f'start_{movie}']
+        if not starts:
+            continue
+        frames_path = f"{session['frames']}_{movie}_frames.npz" if session['frames'] is not None else None
+        for participant, (t, x, y, confidence) in gaze.items():
+            counts = np.zeros(_grid_shape(info, bins, frame_bin), dtype=np.uint32)
+            frame = gaze_frame_indices(t, starts[0], info, frames_path)
+            accumulate(counts, frame, x, y, confidence, frame_bin)
+            result[(movie, participant)] = counts
+    return result
+
+def _accumulate_sessions(args:tuple):
+    """
+    Worker: sums the contributions of a list of sessions into one partial result.
+
+    Returns:
+        partial (dict): (movie, participant) -> count array.
+        done (list): Sessions included.
+        failed (list): (session, error) of sessions that could not be read.
+    """
+    sessions, movie_info, bins, frame_bin, surface = args
+    partial = {(movie, participant): np.zeros(_grid_shape(info, bins, frame_bin), dtype=np.uint32)
+               for movie, info in movie_info.items() for participant in PARTICIPANTS}
+    done, failed = [], []
+    for session in sessions:
+        try:
+            contribution = session_contribution(session, movie_info, bins, frame_bin, surface)
+        except (OSError, ValueError, KeyError) as e:
+            failed.append((session['session'], str(e)))
+            continue
+        for key, counts in contribution.items():
+            partial[key] += counts
+        done.append(session['session'])
+    return partial, done, failed
+
+def _current_generation(store:str):
+    """
+    Returns:
+        (str|None): Directory of the current generation, None if the store is empty.
+    """
+    try:
+        with open(os.path.join(store, CURRENT_NAME)) as f:
+            return os.path.join(store, f.read().strip())
+    except FileNotFoundError:
+        return None
+
+def _load_manifest(generation_dir:str):
+    if generation_dir is None:
+        return None
+    with open(os.path.join(generation_dir, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+def _commit_generation(store:str, generation:str):
+    """
+    Makes generation the current one (atomic replace of the pointer file) and removes all other generations,
+    including those left behind by interrupted updates.
+    """
+    tmp_path = os.path.join(store, CURRENT_NAME + '.tmp')
+    with open(tmp_path, 'w') as f:
+        f.write(generation)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(store, CURRENT_NAME))
+    for name in os.listdir(store):
+        if name.startswith('gen-') and name != generation:
+            shutil.rmtree(os.path.join(store, name), ignore_errors=True)
+
+def update_cohort(store:str, sessions:list, workers:int=ASSET_WORKERS, surface:str='screen',
+                  bins:tuple=HEATMAP_BINS, frame_bin:int=HEATMAP_FRAME_BIN):
+    """
+    Adds the sessions not yet in the store to the cohort counts.
+
+    Args:
+        store (str): Store directory, created on the first update.
+        sessions (list): Sessions, see read_sessions.
+        workers (int): Worker processes.
+        surface (str): Name of the surface defined on the subject screen.
+        bins (tuple): Grid columns and rows (first update only, then taken from the store).
+        frame_bin (int): Frames per time bin (first update only).
+
+    Returns:
+        (dict): Names of the added and failed sessions and the cohort size.
+    """
+    current = _current_generation(store)
+    manifest = _load_manifest(current)
+    if manifest is None:
+        movie_info = {}
+        for movie, path in MOVIE_PATHS.items():
+            info = probe_media(get_stimulus_path(path))
+            movie_info[movie] = {'n_frames': int(round(info['duration'] * info['fps'])), 'fps': info['fps']}
+        manifest = {'generation': 0, 'bins': list(bins), 'frame_bin': frame_bin, 'movies': movie_info,
+                    'sessions': []}
+        os.makedirs(store, exist_ok=True)
+    bins, frame_bin, movie_info = tuple(manifest['bins']), manifest['frame_bin'], manifest['movies']
+
+    # sessions not in the store yet, each once - a session listed twice would be counted twice for good
+    new = {}
+    for session in sessions:
+        if session['session'] in new:
+            print(f"WARNING: session {session['session']} listed more than once, only the first entry is used")
+        elif session['session'] not in manifest['sessions']:
+            new[session['session']] = session
+    new = list(new.values())
+    if not new:
+        print(f"Cohort up to date ({len(manifest['sessions'])} sessions)")
+        return {'added': [], 'failed': [], 'sessions': len(manifest['sessions'])}
+    n_workers = max(1, min(workers, len(new)))
+    jobs = [(new[i::n_workers], movie_info, bins, frame_bin, surface) for i in range(n_workers)]
+
+    totals, added, failed = {}, [], []
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        for partial, done, errors in pool.map(_accumulate_sessions, jobs):
+            for key, counts in partial.items():
+                totals[key] = totals[key] + counts if key in totals else counts
+            added += done
+            failed += errors
+
+    # new generation: counts and manifest written side by side, committed at once by the pointer swap
+    manifest['generation'] += 1
+    manifest['sessions'] += added
+    generation = f"gen-{manifest['generation']:06d}"
+    generation_dir = os.path.join(store, generation)
+    shutil.rmtree(generation_dir, ignore_errors=True)  # leftover of an interrupted update
+    os.makedirs(generation_dir)
+    for (movie, participant), counts in totals.items():
+        name = f"{movie}_{participant}.npy"
+        if current is not None and os.path.isfile(os.path.join(current, name)):
+            counts = counts + np.load(os.path.join(current, name))
+        np.save(os.path.join(generation_dir, name), counts)
+    with open(os.path.join(generation_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    _commit_generation(store, generation)
+
+    print(f"Cohort: {len(added)} sessions added, {len(failed)} failed, {len(manifest['sessions'])} in total")
+    for name, error in failed:
+        print(f"  {name}: {error}")
+    return {'added': added, 'failed': failed, 'sessions': len(manifest['sessions'])}
+
+def load_counts(store:str, movie:str, participant:str):
+    """
+    Cohort counts of a movie, memory-mapped. participant 'both' sums children and caregivers.
+
+    Returns:
+        counts (np.ndarray): (time bins, rows, columns) gaze sample counts.
+        manifest (dict): Store manifest.
+    """
+    current = _current_generation(store)
+    if current is None:
+        raise FileNotFoundError(f"No cohort heatmaps in {store}")
+    manifest = _load_manifest(current)
+    participants = PARTICIPANTS if participant == 'both' else (participant,)
+    arrays = [np.load(os.path.join(current, f"{movie}_{p}.npy"), mmap_mode='r') for p in participants]
+    return (arrays[0] if len(arrays) == 1 else sum(a.astype(np.uint64) for a in arrays)), manifest
+
+def heatmaps(counts:np.ndarray, sigma:float=HEATMAP_SIGMA, sigma_t:float=0.0):
+    """
+    Smoothed heatmaps, each time bin normalized to its maximum.
+
+    Args:
+        counts (np.ndarray): Output of load_counts.
+        sigma (float): Spatial Gaussian smoothing [cells].
+        sigma_t (float): Temporal Gaussian smoothing [time bins].
+
+    Returns:
+        (np.ndarray): float32 (time bins, rows, columns), 0-1.
+    """
+    maps = gaussian_filter(np.asarray(counts, dtype=np.float32), sigma=(sigma_t, sigma, sigma))
+    peak = maps.max(axis=(1, 2), keepdims=True)
+    return np.divide(maps, peak, out=np.zeros_like(maps), where=peak > 0)
+
+def _colorize(maps:np.ndarray, alpha:float):
+    """
+    'Hot' RGBA colors of 0-1 heatmaps, transparency following the value.
+    """
+    rgba = np.empty(maps.shape + (4,), dtype=np.uint8)
+    for channel, offset in enumerate((0.0, 1.0, 2.0)):
+        rgba[..., channel] = (np.clip(3 * maps - offset, 0, 1) * 255).astype(np.uint8)
+    rgba[..., 3] = (maps * alpha * 255).astype(np.uint8)
+    return rgba
+
+def export_video(store:str, movie:str, participant:str, output_path:str, sigma:float=HEATMAP_SIGMA,
+                 alpha:float=HEATMAP_ALPHA):
+    """
+    Renders the heatmaps over the clip; ffmpeg scales the grid to the clip size and overlays it.
+    """
+    counts, manifest = load_counts(store, movie, participant)
+    info, frame_bin = manifest['movies'][movie], manifest['frame_bin']
+    nx, ny = manifest['bins']
+    rgba = _colorize(heatmaps(counts, sigma), alpha)
+
+    clip_path = get_stimulus_path(MOVIE_PATHS[movie])
+    proc = subprocess.Popen(
+        ["ffmpeg", "-hide_banner", "-nostdin", "-y", "-v", "error", "-i", clip_path,
+         "-f", "rawvideo", "-pix_fmt", "rgba", "-s", f"{nx}x{ny}", "-r", str(info['fps']), "-i", "-",
+         "-filter_complex", "[1:v][0:v]scale2ref=flags=bicubic[heat][clip];[clip][heat]overlay=shortest=1[v]",
+         "-map", "[v]", "-map", "0:a?", "-c:v", "libx264", "-pix_fmt", "yuv420p", "-c:a", "aac", output_path],
+        stdin=subprocess.PIPE)
+    try:
+        for frame in range(info['n_frames']):
+            proc.stdin.write(rgba[frame // frame_bin].tobytes())
+    except BrokenPipeError:
+        pass
+    finally:
+        proc.stdin.close()
+    if proc.wait() != 0:
+        raise RuntimeError(f"heatmap video encoding failed ({output_path})")
+    print(f"{movie} {participant}: heatmap video of {len(manifest['sessions'])} sessions -> {output_path}")
+
+def export_array(store:str, movie:str, participant:str, output_path:str, sigma:float=HEATMAP_SIGMA):
+    """
+    Saves the smoothed, normalized heatmaps as a float16 .npy array (time bins, rows, columns).
+    """
+    counts, manifest = load_counts(store, movie, participant)
+    np.save(output_path, heatmaps(counts, sigma).astype(np.float16))
+    print(f"{movie} {participant}: heatmaps of {len(manifest['sessions'])} sessions -> {output_path}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cohort gaze heatmaps of the movie clips.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    update_parser = subparsers.add_parser('update')
+    update_parser.add_argument('--store', required=True)
+    update_parser.add_argument('--sessions', required=True, help="CSV: session, child, parent, clock, frames")
+    update_parser.add_argument('--workers', type=int, default=ASSET_WORKERS)
+    update_parser.add_argument('--surface', default='screen')
+    export_parser = subparsers.add_parser('export')
+    export_parser.add_argument('--store', required=True)
+    export_parser.add_argument('movie', choices=sorted(MOVIE_PATHS))
+    export_parser.add_argument('participant', choices=PARTICIPANTS + ('both',))
+    export_parser.add_argument('--video', default=None)
+    export_parser.add_argument('--array', default=None)
+    export_parser.add_argument('--sigma', type=float, default=HEATMAP_SIGMA)
+    args = parser.parse_args()
+
+    if args.command == 'update':
+        result = update_cohort(args.store, read_sessions(args.sessions), workers=args.workers, surface=args.surface)
+        if result['failed']:
+            sys.exit(1)
+    else:
+        if args.video is None and args.array is None:
+            parser.error("export needs --video and/or --array")
+        if args.array is not None:
+            export_array(args.store, args.movie, args.participant, args.array, sigma=args.sigma)
+        if args.video is not None:
+            export_video(args.store, args.movie, args.participant, args.video, sigma=args.sigma)
@@ -0,0 +1,190 @@
+"""
+Streaming reader of Pupil Capture .pldata files (gaze.pldata, pupil.pldata, ...) with a columnar cache.
+
+A .pldata file is a stream of msgpack-packed (topic, payload) pairs, the payload being the msgpack-packed datum.
+Records are streamed with msgpack.Unpacker (the serializer of m03_pupilcapture_comms) in batches of
+PLDATA_BATCH_SIZE; only the requested fields are taken from each datum, into typed numpy columns, and every
+finished batch is appended to the column files. Memory stays bounded by the batch size.
+
+The columns are cached next to the recording in '<name>.columns/' - one raw file per field and meta.json with the
+source size/mtime, record count and dtypes. Cached columns are opened as read-only np.memmap, so re-opening a
+session takes milliseconds and loads nothing until the data is used. The cache is rebuilt when the source changes
+or a field is requested that is not cached.
+
+Fields are datum keys, with '.<index>' for elements of sequences: 'norm_pos.0', 'gaze_point_3d.2'.
+Missing fields are NaN (-1 for integer columns).
+
+Usage:
+    python misc/pldata.py <recording dir> [--name gaze] [--refresh]
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+
+import msgpack as serializer
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import PLDATA_BATCH_SIZE
+
+DEFAULT_FIELDS = {
+    'gaze': {'timestamp': 'f8', 'confidence': 'f4', 'norm_pos.0': 'f4', 'norm_pos.1': 'f4',
+             'gaze_point_3d.0': 'f4', 'gaze_point_3d.1': 'f4', 'gaze_point_3d.2': 'f4'},
+    'pupil': {'timestamp': 'f8', 'confidence': 'f4', 'id': 'i1', 'diameter': 'f4', 'diameter_3d': 'f4'},
+}
+META_NAME = 'meta.json'
+
+
+def _getter(field:str):
+    """
+    Function taking the field out of a datum, None if missing.
+    """
+    key, _, index = field.partition('.')
+    if not index:
+        return lambda datum: datum.get(key)
+    index = int(index)
+
+    def get(datum:dict):
+        value = datum.get(key)
+        return value[index] if value is not None and len(value) > index else None
+    return get
+
+def _missing(dtype:str):
+    return -1 if np.dtype(dtype).kind in 'iu' else np.nan
+
+def iter_batches(path:str, fields:dict, topic:str=None, batch_size:int=PLDATA_BATCH_SIZE):
+    """
+    Streams a .pldata file in batches of typed columns.
+
+    Args:
+        path (str): .pldata file.
+        fields (dict): Field -> numpy dtype.
+        topic (str): Only records whose topic starts with it, None = all.
+        batch_size (int): Records per batch.
+
+    Yields:
+        (dict): Field -> np.ndarray of up to batch_size values.
+    """
+    getters = {field: _getter(field) for field in fields}
+    batch = {field: [] for field in fields}
+    n = 0
+    with open(path, 'rb') as f:
+        unpacker = serializer.Unpacker(f, use_list=False, raw=False, max_buffer_size=0)
+        for record_topic, payload in unpacker:
+            if topic is not None and not record_topic.startswith(topic):
+                continue
+            datum = serializer.unpackb(payload, use_list=False, raw=False)
+            for field, get in getters.items():
+                batch[field].append(get(datum))
+            n += 1
+            if n == batch_size:
+                yield _to_columns(batch, fields)
+                batch = {field: [] for field in fields}
+                n = 0
+    if n:
+        yield _to_columns(batch, fields)
+
+def _to_columns(batch:dict, fields:dict):
+    return {field: np.array([_missing(fields[field]) if v is None else v for v in values], dtype=fields[field])
+            for field, values in batch.items()}
+
+def _cache_dir(recording_dir:str, name:str):
+    return os.path.join(recording_dir, f"{name}.columns")
+
+def _source_stamp(path:str):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def _read_meta(cache_dir:str):
+    try:
+        with open(os.path.join(cache_dir, META_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def build_cache(recording_dir:str, name:str, fields:dict, topic:str=None, batch_size:int=PLDATA_BATCH_SIZE):
+    """
+    Streams '<name>.pldata' into the column files of '<name>.columns/'. meta.json is written last, so an
+    interrupted build is never taken for a valid cache.
+
+    Returns:
+        (dict): Cache metadata.
+    """
+    source = os.path.join(recording_dir, f"{name}.pldata")
+    cache_dir = _cache_dir(recording_dir, name)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.makedirs(cache_dir)
+
+    files = {field: open(os.path.join(cache_dir, field), 'wb') for field in fields}
+    count = 0
+    try:
+        for columns in iter_batches(source, fields, topic, batch_size):
+            for field, column in columns.items():
+                column.tofile(files[field])
+            count += len(column)
+    finally:
+        for f in files.values():
+            f.close()
+
+    meta = {'source': _source_stamp(source), 'topic': topic, 'count': count, 'fields': fields}
+    with open(os.path.join(cache_dir, META_NAME), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+def load_columns(recording_dir:str, name:str='gaze', fields:dict|list=None, topic:str=None, refresh:bool=False):
+    """
+    Columns of a .pldata file, from the cache when it is valid.
+
+    Args:
+        recording_dir (str): Pupil Capture recording directory.
+        name (str): Data file name without extension - 'gaze', 'pupil', ...
+        fields (dict|list): Field -> dtype, or field names (dtypes from DEFAULT_FIELDS, float64 otherwise).
+            None = DEFAULT_FIELDS[name].
+        topic (str): Only records whose topic starts with it (e.g. 'pupil.0' for one eye), None = all.
+        refresh (bool): Rebuild the cache.
+
+    Returns:
+        (dict): Field -> read-only np.memmap.
+    """
+    defaults = DEFAULT_FIELDS.get(name, {})
+    if fields is None:
+        fields = defaults
+    elif not isinstance(fields, dict):
+        fields = {field: defaults.get(field, 'f8') for field in fields}
+    fields = {field: np.dtype(dtype).str for field, dtype in fields.items()}
+
+    cache_dir = _cache_dir(recording_dir, name)
+    meta = _read_meta(cache_dir)
+    valid = (meta is not None and not refresh
+             and meta['source'] == _source_stamp(os.path.join(recording_dir, f"{name}.pldata"))
+             and meta['topic'] == topic
+             and all(meta['fields'].get(field) == dtype for field, dtype in fields.items()))
+    if not valid:
+        cached = fields
+        if meta is not None and not refresh and meta['topic'] == topic:
+            cached = {**meta['fields'], **fields}  # keep previously cached fields in the cache, not in the result
+        meta = build_cache(recording_dir, name, cached, topic)
+
+    if meta['count'] == 0:
+        return {field: np.empty(0, dtype=meta['fields'][field]) for field in fields}
+    return {field: np.memmap(os.path.join(cache_dir, field), dtype=meta['fields'][field], mode='r',
+                             shape=(meta['count'],))
+            for field in fields}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Columnar cache of a Pupil Capture .pldata file.")
+    parser.add_argument('recording', help="Pupil Capture recording directory")
+    parser.add_argument('--name', default='gaze')
+    parser.add_argument('--refresh', action='store_true')
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    columns = load_columns(args.recording, args.name, refresh=args.refresh)
+    elapsed = time.perf_counter() - t0
+    n = len(next(iter(columns.values())))
+    print(f"{args.name}: {n} records, {len(columns)} columns in {elapsed:.3f} s "
+          f"({_cache_dir(args.recording, args.name)})")
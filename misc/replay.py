@@ -0,0 +1,320 @@
+"""
+Session replay for QA: renders a movie block with the child (master) and caregiver (slave) gaze overlaid on the
+clip, together with gaze confidence, the photodiode marker state and the current stage label.
+
+Inputs are Pupil Player exports of both recordings - surface-mapped gaze (gaze_positions_on_surface_<surface>.csv,
+with the surface defined on the subject screen) and the master annotations (annotations.csv). Clip time 0 is the
+'start_<movie>' annotation. Slave timestamps are mapped onto the master clock with the session clock timeline
+(m06_clock_monitor) when it is given.
+
+The clip is split into chunks rendered in parallel worker processes; each worker decodes its chunk with ffmpeg,
+draws the overlays on batches of frames with array indexing and encodes the chunk. Chunks are then concatenated
+without re-encoding and the clip audio is added.
+
+Usage:
+    python misc/replay.py m1 --child <child export dir> --parent <parent export dir> --output replay_m1.mp4
+        [--surface screen] [--clock data/<session>_clock.csv] [--workers N] [--scale 0.5]
+"""
+import argparse
+import csv
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import MOVIE_1_PATH, MOVIE_2_PATH, MOVIE_3_PATH, WIFI_SOURCE, PUPIL_DEVICES
+from config import REPLAY_SCALE, REPLAY_CHUNK_SECONDS, REPLAY_BATCH_FRAMES, REPLAY_MIN_CONFIDENCE, ASSET_WORKERS
+from misc.synchrony import resample_to_grid
+from misc.video_handling import run_ffmpeg
+from m00_configuration_setup import get_stimulus_path
+from m04_asset_validation import probe_media
+from m06_clock_monitor import load_timeline, correct_timestamps
+
+MOVIE_PATHS = {'m1': MOVIE_1_PATH, 'm2': MOVIE_2_PATH, 'm3': MOVIE_3_PATH}
+PHOTO_TOGGLE_TIME = 0.5  # as in m02_psychopy_routines.run_stimulus_routine
+GAZE_COLORS = {'child': (255, 60, 60), 'parent': (60, 140, 255)}
+GAZE_RADIUS = 0.015  # fraction of the frame height
+RING_WIDTH = 0.35  # fraction of the radius
+
+
+def load_annotations(path:str):
+    """
+    Reads annotations.csv of a Pupil Player export.
+
+    Returns:
+        (list): (timestamp, label) pairs sorted by time.
+    """
+    with open(path, newline='') as f:
+        return sorted((float(r['timestamp']), r['label']) for r in csv.DictReader(f))
+
+def load_surface_gaze(path:str):
+    """
+    Reads surface-mapped gaze of a Pupil Player export. Samples off the surface are kept as NaN positions.
+
+    Returns:
+        t (np.ndarray): Gaze timestamps (Pupil time).
+        x (np.ndarray): Horizontal position, 0-1 from the left surface edge.
+        y (np.ndarray): Vertical position, 0-1 from the bottom surface edge.
+        confidence (np.ndarray): Gaze confidence.
+    """
+    with open(path, newline='') as f:
+        rows = [(float(r['gaze_timestamp']), float(r['x_norm']), float(r['y_norm']), float(r['confidence']),
+                 r['on_surf'] == 'True') for r in csv.DictReader(f)]
+    t, x, y, confidence, on_surf = (np.array(c) for c in zip(*rows))
+    order = np.argsort(t)
+    x, y = np.where(on_surf, x, np.nan), np.where(on_surf, y, np.nan)
+    return t[order], x[order], y[order], confidence[order]
+
+def gaze_per_frame(gaze:tuple, t_start:float, n_frames:int, fps:float, max_gap:float=0.1):
+    """
+    Gaze position and confidence at every frame of the clip.
+
+    Args:
+        gaze (tuple): Output of load_surface_gaze.
+        t_start (float): Pupil time of clip time 0.
+        n_frames (int): Number of frames.
+        fps (float): Clip frame rate.
+        max_gap (float): Longest interpolated gap in the gaze signal [s].
+
+    Returns:
+        (np.ndarray): float32 array (n_frames, 3) of x, y (0-1, y from the bottom) and confidence, NaN if missing.
+    """
+    t, x, y, confidence = gaze
+    t_stop = t_start + n_frames / fps
+    columns = [resample_to_grid(t, v, t_start, t_stop, fs=fps, max_gap=max_gap)[1][:n_frames]
+               for v in (x, y, confidence)]
+    return np.stack(columns, axis=1).astype(np.float32)
+
+def photodiode_state(movie_time:np.ndarray, movie_id:int):
+    """
+    Photodiode marker state at the given clip times, reproducing the toggling of run_stimulus_routine:
+    2 * movie_id + 1 toggles every PHOTO_TOGGLE_TIME from the clip start, the first one switching it on.
+
+    Returns:
+        (np.ndarray): True where the white box is shown.
+    """
+    n_toggles = np.minimum(np.floor(movie_time / PHOTO_TOGGLE_TIME), 2 * movie_id)
+    return (movie_time >= 0) & (n_toggles % 2 == 0)
+
+def stage_labels(annotations:list, times:np.ndarray):
+    """
+    Index of the latest annotation at or before every time, -1 before the first one.
+    """
+    return np.searchsorted(np.array([t for t, _ in annotations]), times, side='right') - 1
+
+def render_label(text:str, height:int):
+    """
+    Renders a text label to an RGB array (white text on a dark box).
+    """
+    font = ImageFont.load_default()
+    width = int(ImageDraw.Draw(Image.new('RGB', (1, 1))).textlength(text, font=font)) + 8
+    image = Image.new('RGB', (width, height), (20, 20, 20))
+    ImageDraw.Draw(image).text((4, (height - 11) // 2), text, fill=(255, 255, 255), font=font)
+    return np.asarray(image)
+
+def _ring_offsets(radius:int):
+    """
+    Pixel offsets (dy, dx) of a ring marker.
+    """
+    dy, dx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    distance = np.hypot(dy, dx)
+    ring = (distance <= radius) & (distance >= radius * (1 - RING_WIDTH))
+    return dy[ring], dx[ring]
+
+def draw_gaze(frames:np.ndarray, gaze:np.ndarray, color:tuple, min_confidence:float=REPLAY_MIN_CONFIDENCE):
+    """
+    Draws a ring at the gaze point of every frame in the batch, in one fancy-indexing assignment.
+    Low-confidence samples are drawn half transparent, missing samples are skipped.
+
+    Args:
+        frames (np.ndarray): uint8 batch (n, height, width, 3), modified in place.
+        gaze (np.ndarray): (n, 3) x, y, confidence from gaze_per_frame.
+        color (tuple): RGB color.
+        min_confidence (float): Confidence below which the marker is half transparent.
+    """
+    n, height, width, _ = frames.shape
+    dy, dx = _ring_offsets(max(int(GAZE_RADIUS * height), 3))
+    valid = ~np.isnan(gaze).any(axis=1)
+    idx = np.flatnonzero(valid)
+    if not len(idx):
+        return
+    cy = np.round((1 - gaze[idx, 1]) * (height - 1)).astype(np.int64)
+    cx = np.round(gaze[idx, 0] * (width - 1)).astype(np.int64)
+    ys, xs = cy[:, None] + dy, cx[:, None] + dx
+    inside = (ys >= 0) & (ys < height) & (xs >= 0) & (xs < width)
+    batch = np.broadcast_to(idx[:, None], ys.shape)
+    alpha = np.broadcast_to(np.where(gaze[idx, 2] >= min_confidence, 1.0, 0.5)[:, None], ys.shape)[inside]
+    b, y, x = batch[inside], ys[inside], xs[inside]
+    frames[b, y, x] = (alpha[:, None] * np.array(color) + (1 - alpha[:, None]) * frames[b, y, x]).astype(np.uint8)
+
+def draw_confidence(frames:np.ndarray, confidence:np.ndarray, row:int, color:tuple):
+    """
+    Draws a confidence bar (length proportional to the confidence) in the top-left corner of every frame.
+    """
+    n, height, width, _ = frames.shape
+    bar_height, bar_width = max(height // 90, 3), width // 6
+    y0 = bar_height * (2 * row + 1)
+    columns = np.arange(bar_width)
+    filled = columns[None, :] < (np.nan_to_num(confidence, nan=0.0) * bar_width)[:, None]
+    frames[:, y0:y0 + bar_height, bar_width // 10:bar_width // 10 + bar_width] = np.where(
+        filled[:, None, :, None], np.array(color, dtype=np.uint8), np.uint8(40))
+
+def draw_photodiode(frames:np.ndarray, state:np.ndarray):
+    """
+    Draws the photodiode box where setup_photodiode places it (right edge, above the middle), white when on.
+    """
+    n, height, width, _ = frames.shape
+    box_height, box_width = int(0.05 * height), int(0.028125 * width)
+    frames[:, height // 2 - box_height:height // 2, width - box_width:] = np.where(
+        state[:, None, None, None], np.uint8(255), np.uint8(0))
+
+def draw_labels(frames:np.ndarray, label_idx:np.ndarray, labels:dict):
+    """
+    Pastes the pre-rendered stage label of every frame in the bottom-left corner, one assignment per label.
+    """
+    height = frames.shape[1]
+    for i in np.unique(label_idx):
+        image = labels[int(i)]
+        h, w = image.shape[:2]
+        frames[label_idx == i, height - h:, :w] = image
+
+def _read_exact(stream, n_bytes:int):
+    data = bytearray(n_bytes)
+    view, filled = memoryview(data), 0
+    while filled < n_bytes:
+        read = stream.readinto(view[filled:])
+        if not read:
+            break
+        filled += read
+    return data if filled == n_bytes else None
+
+def _render_chunk(args:tuple):
+    """
+    Process pool entry point: decodes, annotates and encodes frames [first, last) of the clip.
+    """
+    clip_path, output_path, first, last, fps, size, overlay = args
+    width, height = size
+    decoder = subprocess.Popen(["ffmpeg", "-v", "error", "-nostdin", "-ss", f"{first / fps:.6f}", "-i", clip_path,
+                                "-frames:v", str(last - first), "-an", "-vf", f"scale={width}:{height}",
+                                "-f", "rawvideo", "-pix_fmt", "rgb24", "-"], stdout=subprocess.PIPE)
+    encoder = subprocess.Popen(["ffmpeg", "-v", "error", "-nostdin", "-y", "-f", "rawvideo", "-pix_fmt", "rgb24",
+                                "-s", f"{width}x{height}", "-r", f"{fps:g}", "-i", "-",
+                                "-c:v", "libx264", "-preset", "veryfast", "-crf", "23", "-pix_fmt", "yuv420p",
+                                output_path], stdin=subprocess.PIPE)
+    labels = {i: render_label(text, max(height // 30, 16)) for i, text in overlay['labels'].items()}
+    frame_bytes = width * height * 3
+    frame = first
+    while frame < last:
+        n = min(REPLAY_BATCH_FRAMES, last - frame)
+        data = _read_exact(decoder.stdout, n * frame_bytes)
+        if data is None:
+            break
+        frames = np.frombuffer(data, dtype=np.uint8).reshape(n, height, width, 3)
+        rows = slice(frame - first, frame - first + n)
+        for row, (who, gaze) in enumerate(overlay['gaze'].items()):
+            draw_gaze(frames, gaze[rows], GAZE_COLORS[who])
+            draw_confidence(frames, gaze[rows, 2], row, GAZE_COLORS[who])
+        draw_photodiode(frames, overlay['photodiode'][rows])
+        draw_labels(frames, overlay['label_idx'][rows], labels)
+        encoder.stdin.write(data)
+        frame += n
+    decoder.stdout.close()
+    decoder.wait()
+    encoder.stdin.close()
+    if encoder.wait() != 0:
+        raise RuntimeError(f"encoding of frames {first}-{last} failed")
+    return frame - first
+
+def render_replay(movie:str, child_dir:str, parent_dir:str, output_path:str, surface:str='screen',
+                  clock_path:str=None, workers:int=ASSET_WORKERS, scale:float=REPLAY_SCALE,
+                  chunk_seconds:float=REPLAY_CHUNK_SECONDS):
+    """
+    Renders the replay of one movie block.
+
+    Args:
+        movie (str): Movie name - 'm1', 'm2' or 'm3'.
+        child_dir (str): Pupil Player export directory of the child (master) recording.
+        parent_dir (str): Pupil Player export directory of the caregiver (slave) recording.
+        output_path (str): Output video.
+        surface (str): Name of the surface defined on the subject screen.
+        clock_path (str): Session clock timeline (data/<session>_clock.csv), None = slave clock not corrected.
+        workers (int): Worker processes.
+        scale (float): Output size relative to the clip.
+        chunk_seconds (float): Chunk length [s].
+
+    Returns:
+        (dict): Number of frames, render time [s] and real-time factor (clip duration / render time).
+    """
+    t0 = time.perf_counter()
+    clip_path = get_stimulus_path(MOVIE_PATHS[movie])
+    info = probe_media(clip_path)
+    fps = info['fps']
+    n_frames = int(info['duration'] * fps)
+    size = (int(info['width'] * scale) // 2 * 2, int(info['height'] * scale) // 2 * 2)
+
+    annotations = load_annotations(os.path.join(child_dir, 'annotations.csv'))
+    starts = [t for t, label in annotations if label == f'start_{movie}']
+    if not starts:
+        raise ValueError(f"No 'start_{movie}' annotation in {child_dir}")
+    t_start = starts[0]
+
+    gaze_file = f'gaze_positions_on_surface_{surface}.csv'
+    child = load_surface_gaze(os.path.join(child_dir, 'surfaces', gaze_file))
+    parent = load_surface_gaze(os.path.join(parent_dir, 'surfaces', gaze_file))
+    if clock_path is not None:
+        slave_name = PUPIL_DEVICES[WIFI_SOURCE][1]['name']
+        parent = (correct_timestamps(parent[0], *load_timeline(clock_path, slave_name)),) + parent[1:]
+
+    movie_time = np.arange(n_frames) / fps
+    label_idx = stage_labels(annotations, t_start + movie_time)
+    overlay = {
+        'gaze': {'child': gaze_per_frame(child, t_start, n_frames, fps),
+                 'parent': gaze_per_frame(parent, t_start, n_frames, fps)},
+        'photodiode': photodiode_state(movie_time, int(movie[-1])),
+        'label_idx': label_idx,
+        'labels': {int(i): (annotations[i][1] if i >= 0 else '') + f'  |  {movie}'
+                   for i in np.unique(label_idx)},
+    }
+
+    chunk = max(int(chunk_seconds * fps), 1)
+    bounds = [(first, min(first + chunk, n_frames)) for first in range(0, n_frames, chunk)]
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as tmp_dir:
+        chunk_paths = [os.path.join(tmp_dir, f'chunk_{i:04d}.mp4') for i in range(len(bounds))]
+        jobs = [(clip_path, path, first, last, fps, size, overlay)
+                for path, (first, last) in zip(chunk_paths, bounds)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rendered = sum(pool.map(_render_chunk, jobs))
+
+        list_path = os.path.join(tmp_dir, 'chunks.txt')
+        with open(list_path, 'w') as f:
+            f.writelines(f"file '{path}'\n" for path in chunk_paths)
+        run_ffmpeg(["-f", "concat", "-safe", "0", "-i", list_path, "-i", clip_path,
+                    "-map", "0:v", "-map", "1:a?", "-c:v", "copy", "-c:a", "aac", "-shortest", output_path])
+
+    elapsed = time.perf_counter() - t0
+    result = {'frames': rendered, 'time': elapsed, 'realtime_factor': (rendered / fps) / elapsed}
+    print(f"{movie}: {rendered} frames ({rendered / fps:.1f} s) rendered in {elapsed:.1f} s "
+          f"({result['realtime_factor']:.2f}x real time) -> {output_path}")
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay of a movie block with child and caregiver gaze.")
+    parser.add_argument('movie', choices=sorted(MOVIE_PATHS))
+    parser.add_argument('--child', required=True, help="Pupil Player export directory of the child recording")
+    parser.add_argument('--parent', required=True, help="Pupil Player export directory of the caregiver recording")
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--surface', default='screen')
+    parser.add_argument('--clock', default=None, help="session clock timeline (data/<session>_clock.csv)")
+    parser.add_argument('--workers', type=int, default=ASSET_WORKERS)
+    parser.add_argument('--scale', type=float, default=REPLAY_SCALE)
+    args = parser.parse_args()
+
+    render_replay(args.movie, args.child, args.parent, args.output, surface=args.surface, clock_path=args.clock,
+                  workers=args.workers, scale=args.scale)
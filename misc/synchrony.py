@@ -0,0 +1,371 @@
+"""
+Lagged child-parent synchrony of pupil diameter and gaze velocity during free conversation blocks.
+
+Windowed lagged cross-correlation (WLCC) and categorical cross-recurrence are computed with FFT convolution over
+overlapping windows. Windows are processed in chunks of SYNC_CHUNK_WINDOWS, so memory is bounded by the chunk size
+(two chunks per worker in flight) and not by the block length. Shuffled-pair surrogates reuse a cohort pair matrix,
+so a permutation costs only a few index lookups.
+"""
+import collections
+import itertools
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import SYNC_FS, SYNC_WIN_LEN, SYNC_WIN_STEP, SYNC_MAX_LAG, SYNC_CHUNK_WINDOWS, SYNC_RECUR_BINS
+
+
+def crop_block(t:np.ndarray, values:np.ndarray, t_start:float, t_stop:float):
+    """
+    Crops a signal to a block delimited by annotations, e.g. start_free_convo -> stop_free_convo.
+
+    Args:
+        t (np.ndarray): Pupil timestamps of the signal.
+        values (np.ndarray): Signal values, same length as t.
+        t_start (float): Block start in Pupil time.
+        t_stop (float): Block stop in Pupil time.
+
+    Returns:
+        t (np.ndarray): Cropped timestamps.
+        values (np.ndarray): Cropped values.
+    """
+    i0, i1 = np.searchsorted(t, [t_start, t_stop])
+    return t[i0:i1], values[i0:i1]
+
+def resample_to_grid(t:np.ndarray, values:np.ndarray, t_start:float, t_stop:float, fs:float=SYNC_FS,
+                     max_gap:float=0.05):
+    """
+    Linearly resamples an irregularly sampled signal onto a regular grid shared by both devices.
+    Grid points lying in gaps longer than max_gap (blinks, dropped samples) are set to NaN.
+
+    Args:
+        t (np.ndarray): Pupil timestamps, sorted.
+        values (np.ndarray): Signal values. NaN samples are treated as missing.
+        t_start (float): Grid start in Pupil time.
+        t_stop (float): Grid stop in Pupil time.
+        fs (float): Grid sampling rate [Hz].
+        max_gap (float): Longest gap [s] that is still interpolated.
+
+    Returns:
+        t_grid (np.ndarray): Regular timestamps.
+        v_grid (np.ndarray): Resampled values (float64, NaN where missing).
+    """
+    valid = ~np.isnan(values)
+    t, values = t[valid], values[valid]
+    t_grid = t_start + np.arange(int((t_stop - t_start) * fs)) / fs
+    v_grid = np.interp(t_grid, t, values, left=np.nan, right=np.nan)
+
+    idx = np.clip(np.searchsorted(t, t_grid), 1, len(t) - 1)
+    gap = t[idx] - t[idx - 1]
+    v_grid[gap > max_gap] = np.nan
+    return t_grid, v_grid
+
+def gaze_velocity(t:np.ndarray, x:np.ndarray, y:np.ndarray):
+    """
+    Gaze speed from normalized gaze positions.
+
+    Args:
+        t (np.ndarray): Timestamps [s].
+        x (np.ndarray): Horizontal gaze position.
+        y (np.ndarray): Vertical gaze position.
+
+    Returns:
+        (np.ndarray): Gaze speed [units/s], same length as t.
+    """
+    return np.hypot(np.gradient(x, t), np.gradient(y, t))
+
+def _window_params(fs:float, win_len:float, step:float, max_lag:float):
+    """
+    Converts window parameters from seconds to samples and picks the FFT length.
+    The FFT length covers win + max_lag samples, so circular wrap-around never reaches the reported lags.
+    """
+    win = int(round(win_len * fs))
+    hop = max(int(round(step * fs)), 1)
+    lag = int(round(max_lag * fs))
+    if lag >= win:
+        raise ValueError(f"max_lag ({max_lag} s) has to be shorter than the window ({win_len} s).")
+    nfft = fft.next_fast_len(win + lag, real=True)
+    return win, hop, lag, nfft
+
+def _lag_index(nfft:int, lag:int):
+    """
+    Indices of an irfft output ordered from -lag to +lag.
+    """
+    return np.r_[nfft - lag:nfft, 0:lag + 1]
+
+def _xcorr_chunk(xw:np.ndarray, yw:np.ndarray, nfft:int, lag:int, min_overlap:int):
+    """
+    Lagged Pearson-like correlation of each window row.
+    Windows are z-scored ignoring NaNs; NaNs are then zeroed and the number of valid sample pairs at each lag is
+    obtained by correlating the validity masks, so missing samples do not bias the estimate towards zero.
+    """
+    xm, ym = ~np.isnan(xw), ~np.isnan(yw)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        xz = (xw - np.nanmean(xw, axis=1, keepdims=True)) / np.nanstd(xw, axis=1, keepdims=True)
+        yz = (yw - np.nanmean(yw, axis=1, keepdims=True)) / np.nanstd(yw, axis=1, keepdims=True)
+    xz = np.nan_to_num(xz, nan=0.0, posinf=0.0, neginf=0.0)
+    yz = np.nan_to_num(yz, nan=0.0, posinf=0.0, neginf=0.0)
+
+    idx = _lag_index(nfft, lag)
+    cc = fft.irfft(np.conj(fft.rfft(xz, nfft)) * fft.rfft(yz, nfft), nfft)[:, idx]
+    n = fft.irfft(np.conj(fft.rfft(xm, nfft)) * fft.rfft(ym, nfft), nfft)[:, idx]
+    n = np.rint(n)
+
+    r = cc / np.maximum(n, 1)
+    r[n < min_overlap] = np.nan
+    return r
+
+def _recurrence_chunk(xw:np.ndarray, yw:np.ndarray, nfft:int, lag:int, min_overlap:int):
+    """
+    Diagonal cross-recurrence rate of each window row, for signals already quantized into integer bin codes
+    (-1 = missing). Matches are counted bin by bin with FFT correlation of the bin indicators.
+    """
+    idx = _lag_index(nfft, lag)
+    n_bins = int(max(xw.max(initial=-1), yw.max(initial=-1))) + 1
+    bins = np.arange(n_bins)[None, :, None]
+    xi = (xw[:, None, :] == bins)
+    yi = (yw[:, None, :] == bins)
+    matches = fft.irfft(np.conj(fft.rfft(xi, nfft)) * fft.rfft(yi, nfft), nfft).sum(axis=1)[:, idx]
+    n = fft.irfft(np.conj(fft.rfft(xw >= 0, nfft)) * fft.rfft(yw >= 0, nfft), nfft)[:, idx]
+    n = np.rint(n)
+
+    rr = np.rint(matches) / np.maximum(n, 1)
+    rr[n < min_overlap] = np.nan
+    return rr
+
+_CHUNK_FUNCS = {'xcorr': _xcorr_chunk, 'recurrence': _recurrence_chunk}
+
+def _run_chunk(args:tuple):
+    """
+    Process pool entry point: slices the windows of one chunk and evaluates them.
+    """
+    kind, x, y, starts, win, nfft, lag, min_overlap = args
+    xw = sliding_window_view(x, win)[starts]
+    yw = sliding_window_view(y, win)[starts]
+    return _CHUNK_FUNCS[kind](xw, yw, nfft, lag, min_overlap)
+
+def _iter_chunks(kind:str, x:np.ndarray, y:np.ndarray, fs:float, win_len:float, step:float, max_lag:float,
+                 chunk_windows:int, workers:int, min_overlap:float):
+    """
+    Yields (window start times, per-window lag profiles) chunk by chunk.
+    Only the samples covered by a chunk are handed to a worker, so x and y may be np.memmap arrays.
+    """
+    if len(x) != len(y):
+        raise ValueError(f"Signals have to share one time grid, got {len(x)} and {len(y)} samples.")
+    win, hop, lag, nfft = _window_params(fs, win_len, step, max_lag)
+    starts = np.arange(0, len(x) - win + 1, hop)
+    min_count = int(np.ceil(min_overlap * win))
+
+    def jobs():
+        for c0 in range(0, len(starts), chunk_windows):
+            chunk = starts[c0:c0 + chunk_windows]
+            s0, s1 = chunk[0], chunk[-1] + win
+            yield kind, np.asarray(x[s0:s1]), np.asarray(y[s0:s1]), chunk - s0, win, nfft, lag, min_count
+
+    chunk_starts = (starts[c0:c0 + chunk_windows] for c0 in range(0, len(starts), chunk_windows))
+    if workers == 1:
+        results = map(_run_chunk, jobs())
+        for chunk, res in zip(chunk_starts, results):
+            yield chunk / fs, res
+    else:
+        # at most 2 chunks per worker in flight - executor.map would submit (and copy) every chunk up front
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            remaining = jobs()
+            pending = collections.deque(executor.submit(_run_chunk, job)
+                                        for job in itertools.islice(remaining, 2 * workers))
+            for chunk in chunk_starts:
+                res = pending.popleft().result()
+                job = next(remaining, None)
+                if job is not None:
+                    pending.append(executor.submit(_run_chunk, job))
+                yield chunk / fs, res
+
+def lags_seconds(fs:float=SYNC_FS, max_lag:float=SYNC_MAX_LAG):
+    """
+    Lag axis [s] of the profiles returned by windowed_xcorr and windowed_cross_recurrence.
+    Positive lag means the second signal (parent) follows the first one (child).
+    """
+    lag = int(round(max_lag * fs))
+    return np.arange(-lag, lag + 1) / fs
+
+def windowed_xcorr(x:np.ndarray, y:np.ndarray, fs:float=SYNC_FS, win_len:float=SYNC_WIN_LEN,
+                   step:float=SYNC_WIN_STEP, max_lag:float=SYNC_MAX_LAG, chunk_windows:int=SYNC_CHUNK_WINDOWS,
+                   workers:int=1, min_overlap:float=0.5):
+    """
+    Windowed lagged cross-correlation between child (x) and parent (y) signals sampled on a common grid.
+
+    Args:
+        x (np.ndarray): Child signal, e.g. from resample_to_grid. NaN = missing.
+        y (np.ndarray): Parent signal, same length as x.
+        fs (float): Sampling rate [Hz].
+        win_len (float): Window length [s].
+        step (float): Hop between consecutive windows [s].
+        max_lag (float): Largest lag [s] evaluated in each direction.
+        chunk_windows (int): Windows evaluated at once - bounds memory to ~chunk_windows * FFT length.
+        workers (int): Number of processes. 1 runs in the calling process.
+        min_overlap (float): Minimal fraction of valid sample pairs for a lag to be reported, else NaN.
+
+    Returns:
+        times (np.ndarray): Window start times [s] relative to the first sample.
+        lags (np.ndarray): Lag axis [s].
+        r (np.ndarray): Correlation coefficients, shape (n_windows, n_lags).
+    """
+    times, r = [], []
+    for t_chunk, r_chunk in _iter_chunks('xcorr', x, y, fs, win_len, step, max_lag, chunk_windows, workers,
+                                         min_overlap):
+        times.append(t_chunk)
+        r.append(r_chunk)
+    return _stack(times, r, fs, max_lag)
+
+def quantize(values:np.ndarray, n_bins:int=SYNC_RECUR_BINS):
+    """
+    Quantizes a signal into n_bins equally populated bins for categorical cross-recurrence.
+
+    Args:
+        values (np.ndarray): Signal values, NaN = missing.
+        n_bins (int): Number of bins.
+
+    Returns:
+        (np.ndarray): int8 bin codes, -1 where the value is missing.
+    """
+    edges = np.nanquantile(values, np.linspace(0, 1, n_bins + 1)[1:-1])
+    codes = np.searchsorted(edges, values, side='right').astype(np.int8)
+    codes[np.isnan(values)] = -1
+    return codes
+
+def windowed_cross_recurrence(x:np.ndarray, y:np.ndarray, fs:float=SYNC_FS, win_len:float=SYNC_WIN_LEN,
+                              step:float=SYNC_WIN_STEP, max_lag:float=SYNC_MAX_LAG, n_bins:int=SYNC_RECUR_BINS,
+                              chunk_windows:int=SYNC_CHUNK_WINDOWS, workers:int=1, min_overlap:float=0.5):
+    """
+    Windowed diagonal cross-recurrence profile: share of samples at which child and parent occupy the same
+    quantile bin, for each lag. Each signal is quantized over the whole block.
+
+    Args:
+        x (np.ndarray): Child signal, NaN = missing.
+        y (np.ndarray): Parent signal, same length as x.
+        fs (float): Sampling rate [Hz].
+        win_len (float): Window length [s].
+        step (float): Hop between consecutive windows [s].
+        max_lag (float): Largest lag [s] evaluated in each direction.
+        n_bins (int): Number of quantile bins per signal.
+        chunk_windows (int): Windows evaluated at once. Memory grows with chunk_windows * n_bins.
+        workers (int): Number of processes.
+        min_overlap (float): Minimal fraction of valid sample pairs for a lag to be reported, else NaN.
+
+    Returns:
+        times (np.ndarray): Window start times [s].
+        lags (np.ndarray): Lag axis [s].
+        rr (np.ndarray): Recurrence rates, shape (n_windows, n_lags). Chance level is ~1 / n_bins.
+    """
+    xq, yq = quantize(x, n_bins), quantize(y, n_bins)
+    times, rr = [], []
+    for t_chunk, rr_chunk in _iter_chunks('recurrence', xq, yq, fs, win_len, step, max_lag, chunk_windows,
+                                          workers, min_overlap):
+        times.append(t_chunk)
+        rr.append(rr_chunk)
+    return _stack(times, rr, fs, max_lag)
+
+def _stack(times:list, profiles:list, fs:float, max_lag:float):
+    lags = lags_seconds(fs, max_lag)
+    if not times:
+        return np.empty(0), lags, np.empty((0, len(lags)))
+    return np.concatenate(times), lags, np.concatenate(profiles)
+
+def peak_synchrony(profiles:np.ndarray, lags:np.ndarray):
+    """
+    Per-window peak of the absolute lag profile.
+
+    Args:
+        profiles (np.ndarray): Output of windowed_xcorr or windowed_cross_recurrence, shape (n_windows, n_lags).
+        lags (np.ndarray): Lag axis [s].
+
+    Returns:
+        peak (np.ndarray): Peak |value| of each window (NaN for fully missing windows).
+        peak_lag (np.ndarray): Lag [s] at which the peak occurs.
+    """
+    filled = np.nan_to_num(np.abs(profiles), nan=-np.inf)
+    i = filled.argmax(axis=1)
+    peak = filled[np.arange(len(i)), i]
+    peak[np.isneginf(peak)] = np.nan
+    return peak, lags[i]
+
+def _pair_statistic(args:tuple):
+    """
+    Process pool entry point: mean peak synchrony of one (child, parent) pairing.
+    Series are truncated to the shorter one, since the blocks of different dyads differ slightly in length.
+    """
+    kind, x, y, kwargs = args
+    n = min(len(x), len(y))
+    func = windowed_xcorr if kind == 'xcorr' else windowed_cross_recurrence
+    _, lags, profiles = func(x[:n], y[:n], workers=1, **kwargs)
+    peak, _ = peak_synchrony(profiles, lags)
+    return np.nanmean(peak) if np.isfinite(peak).any() else np.nan
+
+def pair_matrix(children:list, parents:list, kind:str='xcorr', workers:int=1, **kwargs):
+    """
+    Mean peak synchrony of every child with every parent of the cohort.
+    Diagonal = real dyads, off-diagonal = shuffled pairs. n^2 pair statistics are computed once, after which any
+    number of surrogate permutations is cheap (see shuffled_pair_null).
+
+    Args:
+        children (list): Child signals (np.ndarray) of each dyad, on the common grid.
+        parents (list): Parent signals of each dyad, same order as children.
+        kind (str): 'xcorr' or 'recurrence'.
+        workers (int): Number of processes; pairs are distributed among them.
+        **kwargs: Passed on to windowed_xcorr / windowed_cross_recurrence.
+
+    Returns:
+        (np.ndarray): Matrix (n_dyads, n_dyads), [i, j] = statistic(child i, parent j).
+    """
+    if kind not in _CHUNK_FUNCS:
+        raise ValueError(f"Unknown synchrony measure: {kind}")
+    n = len(children)
+    jobs = ((kind, children[i], parents[j], kwargs) for i in range(n) for j in range(n))
+    if workers == 1:
+        stats = list(map(_pair_statistic, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            stats = list(executor.map(_pair_statistic, jobs, chunksize=max(n // workers, 1)))
+    return np.asarray(stats).reshape(n, n)
+
+def _derangements(n:int, n_perm:int, rng:np.random.Generator):
+    """
+    Draws n_perm random permutations of range(n) without fixed points (nobody is paired with their own parent).
+    Rows are drawn in vectorized batches and rejected if they contain a fixed point (~37% acceptance).
+    """
+    if n < 2:
+        raise ValueError("Shuffled-pair surrogates need at least two dyads.")
+    out = np.empty((0, n), dtype=np.intp)
+    while len(out) < n_perm:
+        batch = rng.permuted(np.tile(np.arange(n), (3 * (n_perm - len(out)), 1)), axis=1)
+        batch = batch[(batch != np.arange(n)).all(axis=1)]
+        out = np.concatenate([out, batch])
+    return out[:n_perm]
+
+def shuffled_pair_null(matrix:np.ndarray, n_perm:int=10000, seed:int|None=None):
+    """
+    Surrogate null distribution of the cohort mean synchrony, obtained by re-pairing children with other
+    dyads' parents.
+
+    Args:
+        matrix (np.ndarray): Output of pair_matrix.
+        n_perm (int): Number of surrogate cohorts.
+        seed (int|None): Random seed.
+
+    Returns:
+        observed (float): Cohort mean synchrony of the real dyads.
+        null (np.ndarray): Cohort mean synchrony of each surrogate cohort, shape (n_perm,).
+        p_value (float): One-sided permutation p-value of observed >= null.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(matrix)
+    observed = np.nanmean(np.diag(matrix))
+    perms = _derangements(n, n_perm, rng)
+    null = np.nanmean(matrix[np.arange(n), perms], axis=1)
+    p_value = (1 + np.sum(null >= observed)) / (1 + n_perm)
+    return observed, null, p_value
@@ -1,21 +1,253 @@
-import subprocess
+"""
+Loudness normalization of stimulus and calibration clips (two-pass ffmpeg loudnorm).
+
+Sources are taken from VIDEO_SOURCE_DIR and written to the paths configured in config.py, i.e. for
+MOVIE_1_PATH = '.../norm_mov1.mp4' the source is VIDEO_SOURCE_DIR/mov1.mp4. Clips are processed in a process pool.
+A manifest next to the outputs, keyed by input content hash and ffmpeg parameters, makes unchanged clips skip.
+
+Usage:
+    python misc/video_handling.py [--workers N] [--force]
+"""
+import argparse
+import hashlib
+import json
 import os
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import CALIB_ANI_1_PATH, CALIB_ANI_2_PATH, CALIB_ANI_3_PATH, MOVIE_1_PATH, MOVIE_2_PATH, MOVIE_3_PATH
+from config import VIDEO_SOURCE_DIR, VIDEO_OUTPUT_PREFIX, ASSET_WORKERS
+from config import LOUDNORM_I, LOUDNORM_TP, LOUDNORM_LRA
+
+STIMULUS_PATHS = [CALIB_ANI_1_PATH, CALIB_ANI_2_PATH, CALIB_ANI_3_PATH, MOVIE_1_PATH, MOVIE_2_PATH, MOVIE_3_PATH]
+MANIFEST_NAME = 'loudnorm_manifest.json'
+LOUDNORM_TARGET = f"I={LOUDNORM_I}:TP={LOUDNORM_TP}:LRA={LOUDNORM_LRA}"
+AUDIO_ARGS = ["-c:a", "aac", "-b:a", "192k", "-ar", "48000"]
+
+
+def file_digest(path:str, chunk_size:int=1 << 20):
+    """
+    SHA-256 of file content, read in chunks.
+
+    Args:
+        path (str): File path.
+        chunk_size (int): Read size in bytes.
+
+    Returns:
+        (str): Hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cache_key(input_digest:str, params:list):
+    """
+    Manifest key of one processing job: input content hash combined with the ffmpeg parameters.
+    """
+    return hashlib.sha256((input_digest + '\0' + '\0'.join(params)).encode()).hexdigest()
+
+def load_manifest(path:str):
+    """
+    Loads a JSON manifest, returns an empty one if it does not exist or is unreadable.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_json_atomic(path:str, content:dict):
+    """
+    Writes JSON through a temporary file and os.replace, so an interrupted run never leaves a truncated file.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(content, f, indent=2)
+    os.replace(tmp_path, path)
+
+def tmp_output_path(output_path:str):
+    """
+    Temporary path in the output directory, keeping the extension so ffmpeg picks the right muxer.
+    """
+    folder, name = os.path.split(output_path)
+    return os.path.join(folder, f".tmp_{os.getpid()}_{name}")
+
+def run_ffmpeg(args:list):
+    """
+    Runs ffmpeg and returns its stderr, raising RuntimeError with the ffmpeg message on failure.
+    """
+    proc = subprocess.run(["ffmpeg", "-hide_banner", "-nostdin", "-y", *args],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors='replace')
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else
+                           f"ffmpeg exited with code {proc.returncode}")
+    return proc.stderr
+
+def _parse_loudnorm_json(stderr:str):
+    """
+    Extracts the JSON summary printed by loudnorm (print_format=json) at the end of ffmpeg stderr.
+    """
+    match = re.search(r"\{[^{}]*\"input_i\"[^{}]*\}", stderr)
+    if match is None:
+        raise RuntimeError("loudnorm summary not found in ffmpeg output")
+    return {k: float(v) if re.fullmatch(r"-?[\d.]+", str(v)) else v for k, v in json.loads(match.group(0)).items()}
+
+def measure_loudness(input_path:str, target:str=LOUDNORM_TARGET):
+    """
+    First loudnorm pass: measures integrated loudness, true peak, LRA and threshold of the audio stream.
+
+    Args:
+        input_path (str): Media file.
+        target (str): loudnorm target parameters.
+
+    Returns:
+        (dict): loudnorm summary (input_i, input_tp, input_lra, input_thresh, target_offset, ...).
+    """
+    stderr = run_ffmpeg(["-nostats", "-i", input_path, "-vn",
+                         "-af", f"loudnorm={target}:print_format=json", "-f", "null", "-"])
+    return _parse_loudnorm_json(stderr)
+
+def _apply_filter(measured:dict, target:str=LOUDNORM_TARGET):
+    return (f"loudnorm={target}:measured_I={measured['input_i']}:measured_TP={measured['input_tp']}:"
+            f"measured_LRA={measured['input_lra']}:measured_thresh={measured['input_thresh']}:"
+            f"offset={measured['target_offset']}:linear=true:print_format=json")
+
+def normalize_clip(input_path:str, output_path:str):
+    """
+    Two-pass loudness normalization of one clip. Video is stream-copied. The output is written to a temporary
+    file and moved into place only after ffmpeg succeeded.
+
+    Args:
+        input_path (str): Source clip.
+        output_path (str): Normalized clip.
+
+    Returns:
+        (dict): Job result with timings [s], measured and resulting loudness.
+    """
+    t0 = time.perf_counter()
+    measured = measure_loudness(input_path)
+    t1 = time.perf_counter()
+
+    tmp_path = tmp_output_path(output_path)
+    try:
+        stderr = run_ffmpeg(["-nostats", "-i", input_path, "-af", _apply_filter(measured),
+                             "-c:v", "copy", *AUDIO_ARGS, tmp_path])
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    t2 = time.perf_counter()
+
+    applied = _parse_loudnorm_json(stderr)
+    return {
+        'input': input_path,
+        'output': output_path,
+        'measure_time': t1 - t0,
+        'apply_time': t2 - t1,
+        'input_i': measured['input_i'],
+        'input_tp': measured['input_tp'],
+        'input_lra': measured['input_lra'],
+        'output_i': applied['output_i'],
+        'output_tp': applied['output_tp'],
+    }
+
+def _job(input_path:str, output_path:str, key:str):
+    """
+    Process pool entry point. Errors are returned, not raised, so one broken clip does not stop the others.
+    """
+    try:
+        result = normalize_clip(input_path, output_path)
+        result['status'] = 'done'
+    except (OSError, RuntimeError, KeyError) as e:
+        result = {'input': input_path, 'output': output_path, 'status': 'failed', 'error': str(e)}
+    result['key'] = key
+    return result
+
+def source_path(output_path:str, source_dir:str=VIDEO_SOURCE_DIR, prefix:str=VIDEO_OUTPUT_PREFIX):
+    """
+    Source clip of a configured (normalized) clip path: prefix stripped, looked up in source_dir.
+    """
+    name = os.path.basename(output_path)
+    if name.startswith(prefix):
+        name = name[len(prefix):]
+    return os.path.join(source_dir, name)
+
+def normalize_all(output_paths:list=None, source_dir:str=VIDEO_SOURCE_DIR, workers:int=ASSET_WORKERS,
+                  force:bool=False):
+    """
+    Normalizes all configured clips in a process pool, skipping those whose input and parameters did not change.
+
+    Args:
+        output_paths (list): Normalized clip paths, by default all paths configured in config.py.
+        source_dir (str): Folder with source clips.
+        workers (int): Number of ffmpeg processes run at once.
+        force (bool): Reprocess clips even if the manifest has them.
+
+    Returns:
+        (list): Job results (status 'done', 'skipped' or 'failed').
+    """
+    output_paths = STIMULUS_PATHS if output_paths is None else output_paths
+    params = ["loudnorm", LOUDNORM_TARGET, "-c:v", "copy", *AUDIO_ARGS]
+    manifests = {}
+    results, jobs = [], []
+
+    for output_path in output_paths:
+        input_path = source_path(output_path, source_dir)
+        manifest_path = os.path.join(os.path.dirname(output_path), MANIFEST_NAME)
+        manifest = manifests.setdefault(manifest_path, load_manifest(manifest_path))
+        if not os.path.isfile(input_path):
+            results.append({'input': input_path, 'output': output_path, 'status': 'failed',
+                            'error': 'source clip not found'})
+            continue
+        key = cache_key(file_digest(input_path), params)
+        entry = manifest.get(os.path.basename(output_path))
+        if not force and entry and entry.get('key') == key and os.path.isfile(output_path):
+            results.append({**entry, 'status': 'skipped'})
+            continue
+        jobs.append((input_path, output_path, key))
+
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_job, *job) for job in jobs]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                if result['status'] == 'done':
+                    manifest_path = os.path.join(os.path.dirname(result['output']), MANIFEST_NAME)
+                    manifests[manifest_path][os.path.basename(result['output'])] = result
+                    write_json_atomic(manifest_path, manifests[manifest_path])
+                print(f"{result['status']}: {os.path.basename(result['output'])}")
+    return results
 
-folder = "C:/Users/Badania/PycharmProjects/et_procedure/videos"
-output_prefix = "norm_"
+def print_report(results:list):
+    """
+    Prints per-clip timings and loudness.
+    """
+    print(f"{'clip':<24}{'status':<9}{'measure [s]':>12}{'apply [s]':>11}{'in LUFS':>9}{'out LUFS':>10}")
+    for r in sorted(results, key=lambda r: r['output']):
+        name = os.path.basename(r['output'])
+        if r['status'] == 'failed':
+            print(f"{name:<24}{'failed':<9}  {r['error']}")
+            continue
+        timings = (f"{r['measure_time']:>12.2f}{r['apply_time']:>11.2f}" if r['status'] == 'done'
+                   else f"{'-':>12}{'-':>11}")
+        print(f"{name:<24}{r['status']:<9}{timings}{r['input_i']:>9.1f}{r['output_i']:>10.1f}")
 
-for filename in os.listdir(folder):
-    if filename.endswith(".mp4"):
-        input_path = os.path.join(folder, filename)
-        output_path = os.path.join(folder, f"{output_prefix}{filename}")
 
-        cmd = [
-            "ffmpeg",
-            "-i", input_path,
-            "-af", "loudnorm=I=-16:TP=-1.5:LRA=11",
-            "-c:v", "copy",
-            output_path
-        ]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Two-pass loudness normalization of stimulus clips.")
+    parser.add_argument('--workers', type=int, default=ASSET_WORKERS)
+    parser.add_argument('--source-dir', default=VIDEO_SOURCE_DIR)
+    parser.add_argument('--force', action='store_true', help="reprocess clips found in the manifest")
+    args = parser.parse_args()
 
-        print("Normalizing:", filename)
-        subprocess.run(cmd)
+    job_results = normalize_all(source_dir=args.source_dir, workers=args.workers, force=args.force)
+    print_report(job_results)
+    if any(r['status'] == 'failed' for r in job_results):
+        sys.exit(1)
@@ -0,0 +1,203 @@
+"""
+Transcoding of configured clips to a decoder-friendly layout, and a headless decode benchmark.
+
+Clips are scaled to the subject display resolution (WIN_SIZES[WIN_ID_MAIN]), resampled to a frame rate dividing
+SUBJECT_REFRESH_RATE and encoded as H.264 without B-frames, with fastdecode tuning (no CABAC, no deblocking) and
+a short, fixed GOP. Outputs go to TRANSCODED_DIR under the same file names; main.py picks them up through
+m00_configuration_setup.get_stimulus_path. The stage is cached the same way as misc/video_handling.py.
+
+Usage:
+    python misc/video_transcoding.py transcode [--workers N] [--force]
+    python misc/video_transcoding.py benchmark
+"""
+import argparse
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import WIN_ID_MAIN, WIN_SIZES, SUBJECT_REFRESH_RATE, TRANSCODED_DIR, TRANSCODE_GOP, ASSET_WORKERS
+from misc.video_handling import STIMULUS_PATHS, file_digest, cache_key, load_manifest, write_json_atomic
+from misc.video_handling import run_ffmpeg, tmp_output_path
+from m04_asset_validation import probe_media
+
+MANIFEST_NAME = 'transcode_manifest.json'
+
+
+def target_frame_rate(source_fps:float, refresh_rate:int=SUBJECT_REFRESH_RATE):
+    """
+    Lowest frame rate not below source_fps that divides the display refresh rate, so every movie frame is shown
+    for the same number of refreshes (e.g. 24 or 25 fps -> 30 fps at 60 Hz).
+    """
+    if source_fps <= 0:
+        return refresh_rate
+    return refresh_rate / max(math.floor(refresh_rate / source_fps + 1e-6), 1)
+
+def transcode_params(fps:float, size:tuple=WIN_SIZES[WIN_ID_MAIN]):
+    """
+    ffmpeg output arguments of the decoder-friendly layout.
+    """
+    width, height = size
+    gop = max(int(round(fps * TRANSCODE_GOP)), 1)
+    vf = (f"scale={width}:{height}:force_original_aspect_ratio=decrease:flags=lanczos,"
+          f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,fps={fps:g},format=yuv420p")
+    return ["-vf", vf,
+            "-c:v", "libx264", "-preset", "slow", "-tune", "fastdecode", "-crf", "18",
+            "-bf", "0", "-g", str(gop), "-keyint_min", str(gop), "-sc_threshold", "0",
+            "-c:a", "copy", "-movflags", "+faststart"]
+
+def transcode_clip(input_path:str, output_path:str, params:list):
+    """
+    Transcodes one clip through a temporary file in the output directory.
+
+    Returns:
+        (dict): Job result with timing [s].
+    """
+    t0 = time.perf_counter()
+    tmp_path = tmp_output_path(output_path)
+    try:
+        run_ffmpeg(["-nostats", "-i", input_path, *params, tmp_path])
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return {'input': input_path, 'output': output_path, 'time': time.perf_counter() - t0}
+
+def _job(input_path:str, output_path:str, params:list, key:str):
+    try:
+        result = transcode_clip(input_path, output_path, params)
+        result['status'] = 'done'
+    except (OSError, RuntimeError) as e:
+        result = {'input': input_path, 'output': output_path, 'status': 'failed', 'error': str(e)}
+    result['key'] = key
+    return result
+
+def transcode_all(input_paths:list=None, output_dir:str=TRANSCODED_DIR, workers:int=ASSET_WORKERS,
+                  force:bool=False):
+    """
+    Transcodes all configured clips in a process pool, skipping clips whose input and parameters did not change.
+
+    Args:
+        input_paths (list): Clips to transcode, by default all paths configured in config.py.
+        output_dir (str): Destination folder.
+        workers (int): Number of ffmpeg processes run at once.
+        force (bool): Reprocess clips even if the manifest has them.
+
+    Returns:
+        (list): Job results (status 'done', 'skipped' or 'failed').
+    """
+    input_paths = STIMULUS_PATHS if input_paths is None else input_paths
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    results, jobs = [], []
+
+    for input_path in input_paths:
+        name = os.path.basename(input_path)
+        output_path = os.path.join(output_dir, name)
+        try:
+            params = transcode_params(target_frame_rate(probe_media(input_path)['fps']))
+        except (OSError, RuntimeError, KeyError, ValueError) as e:
+            results.append({'input': input_path, 'output': output_path, 'status': 'failed', 'error': str(e)})
+            continue
+        key = cache_key(file_digest(input_path), params)
+        entry = manifest.get(name)
+        if not force and entry and entry.get('key') == key and os.path.isfile(output_path):
+            results.append({**entry, 'status': 'skipped'})
+            continue
+        jobs.append((input_path, output_path, params, key))
+
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_job, *job) for job in jobs]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                if result['status'] == 'done':
+                    manifest[os.path.basename(result['output'])] = result
+                    write_json_atomic(manifest_path, manifest)
+                print(f"{result['status']}: {os.path.basename(result['output'])}")
+    return results
+
+def benchmark_decode(path:str, max_frames:int=None):
+    """
+    Decodes a clip headlessly (OpenCV/FFmpeg) into RGB frames, as handed to the render loop, and times each frame.
+
+    Args:
+        path (str): Media file.
+        max_frames (int): Stop after this many frames, None = whole clip.
+
+    Returns:
+        (dict): Frame count, mean/p95/p99/max decode time per frame [ms] and the share of frames slower than
+            one display refresh.
+    """
+    import cv2
+
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise RuntimeError(f"Cannot open {path}")
+    times = []
+    try:
+        while max_frames is None or len(times) < max_frames:
+            t0 = time.perf_counter()
+            ok, frame = cap.read()
+            if not ok:
+                break
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            times.append(time.perf_counter() - t0)
+    finally:
+        cap.release()
+    if not times:
+        raise RuntimeError(f"No frames decoded from {path}")
+
+    times = np.asarray(times) * 1000
+    return {
+        'frames': len(times),
+        'mean_ms': float(times.mean()),
+        'p95_ms': float(np.percentile(times, 95)),
+        'p99_ms': float(np.percentile(times, 99)),
+        'max_ms': float(times.max()),
+        'late_share': float(np.mean(times > 1000 / SUBJECT_REFRESH_RATE)),
+    }
+
+def run_benchmark(input_paths:list=None, output_dir:str=TRANSCODED_DIR, max_frames:int=None):
+    """
+    Benchmarks original and transcoded version of each clip and prints a comparison.
+    """
+    input_paths = STIMULUS_PATHS if input_paths is None else input_paths
+    print(f"{'clip':<24}{'version':<12}{'frames':>7}{'mean':>8}{'p95':>8}{'p99':>8}{'max':>8}{'late':>7}")
+    for input_path in input_paths:
+        name = os.path.basename(input_path)
+        for version, path in (('original', input_path), ('transcoded', os.path.join(output_dir, name))):
+            if not os.path.isfile(path):
+                print(f"{name:<24}{version:<12}  missing")
+                continue
+            r = benchmark_decode(path, max_frames)
+            print(f"{name:<24}{version:<12}{r['frames']:>7}{r['mean_ms']:>8.2f}{r['p95_ms']:>8.2f}"
+                  f"{r['p99_ms']:>8.2f}{r['max_ms']:>8.2f}{r['late_share']:>7.1%}")
+    print(f"Times in ms per frame; late = frames decoded slower than one refresh at {SUBJECT_REFRESH_RATE} Hz.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Decoder-friendly transcoding of stimulus clips.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    transcode_parser = subparsers.add_parser('transcode')
+    transcode_parser.add_argument('--workers', type=int, default=ASSET_WORKERS)
+    transcode_parser.add_argument('--force', action='store_true', help="reprocess clips found in the manifest")
+    benchmark_parser = subparsers.add_parser('benchmark')
+    benchmark_parser.add_argument('--max-frames', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == 'transcode':
+        job_results = transcode_all(workers=args.workers, force=args.force)
+        for r in job_results:
+            detail = f"{r['time']:.1f} s" if r['status'] == 'done' else r.get('error', '')
+            print(f"{os.path.basename(r['output']):<24}{r['status']:<9}{detail}")
+        if any(r['status'] == 'failed' for r in job_results):
+            sys.exit(1)
+    else:
+        run_benchmark(max_frames=args.max_frames)